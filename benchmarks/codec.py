@@ -0,0 +1,46 @@
+from __future__ import print_function
+import time
+
+from hop import Message
+from hop.codec import Codec, decode
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Encode and decode time and encoded size per message for each queue codec.
+
+    python -m benchmarks.codec
+"""
+
+CODECS = [('json', None), ('json', 'zlib'), ('json', 'lz4'), ('msgpack', None), ('msgpack', 'zlib'), ('msgpack', 'lz4')]
+
+def messages():
+    page = u'<html><body>' + u''.join(u'<p><a href="http://example.com/page/%d">Page %d</a> some text</p>' % (i, i) for i in range(1000)) + u'</body></html>'
+    return [('pageUrl', Message('pageUrl', {'url': 'http://abc.com/index.html', 'priority': 1})),
+            ('pageBody', Message('pageBody', {'body': page}))]
+
+def measure(codec, msg, count):
+    start = time.time()
+    for i in range(count):
+        data = codec.encode(msg)
+    encoded = time.time()
+    for i in range(count):
+        decode(data)
+    decoded = time.time()
+    return (encoded - start) / count * 1e6, (decoded - encoded) / count * 1e6, len(data)
+
+def main():
+    print('%-10s %-8s %-6s %12s %12s %10s' % ('message', 'format', 'comp', 'encode us', 'decode us', 'bytes'))
+    for name, msg in messages():
+        count = 10000 if name == 'pageUrl' else 200
+        for format, compression in CODECS:
+            try:
+                codec = Codec(format, compression)
+            except ImportError:
+                print('%-10s %-8s %-6s %s' % (name, format, compression or '-', 'not installed'))
+                continue
+            encodeTime, decodeTime, size = measure(codec, msg, count)
+            print('%-10s %-8s %-6s %12.1f %12.1f %10d' % (name, format, compression or '-', encodeTime, decodeTime, size))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+from __future__ import print_function
+import time
+
+from hop.local import LocalContext
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Cost of dispatching small messages through Context._process, with and without filters.
+
+    python -m benchmarks.dispatch
+"""
+
+COUNT = 100000
+
+def measure(filterCount):
+    context = LocalContext()
+
+    for i in range(filterCount):
+        context.filter('benchMessage', i)(lambda msg: msg)
+
+    @context.handle('benchMessage')
+    def handler(msg):
+        pass
+
+    msgs = [context.message(messageType='benchMessage', value=i) for i in range(COUNT)]
+    start = time.time()
+    for msg in msgs:
+        context._process(msg)
+    return COUNT / (time.time() - start)
+
+def main():
+    print('%10s %15s' % ('filters', 'msg/s'))
+    for filterCount in [0, 1, 3, 10]:
+        print('%10d %15.0f' % (filterCount, measure(filterCount)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+from __future__ import print_function
+import time
+
+from hop.local import LocalContext
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Throughput of LocalContext.publish and run as the number of queued messages grows.
+
+    python -m benchmarks.local_queue
+"""
+
+DEPTHS = [100, 1000, 10000, 100000]
+PRIORITIES = 4
+
+def measure(depth):
+    context = LocalContext()
+
+    @context.handle('benchMessage')
+    def handler(msg):
+        pass
+
+    msgs = [context.message(messageType='benchMessage', priority=i % PRIORITIES) for i in range(depth)]
+    start = time.time()
+    for msg in msgs:
+        context.publish(msg)
+    published = time.time()
+    context.run()
+    finished = time.time()
+    return depth / (published - start), depth / (finished - published)
+
+def main():
+    print('%10s %15s %15s' % ('depth', 'publish msg/s', 'run msg/s'))
+    for depth in DEPTHS:
+        publishRate, runRate = measure(depth)
+        print('%10d %15.0f %15.0f' % (depth, publishRate, runRate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+from __future__ import print_function
+import time
+
+from hop import Message
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Cost of creating and cloning messages, including one carrying a large page body.
+
+    python -m benchmarks.message
+"""
+
+COUNT = 100000
+
+def rate(f):
+    start = time.time()
+    for i in range(COUNT):
+        f()
+    return COUNT / (time.time() - start)
+
+def main():
+    small = Message('pageUrl', {'url': 'http://abc.com'})
+    large = Message('pageBody', {'body': 'x' * 500000})
+    print('%-25s %15s' % ('operation', 'ops/s'))
+    print('%-25s %15.0f' % ('create', rate(lambda: Message('pageUrl', {'url': 'http://abc.com'}))))
+    print('%-25s %15.0f' % ('create + read ID', rate(lambda: Message('pageUrl', {'url': 'http://abc.com'})['_system']['messageID'])))
+    print('%-25s %15.0f' % ('clone', rate(small.clone)))
+    print('%-25s %15.0f' % ('clone large body', rate(large.clone)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+from __future__ import print_function
+import re
+import sys
+import gc
+import json
+import time
+import base64
+import atexit
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+from timeit import default_timer as timer
+
+from hop import Message, ContextConfig
+from hop.codec import Codec
+from hop.local import LocalContext
+from hop.kinesis import LambdaContext
+from tests.stubs import StubKinesisClient, StubTable
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Benchmarks of the dispatch hot path, written as JSON so runs on different commits can be compared.
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --compare before.json [--threshold 0.15] [--filter lambda]
+
+Every case is timed for --duration seconds, --repeat times, and the best rate is kept.
+With --compare, cases slower than the baseline by more than the threshold are reported as regressions
+and the exit status is 1.
+"""
+
+CASES = []
+
+def case(name):
+    """Registers a setup function returning (callable, operations per call) under the name"""
+    def register(setup):
+        CASES.append((name, setup))
+        return setup
+    return register
+
+
+def handlerContext(contextClass=LocalContext, config=None, handlers=1, filters=0, **kwargs):
+    context = contextClass(config, **kwargs)
+    for i in range(filters):
+        context.filter('benchMessage', i)(lambda msg: msg)
+    for i in range(handlers):
+        def handler(msg):
+            pass
+        handler.__name__ = 'handler%d' % i
+        context.handle('benchMessage')(handler)
+    return context
+
+
+@case('message.create')
+def messageCreate():
+    return lambda: Message('pageUrl', {'url': 'http://abc.com'}), 1
+
+@case('message.clone')
+def messageClone():
+    msg = Message('pageUrl', {'url': 'http://abc.com'})
+    return msg.clone, 1
+
+# No runtime.autoStop: the lambda.handler cases would stop processing after autoStopLimit messages
+CONFIG = {'runtime': {'stateTTL': 5},
+          'lambda': {'concurrency': 1, 'deadlineMargin': 1000},
+          'queues': {'priority': {'type': 'kinesis', 'stream': 'HopperQueuePriority'},
+                     'default': {'type': 'kinesis', 'stream': 'HopperQueue', 'codec': 'json'}}}
+
+@case('config.construct')
+def configConstruct():
+    return lambda: ContextConfig(CONFIG), 1
+
+@case('config.lookup.hit')
+def configHit():
+    config = ContextConfig(CONFIG)
+    return lambda: config['queues.default.stream'], 1
+
+@case('config.lookup.miss')
+def configMiss():
+    config = ContextConfig(CONFIG)
+    return lambda: config['dispatch.fanout'], 1
+
+def filterCase(count):
+    def setup():
+        context = handlerContext(filters=count)
+        msg = context.message(messageType='benchMessage')
+        plan = context._plan('benchMessage')
+        return lambda: context._filterMsg(msg, plan), 1
+    return setup
+
+for _count in [1, 5, 20]:
+    case('filterMsg.%d' % _count)(filterCase(_count))
+
+def fanoutCase(handlers, fanout):
+    def setup():
+        context = handlerContext(config=ContextConfig({'dispatch': {'fanout': fanout}}), handlers=handlers)
+        msg = context.message(messageType='benchMessage')
+        plan = context._plan('benchMessage')
+
+        def invoke():
+            context._invokeRule(plan, msg)
+            if len(context.queues):
+                context.queues = type(context.queues)()
+        return invoke, 1
+    return setup
+
+for _handlers in [1, 4]:
+    for _fanout in ['queue', 'inline']:
+        case('invokeRule.%d.%s' % (_handlers, _fanout))(fanoutCase(_handlers, _fanout))
+
+def localCase(depth, config=None):
+    def setup():
+        context = handlerContext(config=config() if config is not None else None)
+        msgs = [context.message(messageType='benchMessage', priority=i % 4) for i in range(depth)]
+
+        def publishAndRun():
+            for msg in msgs:
+                context.publish(msg)
+            context.run()
+        return publishAndRun, depth
+    return setup
+
+for _depth in [1, 100, 10000]:
+    case('local.publishRun.%d' % _depth)(localCase(_depth))
+
+def durableConfig():
+    directory = tempfile.mkdtemp(prefix='hopper-bench-')
+    atexit.register(shutil.rmtree, directory, True)
+    return ContextConfig({'local': {'durable': {'directory': directory}}})
+
+for _depth in [100, 10000]:
+    case('local.durable.publishRun.%d' % _depth)(localCase(_depth, durableConfig))
+
+def lambdaCase(records):
+    def setup():
+        config = ContextConfig(CONFIG)
+        context = handlerContext(LambdaContext, config, kinesisClient=StubKinesisClient(), table=StubTable())
+        codec = Codec()
+        event = {'Records': [{'kinesis': {'data': base64.b64encode(codec.encode(Message('benchMessage', {'value': i}))).decode('ascii'),
+                                          'sequenceNumber': str(i), 'partitionKey': str(i)}}
+                             for i in range(records)]}
+        return lambda: context.lambda_handler(event, None), records
+    return setup
+
+for _records in [1, 10, 100, 500]:
+    case('lambda.handler.%d' % _records)(lambdaCase(_records))
+
+
+def measure(setup, duration, repeat):
+    f, operations = setup()
+    f()
+    best = 0
+    # As in timeit, collections triggered by earlier cases would otherwise be charged to this one
+    gc.collect()
+    gc.disable()
+    try:
+        best = bestRate(f, operations, duration, repeat)
+    finally:
+        gc.enable()
+    return best
+
+def bestRate(f, operations, duration, repeat):
+    # Calls are timed in batches of at least 10ms, so the timer adds nothing to fast cases
+    number = 1
+    while True:
+        elapsed = timeCalls(f, number)
+        if elapsed >= 0.01:
+            break
+        number *= 2
+    best = 0
+    for i in range(repeat):
+        calls = 0
+        elapsed = 0
+        while elapsed < duration:
+            elapsed += timeCalls(f, number)
+            calls += number
+        best = max(best, calls * operations / elapsed)
+    return best
+
+def timeCalls(f, number):
+    calls = range(number)
+    start = timer()
+    for i in calls:
+        f()
+    return timer() - start
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).decode('ascii').strip()
+    except Exception:
+        return None
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print('%-28s %14s %14s %9s' % ('case', 'baseline/s', 'current/s', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['opsPerSec'], result['opsPerSec']
+        change = after / before - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('%-28s %14.0f %14.0f %+8.1f%%%s' % (name, before, after, change * 100, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Hopper dispatch benchmarks')
+    parser.add_argument('--output', help='file to write the JSON results to (stdout by default)')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.15, help='slowdown reported as a regression (0.15 = 15%%)')
+    parser.add_argument('--filter', help='regular expression selecting the cases to run')
+    parser.add_argument('--duration', type=float, default=0.2, help='seconds each case is timed for')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    results = dict()
+    for name, setup in CASES:
+        if args.filter and not re.search(args.filter, name):
+            continue
+        rate = measure(setup, args.duration, args.repeat)
+        results[name] = {'opsPerSec': rate, 'usPerOp': 1e6 / rate}
+        print('%-28s %14.0f ops/s' % (name, rate), file=sys.stderr)
+
+    report = {'commit': commit(), 'python': platform.python_version(), 'time': int(time.time()), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+    elif not args.compare:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+import tempfile
+import subprocess
+from timeit import default_timer as timer
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Cold start of the crawler example on Lambda: every run is a new interpreter which imports
+examples.crawler.crawl (importing hop and creating its LambdaContext) and then hands one Kinesis
+record to crawl.lambda_handler.
+
+    python -m benchmarks.startup --runs 10 [--output startup.json]
+
+Reported in milliseconds, the median and the best of the runs:
+    importHop     import hop
+    import        import of the crawler module, including the above
+    firstMessage  the first lambda_handler call, including the AWS clients it creates (and the import of boto3
+                  when hop has not imported it yet)
+    total         import and firstMessage
+AWS is not called: the requests are answered with an empty response by a before-send hook of the
+boto3 session, so the clients are created, the requests signed and the responses parsed as on Lambda.
+"""
+
+STAGES = ['importHop', 'import', 'firstMessage', 'total']
+
+
+class _Raw(object):
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def _emptyResponse(request, **kwargs):
+    from botocore.awsrequest import AWSResponse
+    return AWSResponse(request.url, 200, {}, _Raw(b'{}'))
+
+
+def probe():
+    """Runs in the new interpreter, prints the times of the stages as JSON"""
+    start = timer()
+    import hop
+    importedHop = timer()
+    from examples.crawler import crawl
+    imported = timer()
+    # The hook needs boto3, which the first message would import otherwise, so its import is counted there
+    boto3Started = timer()
+    import boto3
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-send', _emptyResponse)
+    boto3Imported = timer()
+    msg = hop.Message('pageBody', {'body': '<html><body>No links</body></html>'})
+    event = {'Records': [{'eventSource': 'aws:kinesis',
+                          'kinesis': {'data': base64.b64encode(json.dumps(msg).encode('utf-8')).decode('ascii'),
+                                      'sequenceNumber': '1', 'partitionKey': '1'}}]}
+    handled = timer()
+    crawl.lambda_handler(event, None)
+    done = timer()
+    firstMessage = done - handled + boto3Imported - boto3Started
+    print(json.dumps({'importHop': (importedHop - start) * 1000, 'import': (imported - start) * 1000,
+                      'firstMessage': firstMessage * 1000, 'total': (firstMessage + imported - start) * 1000}))
+
+
+def run(runs):
+    env = dict(os.environ, AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark',
+               AWS_DEFAULT_REGION='ap-southeast-2', HOPPER_URL_STORE=os.path.join(tempfile.gettempdir(), 'hopper-startup-urls'))
+    samples = dict((stage, []) for stage in STAGES)
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-m', 'benchmarks.startup', '--probe'], env=env)
+        times = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        for stage in STAGES:
+            samples[stage].append(times[stage])
+    results = dict()
+    for stage in STAGES:
+        values = sorted(samples[stage])
+        results['startup.%s' % stage] = {'medianMs': values[len(values) // 2], 'bestMs': values[0]}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Hopper cold start benchmark')
+    parser.add_argument('--runs', type=int, default=10, help='interpreters started')
+    parser.add_argument('--output', help='file to write the JSON results to (stdout by default)')
+    parser.add_argument('--probe', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.probe:
+        probe()
+        return 0
+
+    # Imported here, the probes measure the imports of hop themselves
+    from benchmarks.run import commit
+    results = run(args.runs)
+    for name in sorted(results):
+        print('%-24s %10.1f ms median %10.1f ms best' % (name, results[name]['medianMs'], results[name]['bestMs']),
+              file=sys.stderr)
+    report = {'commit': commit(), 'python': platform.python_version(), 'time': int(time.time()), 'runs': args.runs, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
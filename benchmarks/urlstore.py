@@ -0,0 +1,71 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from examples.crawler.urlstore import UrlStore
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Inserts and lookups per second and bytes per URL of the crawler's seen-URL store, against a dict.
+
+    python -m benchmarks.urlstore [urls]
+"""
+
+def urls(count, offset=0):
+    return ['http://example%d.com/path/to/page/%d.html' % (i % 1000, i) for i in range(offset, offset + count)]
+
+def rate(count, start):
+    return count / max(time.time() - start, 1e-9)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    seen, unseen = urls(count), urls(count, count)
+    both = seen + unseen
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        processed = dict()
+        for url in seen:
+            processed[url] = url
+        dictInsert = rate(count, start)
+        start = time.time()
+        for url in both:
+            url in processed
+        dictLookup = rate(2 * count, start)
+        dictBytes = sys.getsizeof(processed) + sum(sys.getsizeof(url) for url in seen)
+
+        path = os.path.join(directory, 'urls')
+        store = UrlStore(path)
+        start = time.time()
+        for url in seen:
+            store.add(url)
+        storeInsert = rate(count, start)
+        start = time.time()
+        for url in both:
+            url in store
+        storeLookup = rate(2 * count, start)
+        start = time.time()
+        for batch in range(0, 2 * count, 500):
+            store.containsMany(both[batch:batch + 500])
+        storeBatch = rate(2 * count, start)
+        store.close()
+        storeBytes = os.path.getsize(path)
+        start = time.time()
+        reopened = UrlStore(path)
+        assert len(reopened) == count
+        reopenTime = time.time() - start
+        reopened.close()
+
+        print('%-10s %14s %14s %14s %12s' % ('store', 'inserts/s', 'lookups/s', 'batch/s', 'bytes/url'))
+        print('%-10s %14d %14d %14s %12.1f' % ('dict', dictInsert, dictLookup, '-', dictBytes / float(count)))
+        print('%-10s %14d %14d %14d %12.1f' % ('urlstore', storeInsert, storeLookup, storeBatch, storeBytes / float(count)))
+        print('urlstore reopened with %d urls in %.1f ms' % (count, reopenTime * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
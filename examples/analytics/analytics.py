@@ -1,76 +1,79 @@
+import os
+import sys
+
+if __name__ == '__main__':
+    # Run as a script: python examples/analytics/analytics.py, hop and the examples are found from the repository root
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+
 from examples.analytics import lookupUserAgent, incrementPageView, incrementUserCounter, parsePath
 from hop.kinesis import LambdaContext
 from hop.local import LocalContext
 
 __author__ = 'Denis Mikhalkin'
 
-from hop import Context, ContextConfig
+from hop import ContextConfig
+
+import logging
+logger = logging.getLogger("hopper.analytics")
 
 # Use case: web analytics (page views, unique users, geo ip lookup (block), user lookup(block), user agent lookup(block))
 
 if __name__ == '__main__':
-    context = LocalContext(ContextConfig(autoStop=True, autoStopLimit=100))
+    context = LocalContext(ContextConfig(runtime={'autoStop': True, 'autoStopLimit': 100}))
     logging.basicConfig(format='%(levelname)s | %(filename)s | %(message)s', level=logging.DEBUG)
 else:
     # By default, make sure the sample stops on Lambdato avoid incurring costs
-    context = LambdaContext(ContextConfig(autoStop=True, autoStopLimit=100))
+    context = LambdaContext(ContextConfig(runtime={'autoStop': True, 'autoStopLimit': 100}))
 
-@context.webHandler("webRequest")
 @context.handle('pageView')
 def pageView(msg):
-    url = msg['url']
-    context.publish(context.message(messageType='internalPageView', url=url))\
-        .collect('enrichedPageView') \
-        .mergeAs('enrichedFinalPageView')
+    # Both internalPageView handlers enrich the page view, the join below merges what they found
+    context.publish(context.message(messageType='internalPageView', url=msg['url'], cookie=msg['cookie'],
+                                    userAgent=msg['userAgent']))
 
 @context.handle('internalPageView')
 def geoIPLookup(msg):
     # Lookup IP
-    url = msg['url']
-    country=''
-    context.publish(context.message(msg.update(dict(messageType='enrichedPageView', country='')))
-
-# Note that it matches the original message
-@context.handle('enrichedFinalPageView')
-def uniqueUsers(msg):
-    cookie = msg['cookie']
-    country = msg['country']
-    # Increment user counter recording their country
-    incrementUserCounter(cookie, country)
-    # Nothing published
-
-@context.handle('enrichedFinalPageView')
-def enrichedPageView(msg):
-    country = msg['country']
-    url = msg['url']
-    path = parsePath(url)
-    # Increment page views recording device country
-    incrementPageView(path, country)
-    # Nothing published
+    country = 'AU'
+    context.publish(context.message(messageType='enrichedPageView', url=msg['url'], cookie=msg['cookie'],
+                                    country=country))
 
 @context.handle('internalPageView')
 def resolveUserAgent(msg):
-    userAgent = msg['userAgent']
-    browserInfo = lookupUserAgent(userAgent)
-    context.publish(context.message(msg.update(dict(messageType='enrichedPageView').update(browserInfo))))
+    browserInfo = lookupUserAgent(msg['userAgent'])
+    context.publish(context.message(messageType='enrichedPageView', url=msg['url'], cookie=msg['cookie'],
+                                    **browserInfo))
 
-# Alternative to .collect - collect all message which have the same parentMessageID
-# This method will receive original 'enrichedPageView' messages, first each one of them, and eventually all of them
-@context.join(message='enrichedPageView', condition='parentMessageID', discard='5s')
+# Collects the enrichedPageView messages which have the same parentMessageID (the internalPageView they came from)
+# This method receives the group each time one of them arrives, until all of them did
+@context.join('parentMessageID', message='enrichedPageView', discard='5s')
 def collectPageViews(msgs):
     if not msgs.checkFieldsInMessages('country', 'deviceType'):
         return
 
     context.forget(msgs)
-    country = msgs['country']
-    url = msgs['url']
-    path = parsePath(url)
+    context.publish(context.message(messageType='enrichedFinalPageView', url=msgs['url'], cookie=msgs['cookie'],
+                                    country=msgs['country'], deviceType=msgs['deviceType']))
+
+@context.handle('enrichedFinalPageView')
+def uniqueUsers(msg):
+    # Increment user counter recording their country
+    incrementUserCounter(msg['cookie'], msg['country'])
+    logger.info('Unique user %s from %s', msg['cookie'], msg['country'])
+    # Nothing published
+
+@context.handle('enrichedFinalPageView')
+def enrichedPageView(msg):
+    path = parsePath(msg['url'])
     # Increment page views recording device country
-    incrementPageView(path, country)
+    incrementPageView(path, msg['country'])
+    logger.info('Page view of %s from %s on %s', msg['url'], msg['country'], msg['deviceType'])
+    # Nothing published
 
 # Default handler for Lambda implementation
 def lambda_handler(event, lambda_context):
-    context.lambda_handler(event, lambda_context)
+    # The batch item failures reported by the context go back to Lambda
+    return context.lambda_handler(event, lambda_context)
 
 if __name__ == '__main__':
     # Using default implementation for testing
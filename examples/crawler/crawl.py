@@ -1,5 +1,5 @@
 from __future__ import print_function
-from examples.crawler.db import isUrlProcessed, markUrlProcessed
+from examples.crawler.db import isUrlProcessed, markUrlProcessed, unprocessedUrls
 from hop import Context, ContextConfig
 from hop.local import LocalContext
 from hop.kinesis import LambdaContext
@@ -12,12 +12,12 @@ import logging
 logger = logging.getLogger("hopper.crawler")
 
 if __name__ == '__main__':
-    # context = LocalContext(ContextConfig(autoStop=True, autoStopLimit=100))
+    # context = LocalContext(ContextConfig(runtime={'autoStop': True, 'autoStopLimit': 100}))
     context = LocalContext(ContextConfig.fromYaml('config.yaml'))
     logging.basicConfig(format='%(levelname)s | %(filename)s | %(message)s', level=logging.DEBUG)
 else:
     # By default, make sure the sample stops on Lambdato avoid incurring costs
-    context = LambdaContext(ContextConfig(autoStop=True, autoStopLimit=100, dynamoDBRegion='ap-southeast-2', kinesisRegion='ap-southeast-2'))
+    context = LambdaContext(ContextConfig(runtime={'autoStop': True, 'autoStopLimit': 100}, aws={'region': 'ap-southeast-2'}))
 
 @context.handle("pageUrl")
 def pageUrl(msg):
@@ -41,9 +41,8 @@ def pageBody(msg): # TODO Unwrap parameters
     logger.info("pageBody %s" % msg)
     if 'body' in msg and msg['body'] is not None:
         urls = extractUrls(msg['body'])
-        for url in urls:
-            if not isUrlProcessed(url):
-                context.publish(context.message(messageType='pageUrl', url=url, priority=(0 if url.startswith('https') else 1)))
+        for url in unprocessedUrls(urls):
+            context.publish(context.message(messageType='pageUrl', url=url, priority=(0 if url.startswith('https') else 1)))
     else:
         logger.warn('body is None in pageBody(msg)')
 
@@ -60,7 +59,8 @@ def nopFilter(msg):
 
 # Default handler for Lambda implementation
 def lambda_handler(event, lambda_context):
-    context.lambda_handler(event, lambda_context)
+    # The batch item failures reported by the context go back to Lambda
+    return context.lambda_handler(event, lambda_context)
 
 if __name__ == '__main__':
     logger.info('Running crawler')
@@ -1,9 +1,34 @@
+import os
+import tempfile
+
+from examples.crawler.urlstore import UrlStore
+
 __author__ = 'Denis Mikhalkin'
 
-_processed = dict()
+# Seen URLs survive restarts of the crawler (and warm Lambda invocations, which share /tmp)
+# The store is opened by one process only: run the crawler with LocalContext, not ProcessPoolContext (every Lambda
+# container has a /tmp of its own)
+_store = dict()
+
+def urlStore():
+    if 'store' not in _store:
+        path = os.environ.get('HOPPER_URL_STORE') or os.path.join(tempfile.gettempdir(), 'hopper-seen-urls')
+        _store['store'] = UrlStore(path)
+    return _store['store']
 
 def isUrlProcessed(url):
-    return url in _processed
+    return url in urlStore()
 
 def markUrlProcessed(url):
-    _processed[url] = url
\ No newline at end of file
+    urlStore().add(url)
+
+def unprocessedUrls(urls):
+    """The URLs which have not been processed, in order and without repeats"""
+    store = urlStore()
+    seen = set()
+    result = []
+    for url, processed in zip(urls, store.containsMany(urls)):
+        if not processed and url not in seen:
+            seen.add(url)
+            result.append(url)
+    return result
@@ -0,0 +1,168 @@
+import os
+import mmap
+import struct
+import hashlib
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Set of seen URLs kept in a memory-mapped file.
+
+Every URL is stored as the first 8 bytes of its MD5 digest in an open-addressing hash table with linear
+probing (0 marks an empty slot). The table doubles when it is more than maxLoad full, so it is between
+maxLoad / 2 and maxLoad full and takes 8 / maxLoad to 16 / maxLoad bytes per URL (16 to 32 with the default
+maxLoad of 0.5, 32 right after it grew). Only the pages touched by lookups are read into memory.
+Two URLs sharing a 64 bit hash are treated as the same URL, which is expected about once in 10^11 URLs
+for a store of tens of millions.
+
+The store is not shared between processes: the count in the header and the slots are updated without a lock,
+and growing replaces the file, so one process at a time opens it.
+"""
+
+_HEADER = struct.Struct('<8sQQ')
+_SLOT = struct.Struct('<Q')
+_MAGIC = b'HOPURLS1'
+_CHUNK = 65536
+
+def urlHash(url):
+    if not isinstance(url, bytes):
+        url = url.encode('utf-8')
+    return _SLOT.unpack(hashlib.md5(url).digest()[:8])[0] or 1
+
+
+class UrlStore(object):
+    """
+    Seen URLs persisted in the file at path, or kept in anonymous memory when path is None.
+    capacity is the initial number of slots, rounded up to a power of two. Used by a single process
+    """
+    def __init__(self, path=None, capacity=None, maxLoad=0.5):
+        self.path = path
+        self.maxLoad = maxLoad
+        self.file = None
+        if path is not None and os.path.exists(path) and os.path.getsize(path) > 0:
+            self._open(path)
+        else:
+            slots = 1024
+            while slots < (capacity or 65536):
+                slots *= 2
+            self._create(path, slots)
+
+    def _create(self, path, slots):
+        size = _HEADER.size + slots * _SLOT.size
+        if path is not None:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), size)
+        else:
+            self.map = mmap.mmap(-1, size)
+        self.slots = slots
+        self.mask = slots - 1
+        self.count = 0
+        _HEADER.pack_into(self.map, 0, _MAGIC, slots, 0)
+
+    def _open(self, path):
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.slots, self.count = _HEADER.unpack_from(self.map, 0)
+        if magic != _MAGIC:
+            raise ValueError('%s is not a URL store' % path)
+        self.mask = self.slots - 1
+
+    def _find(self, value):
+        """Offset of the slot holding the hash, or of the empty slot where it belongs, and whether it was found"""
+        index = value & self.mask
+        unpack = _SLOT.unpack_from
+        while True:
+            offset = _HEADER.size + index * 8
+            current = unpack(self.map, offset)[0]
+            if current == value:
+                return offset, True
+            if current == 0:
+                return offset, False
+            index = (index + 1) & self.mask
+
+    def __contains__(self, url):
+        return self._find(urlHash(url))[1]
+
+    def __len__(self):
+        return self.count
+
+    def add(self, url):
+        """Adds the URL, returns False if it was already in the store"""
+        return self._insert(urlHash(url))
+
+    def _insert(self, value):
+        if self.count + 1 > self.slots * self.maxLoad:
+            self._grow()
+        offset, found = self._find(value)
+        if found:
+            return False
+        _SLOT.pack_into(self.map, offset, value)
+        self.count += 1
+        struct.pack_into('<Q', self.map, 16, self.count)
+        return True
+
+    def _probeOrder(self, urls):
+        # Probing in slot order keeps the reads of a batch sequential in the file
+        hashes = [urlHash(url) for url in urls]
+        return hashes, sorted(range(len(hashes)), key=lambda i: hashes[i] & self.mask)
+
+    def containsMany(self, urls):
+        """List of booleans telling which of the URLs are in the store"""
+        hashes, order = self._probeOrder(urls)
+        result = [False] * len(hashes)
+        mapped, mask, unpack = self.map, self.mask, _SLOT.unpack_from
+        for i in order:
+            value = hashes[i]
+            index = value & mask
+            while True:
+                current = unpack(mapped, _HEADER.size + index * 8)[0]
+                if current == value:
+                    result[i] = True
+                    break
+                if current == 0:
+                    break
+                index = (index + 1) & mask
+        return result
+
+    def addMany(self, urls):
+        """Adds the URLs and returns the ones which were not in the store yet, in their original order"""
+        hashes, order = self._probeOrder(urls)
+        added = [False] * len(hashes)
+        for i in order:
+            added[i] = self._insert(hashes[i])
+        return [url for url, new in zip(urls, added) if new]
+
+    @staticmethod
+    def _hashes(mapped, slots):
+        for start in range(0, slots, _CHUNK):
+            count = min(_CHUNK, slots - start)
+            for value in struct.unpack_from('<%dQ' % count, mapped, _HEADER.size + start * 8):
+                if value:
+                    yield value
+
+    def _grow(self):
+        oldMap, oldFile, oldSlots = self.map, self.file, self.slots
+        path = self.path + '.grow' if self.path is not None else None
+        self._create(path, oldSlots * 2)
+        # Streamed from the old table, which is mapped until the new one is complete
+        count = 0
+        for value in UrlStore._hashes(oldMap, oldSlots):
+            _SLOT.pack_into(self.map, self._find(value)[0], value)
+            count += 1
+        self.count = count
+        struct.pack_into('<Q', self.map, 16, self.count)
+        oldMap.close()
+        if oldFile is not None:
+            oldFile.close()
+            self.map.flush()
+            os.rename(path, self.path)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        if self.file is not None:
+            self.file.close()
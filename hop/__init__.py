@@ -1,14 +1,22 @@
 from __future__ import print_function
 __author__ = 'Denis Mikhalkin'
 
+import os
+import sys
+import time
 import uuid
+import json
 import logging
-from datetime import datetime
-import yaml
-import collections
+import itertools
+from datetime import datetime, timedelta
+from timeit import default_timer as timer
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from hop.tracing import activate, deactivate, link, copyLineage
 logger = logging.getLogger("hopper.base")
 
-# TODO Message ID, parent/child
 # TODO Doc Comments and comments in code
 # TODO Unit test: Filter, Join, Collect, Merge
 # TODO Exception handling - if error occurs, message is retried X number of times
@@ -26,23 +34,24 @@ logger = logging.getLogger("hopper.base")
 
 # TODO Config is too specific to the implementation. Should have generic sections, which will be interpreted by corresponding service
 class ContextConfig(dict):
-    def __init__(self, yamlObject=None):
+    def __init__(self, yamlObject=None, **sections):
+        """Configuration from the parsed config.yaml, or its sections as keywords: ContextConfig(runtime={...})"""
         dict.__init__(self)
-        if yaml is not None:
+        if sections:
+            yamlObject = dict(yamlObject or {}, **sections)
+        if yamlObject is not None:
             self.update(yamlObject)
             for key, value in ContextConfig._traverse(yamlObject):
                 self[key] = value
 
-    def __getitem__(self, key):
-        try:
-            return dict.__getitem__(self, key)
-        except:
-            return None
+    def __missing__(self, key):
+        # Missing keys read as None. dict calls this only on a miss, so hits stay at dict speed
+        return None
 
     @staticmethod
     def _traverse(nested):
-        for key, value in nested.iteritems():
-            if isinstance(value, collections.Mapping):
+        for key, value in nested.items():
+            if isinstance(value, Mapping):
                 for inner_key, inner_value in ContextConfig._traverse(value):
                     yield key + '.' + inner_key, inner_value
             else:
@@ -50,11 +59,54 @@ class ContextConfig(dict):
 
     @staticmethod
     def fromYaml(configFile):
+        # yaml is only needed by contexts configured from a file, so importing hop does not load it
+        import yaml
         with open(configFile, 'r') as stream:
             return ContextConfig(yamlObject=yaml.load(stream))
 
 
+_EPOCH = datetime(1970, 1, 1)
+_idState = {'pid': None, 'prefix': None, 'counter': None}
+
+def _nextMessageID():
+    """Unique per process prefix plus a counter, so only the first message of a process pays for uuid4"""
+    pid = os.getpid()
+    if _idState['pid'] != pid:
+        _idState['pid'] = pid
+        _idState['prefix'] = str(uuid.uuid4())
+        _idState['counter'] = itertools.count()
+    return '%s-%x' % (_idState['prefix'], next(_idState['counter']))
+
+
+_clock = [None]
+
+def _timestamp(now):
+    """str() of the UTC datetime of the time, the date and time of day formatted once per second"""
+    second, micros = divmod(int(round(now * 1000000)), 1000000)
+    cached = _clock[0]
+    if cached is None or cached[0] != second:
+        cached = _clock[0] = (second, str(_EPOCH + timedelta(seconds=second)))
+    return '%s.%06d' % (cached[1], micros) if micros else cached[1]
+
+
+class SystemHeader(dict):
+    """
+    The _system part of a Message: a dict with messageID and timestamp, and entries such as flow.
+    Both are stored when it is created, so json.dumps, msgpack and pickle see them as they are
+    """
+    __slots__ = ()
+
+    def __init__(self, values=None):
+        dict.__init__(self)
+        self['messageID'] = _nextMessageID()
+        self['timestamp'] = _timestamp(time.time())
+        if values:
+            self.update(values)
+
+
 class Message(dict):
+    __slots__ = ()
+
     def __init__(self, messageType, params):
         dict.__init__(self)
         if messageType is None or messageType == '':
@@ -62,18 +114,76 @@ class Message(dict):
         if params is not None:
             self.update(params)
         self['messageType'] = messageType
-        self['_system'] = {
-            'messageID': str(uuid.uuid4()),
-            'timestamp': str(datetime.utcnow())
-        }
+        self['_system'] = SystemHeader()
 
     def clone(self):
-        return Message(self['messageType'], self)
+        """
+        Copy of the message with a new _system header. Only the top level dict is copied,
+        the field values (such as a page body) are shared with the original
+        """
+        msg = dict.__new__(type(self))
+        dict.update(msg, self)
+        dict.__setitem__(msg, '_system', SystemHeader())
+        return msg
+
+class DispatchPlan(object):
+    """
+    Filters and handlers registered for one messageType, compiled by Context._plan.
+    Filters are sorted by their order, handlers keep registration order and are indexed by name.
+    isolated holds the handlers which always receive their fan-out copy through the queue.
+    joins holds the JoinRules collecting messages of the type.
+    """
+    __slots__ = ('filters', 'handlers', 'handlersByName', 'isolated', 'joins')
+
+    def __init__(self, filters, handlers, isolated=frozenset(), joins=()):
+        self.filters = filters
+        self.handlers = handlers
+        self.isolated = isolated
+        self.joins = joins
+        self.handlersByName = dict()
+        for callback in handlers:
+            self.handlersByName.setdefault(callback.__name__, callback)
+
+
+def _messageTypeOf(msg):
+    if isinstance(msg, dict):
+        return msg.get('messageType')
+    # Groups of messages passed to join callbacks
+    return getattr(getattr(msg, 'rule', None), 'message', None)
+
 
 class Context(object):
     def __init__(self, config=None):
         self.config = config or ContextConfig()
         self.rules = dict(filter=dict(), handler=dict(), join=dict())
+        self.orders = dict(filter=dict(), handler=dict(), join=dict())
+        self.plans = dict()
+        self.isolated = set()
+        self.joins = dict()
+        self.joinStore = None
+        # How the handlers after the first one receive a message: queue, inline or pool
+        self.fanout = self.config['dispatch.fanout'] or 'queue'
+        self.fanoutExecutor = None
+        from hop.metrics import Metrics
+        self.metrics = Metrics.fromConfig(self.config)
+        self.tracer = None
+        if self.config['tracing.enabled']:
+            from hop.tracing import Tracer
+            self.tracer = Tracer.fromConfig(self.config)
+        self.dedup = None
+        if self.config['dedup.enabled']:
+            from hop.dedup import Deduplicator
+            self.dedup = Deduplicator.fromConfig(self.config)
+            if self.dedup is not None:
+                self.dedup.metrics = self.metrics
+        from hop.retry import RetryPolicy
+        self.retryPolicy = RetryPolicy.fromConfig(self.config)
+        self.rateLimits = None
+        if self.config['throttle'] is not None:
+            from hop.throttle import RateLimits
+            self.rateLimits = RateLimits.fromConfig(self.config, self.metrics)
+        from hop.partition import PartitionKeys
+        self.partitionKeys = PartitionKeys.fromConfig(self.config)
 
     ######### Internals ################
 
@@ -81,13 +191,32 @@ class Context(object):
         logger.info("Registering %s %s -> %s", kind, rule, callback)
         if rule not in self.rules[kind]:
             self.rules[kind][rule] = [callback]
+            self.orders[kind][rule] = [order]
         else:
-            # TODO Implement order
             self.rules[kind][rule].append(callback)
+            self.orders[kind][rule].append(order)
+        self.plans = dict()
 
     def _containsRule(self, rule, kind):
         return rule in self.rules[kind]
 
+    def _plan(self, messageType):
+        plan = self.plans.get(messageType)
+        if plan is None:
+            plan = self._compile(messageType)
+            self.plans[messageType] = plan
+        return plan
+
+    def _compile(self, messageType):
+        filters = self.rules['filter'].get(messageType, [])
+        orders = self.orders['filter'].get(messageType, [])
+        # Filters with an order run first, lowest order first. The rest run in registration order
+        ordered = sorted(range(len(filters)), key=lambda index: (orders[index] is None, orders[index], index))
+        handlers = tuple(self.rules['handler'].get(messageType, []))
+        return DispatchPlan(tuple(filters[index] for index in ordered), handlers,
+                            frozenset(callback for callback in handlers if callback in self.isolated),
+                            tuple(self.joins.get(messageType, ())))
+
     def _checkForStop(self):
         if self._getTerminated():
             return True
@@ -97,68 +226,241 @@ class Context(object):
         return False
 
     def _process(self, msg):
+        """Processes the message. Returns False when a callback failed and the message should be delivered again"""
+        tracer = self.tracer
+        if tracer is None:
+            # Current, so the messages it publishes are linked to it
+            token = activate(msg)
+            try:
+                return self._dispatch(msg)
+            finally:
+                deactivate(token)
+        state = tracer.start(msg)
+        try:
+            return self._dispatch(msg)
+        finally:
+            tracer.finish(state)
+
+    def _dispatch(self, msg):
         self._incrementRequestCount()
-        if self._checkForStop(): return
-        if msg is not None:
-            if (type(msg) == dict or type(msg) == Message) and 'messageType' in msg:
-                msg = self._filterMsg(msg)
-                if msg is not None:
-                    if self._containsRule(msg['messageType'], 'handler'):
-                        # TODO Error handling
-                        self._invokeRule(msg['messageType'], 'handler', msg)
-
-    def _filterMsg(self, msg):
-        filters = self.rules['filter']
-        if msg['messageType'] in filters:
-            filterCallbacks = filters[msg['messageType']]
-            for callback in filterCallbacks:
-                if self._getTerminated(): return None
-                # TODO Error handling
-                msg = callback(msg)
-                if msg is None:
-                    break
+        if self._checkForStop(): return True
+        if not isinstance(msg, dict) or 'messageType' not in msg:
+            return True
+        dedup = self.dedup
+        if dedup is not None and dedup.seen(msg):
+            logger.debug('Skipping duplicate message %s', msg['messageType'])
+            return True
+        if self.rateLimits is not None:
+            self.rateLimits.wait('messageType', msg['messageType'])
+        received = msg
+        if self.metrics is not None:
+            self.metrics.message(msg['messageType'])
+        plan = self._plan(msg['messageType'])
+        if plan.filters:
+            messageType = msg['messageType']
+            try:
+                msg = self._filterMsg(msg, plan)
+            except:
+                logger.exception('Exception filtering message %s', messageType)
+                # The whole message is retried
+                return self._failed(None, received, sys.exc_info()[1])
+            if msg is None:
+                if dedup is not None:
+                    self._markSeen(received)
+                return True
+            if msg['messageType'] != messageType:
+                plan = self._plan(msg['messageType'])
+        if plan.joins:
+            self._collect(plan, msg)
+        handled = True
+        if plan.handlers:
+            handled = self._invokeRule(plan, msg)
+        if dedup is not None and handled:
+            self._markSeen(received)
+        return handled
+
+    def _filterMsg(self, msg, plan=None):
+        for callback in (plan or self._plan(msg['messageType'])).filters:
+            if self._getTerminated(): return None
+            messageType = msg['messageType']
+            msg = callback(msg)
+            if msg is None:
+                if self.metrics is not None:
+                    self.metrics.filterDrop(messageType, callback.__name__)
+                break
         return msg
 
-    def _invokeRule(self, rule, kind, msg):
-        if self._getTerminated(): return
+    def _markSeen(self, msg):
+        """Records the message as processed, so its deliveries again are skipped"""
+        self.dedup.markSeen(msg)
 
-        callbacks = self.rules[kind][rule]
-        if callbacks is None or len(callbacks) == 0:
-            return
+    def _invokeRule(self, plan, msg):
+        """Calls the handlers, returns False if one of them failed for good and the message should be delivered again"""
+        if self._getTerminated(): return True
 
-        callbacks = self._callbacksForMessage(callbacks, msg)
+        callbacks = self._callbacksForMessage(plan, msg)
+        if len(callbacks) == 0:
+            return True
 
-        callback = callbacks[0]
+        local, queued = self._fanoutCallbacks(plan, callbacks[1:])
+        if queued:
+            newMsgs = [self._callbackWrappedMessage(msg, callback) for callback in queued]
+            logger.debug('Publishing parallel messages: %s', newMsgs)
+            self.publishBatch(newMsgs, 'priority')
+
+        # Siblings run in-process get the same copy of the message they would get through the queue
+        siblings = [(callback, self._callbackWrappedMessage(msg, callback)) for callback in local]
+        if siblings and self.fanout == 'pool':
+            futures = [self._fanoutPool().submit(self._invokeSibling, callback, newMsg) for callback, newMsg in siblings]
+            results = [self._invokeCallback(callbacks[0], msg)] + [future.result() for future in futures]
+        else:
+            results = [self._invokeCallback(callbacks[0], msg)]
+            for callback, newMsg in siblings:
+                results.append(self._invokeSibling(callback, newMsg))
+        return all(results)
+
+    def _collect(self, plan, msg):
+        """Adds the message to its group of every join on the type, calling the joins whose groups are big enough"""
+        for rule, group in self._completeGroups(plan, msg):
+            self._invokeCallback(rule.callback, group)
+
+    def _completeGroups(self, plan, msg):
+        """Adds the message to its group of every join on the type, yielding (rule, group) of the big enough ones"""
+        from hop.join import MessageGroup
+        store = self._getJoinStore()
+        for rule in plan.joins:
+            key = rule.key(msg)
+            if key is None:
+                logger.debug('Message %s has no %s to join on', msg['messageType'], rule.condition)
+                continue
+            msgs = store.add(rule, key, msg)
+            if len(msgs) >= rule.minimumCount:
+                yield rule, MessageGroup(rule, key, msgs)
+
+    def _invokeSibling(self, callback, msg):
+        """Calls a sibling handler with its copy of the message, traced as the copy would be through the queue"""
+        tracer = self.tracer
+        if tracer is None:
+            return self._invokeCallback(callback, msg)
+        state = tracer.start(msg)
+        try:
+            return self._invokeCallback(callback, msg)
+        finally:
+            tracer.finish(state)
+
+    def _invokeCallback(self, callback, msg):
+        """Calls the callback, returns False if it failed and the message could not be retried"""
+        # Fan-out siblings can run on pool threads, which do not share the current message
+        token = activate(msg)
+        try:
+            return self._invokeMeasured(callback, msg)
+        finally:
+            deactivate(token)
+
+    def _invokeMeasured(self, callback, msg):
+        metrics = self.metrics
+        if metrics is None:
+            try:
+                callback(msg)
+            except:
+                logger.exception('Exception calling callback %s', callback)
+                return self._failed(callback, msg, sys.exc_info()[1])
+            return True
+        start = timer()
         try:
             callback(msg)
         except:
+            metrics.callback(_messageTypeOf(msg), callback.__name__, timer() - start, True)
             logger.exception('Exception calling callback %s', callback)
-        
-        for callback in callbacks[1:]:
-            newMsg = self._callbackWrappedMessage(msg, callback)
-            logger.debug('Publishing parallel message: %s', newMsg)
-            self.publish(newMsg, 'priority')
-
-    def _callbacksForMessage(self, callbacks, msg):
-        if 'flow' in msg['_system'] and 'currentState' in msg['_system']['flow'] and 'callback' in msg['_system']['flow']['currentState']:
-            for callback in callbacks:
-                if callback.func_name == msg['_system']['flow']['currentState']['callback']:
-                    return [callback]
-            return []
+            return self._failed(callback, msg, sys.exc_info()[1])
+        metrics.callback(_messageTypeOf(msg), callback.__name__, timer() - start)
+        return True
+
+    def _failed(self, callback, msg, error):
+        """
+        The callback (or a filter, callback None) raised processing the message. Publishes a copy for the callback
+        to try again, or to the dead-letter queue once retry.maxAttempts failed. Returns False when neither was
+        possible and the message should be delivered again by its source
+        """
+        if not isinstance(msg, dict) or 'messageType' not in msg:
+            # Groups of messages passed to join callbacks are not retried
+            return True
+        policy = self.retryPolicy
+        attempts = policy.attempts(msg)
+        copy = self._callbackWrappedMessage(msg, callback) if callback is not None else self._copyMessage(msg)
+        if attempts < policy.maxAttempts:
+            logger.info('Retrying %s of %s, attempt %s of %s', callback.__name__ if callback is not None else 'filters',
+                        msg['messageType'], attempts + 1, policy.maxAttempts)
+            if self.metrics is not None:
+                self.metrics.retried(msg['messageType'])
+            self.publish(policy.retry(copy, attempts), policy.queue)
+            return True
+        if self._deadLetter(policy.deadLetter(copy, attempts, callback, error)):
+            logger.error('Sent %s to the dead-letter queue after %s attempts', msg['messageType'], attempts)
+            if self.metrics is not None:
+                self.metrics.deadLettered(msg['messageType'])
+            return True
+        return False
+
+    def _deadLetter(self, msg):
+        """Publishes the message to retry.deadLetterQueue, returns False if there is none"""
+        if self.retryPolicy.deadLetterQueue is None:
+            return False
+        self.publish(msg, self.retryPolicy.deadLetterQueue)
+        return True
+
+    def _copyMessage(self, msg):
+        copy = msg.clone() if isinstance(msg, Message) else Message(msg['messageType'], msg)
+        system = msg.get('_system')
+        if system is not None:
+            copyLineage(system, copy['_system'])
+        return copy
+
+    def _stamp(self, msg):
+        """Called by publish: links the message to the message being processed, and to its trace when tracing"""
+        if self.tracer is not None:
+            self.tracer.stamp(msg)
         else:
-            return callbacks
+            link(msg)
+
+    def _fanoutCallbacks(self, plan, callbacks):
+        """Splits the sibling handlers into the ones run in this process and the ones sent through the queue"""
+        if self.fanout == 'queue' or len(callbacks) == 0:
+            return (), callbacks
+        local = [callback for callback in callbacks if callback not in plan.isolated]
+        queued = [callback for callback in callbacks if callback in plan.isolated]
+        return local, queued
+
+    def _fanoutPool(self):
+        if self.fanoutExecutor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.fanoutExecutor = ThreadPoolExecutor(max_workers=self.config['dispatch.fanoutWorkers'] or 4)
+        return self.fanoutExecutor
+
+    def _callbacksForMessage(self, plan, msg):
+        system = msg.get('_system')
+        flow = system.get('flow') if system is not None else None
+        if flow is not None and 'currentState' in flow and 'callback' in flow['currentState']:
+            callback = plan.handlersByName.get(flow['currentState']['callback'])
+            return [callback] if callback is not None else []
+        else:
+            return plan.handlers
 
     def _callbackWrappedMessage(self, msg, callback):
         """
         Creates a message with the flow state which will match the corresponding callback
         """
-        callbackMsg = msg.clone()
+        callbackMsg = msg.clone() if isinstance(msg, Message) else Message(msg['messageType'], msg)
+        system = msg.get('_system')
+        if system is not None:
+            # The copy stands for the message, its published messages are linked to the message
+            copyLineage(system, callbackMsg['_system'])
         if 'flow' in callbackMsg['_system']:
             flow = callbackMsg['_system']['flow']
         else:
             flow = {}
         flow['currentState'] = {
-            'callback': callback.func_name
+            'callback': callback.__name__
         }
         callbackMsg['_system']['flow'] = flow
         return callbackMsg
@@ -174,10 +476,25 @@ class Context(object):
     def _incrementRequestCount(self):
         raise NotImplemented("_incrementRequestCount is not implemented by default")
 
+    def _getJoinStore(self):
+        if self.joinStore is None:
+            from hop.join import MemoryJoinStore
+            self.joinStore = MemoryJoinStore(self.config['join.maxMessages'], self.config['join.maxBytes'])
+        return self.joinStore
+
     ######### Wrappers #############
 
-    def handle(self, rule):
+    def handle(self, rule, isolated=False, rateLimit=None, burst=None):
+        """
+        Marks a handler of the messageType. An isolated handler is always sent its copy of a message
+        through the queue, even when dispatch.fanout runs the other handlers in-process.
+        With rateLimit, at most that many messages of the type per second are dispatched, see hop.throttle
+        """
         def caller(f):
+            if isolated:
+                self.isolated.add(f)
+            if rateLimit is not None:
+                self.limit('messageType', rule, rateLimit, burst)
             self._register(rule, 'handler', f)
             return f
         return caller
@@ -189,7 +506,13 @@ class Context(object):
         return caller
 
     def join(self, condition, message=None, discard=None, minimumCount=1):
+        """
+        Marks a callback receiving the messages of the type grouped by the condition field, once at least
+        minimumCount of them arrived. Groups are discarded after the discard window (such as '5s') or forget()
+        """
         def caller(f):
+            from hop.join import JoinRule
+            self.joins.setdefault(message, []).append(JoinRule(f, message, condition, discard, minimumCount))
             self._register(message, 'join', f, condition=condition)
             return f
         return caller
@@ -210,9 +533,66 @@ class Context(object):
     def stop(self):
         pass
 
+    def deduplicate(self, key=None, maxSize=None, ttl=None, bloom=None, backend=None):
+        """
+        Skips messages which have already been processed, by their _system.messageID
+        or by the value key(msg) returns (None processes the message). See hop.dedup
+        """
+        from hop.dedup import Deduplicator
+        self.dedup = Deduplicator(key, maxSize, ttl, bloom, backend)
+        self.dedup.metrics = self.metrics
+        return self.dedup
+
+    def trace(self, sampleRate=None, collector=None):
+        """
+        Stamps published messages with their trace and parent, and records spans of the sampled ones
+        (all of them by default) in the collector, a LocalCollector unless given. See hop.tracing
+        """
+        from hop.tracing import Tracer
+        self.tracer = Tracer(sampleRate, collector)
+        return self.tracer
+
+    def limit(self, kind, name, rate, burst=None):
+        """Limits the messages of a messageType (kind messageType) or published to a queue (kind queue) per second"""
+        if self.rateLimits is None:
+            from hop.throttle import RateLimits
+            self.rateLimits = RateLimits(self.metrics)
+        self.rateLimits.limit(kind, name, rate, burst)
+
+    def partitionBy(self, messageType, field=None, key=None, correlation=False, salts=None):
+        """
+        Partition key of the published messages of the type: the value of a field, key(msg), or with correlation
+        a hash of the parentMessageID (correlation=True) or of another _system field, such as 'traceID'.
+        Messages sharing the key are received in order, see hop.partition
+        """
+        self.partitionKeys.register(messageType, field, key, correlation, salts)
+
+    def retry(self, maxAttempts=None, delay=None, maxDelay=None, queue=None, deadLetterQueue=None):
+        """
+        Publishes a copy of a message again for a handler which raised, up to maxAttempts attempts with
+        exponential backoff, then to the deadLetterQueue. See hop.retry
+        """
+        from hop.retry import RetryPolicy
+        self.retryPolicy = RetryPolicy(maxAttempts, delay, maxDelay, queue, deadLetterQueue)
+        return self.retryPolicy
+
+    def stats(self):
+        """Snapshot of the counters and latencies recorded so far, see hop.metrics"""
+        return self.metrics.snapshot() if self.metrics is not None else dict()
+
     def forget(self, msgs):
+        """Discards the group of messages passed to a join callback"""
+        if getattr(msgs, 'rule', None) is not None:
+            self._getJoinStore().forget(msgs.rule, msgs.key)
+
+    def flush(self):
+        """Sends any messages buffered by publish. No-op for contexts which publish immediately"""
         pass
 
+    def publishBatch(self, msgs, queue=None):
+        for msg in msgs:
+            self.publish(msg, queue)
+
     def publish(self, msg, queue=None):
         if self.terminated:
             return
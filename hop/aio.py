@@ -0,0 +1,252 @@
+import sys
+import asyncio
+import threading
+from timeit import default_timer as timer
+
+from hop import _messageTypeOf
+from hop.local import LocalContext
+from hop.retry import RetryPolicy
+from hop.tracing import wrapCurrent, activate, deactivate
+import logging
+logger = logging.getLogger("hopper.aio")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Local context running handlers on an asyncio event loop (Python 3 only)
+"""
+
+class AsyncLocalContext(LocalContext):
+    """
+    LocalContext which processes up to maxInFlight messages concurrently on an asyncio event loop.
+
+    Handlers and filters declared with `async def` are awaited on the loop. Plain functions are run
+    in the executor (the loop's default thread pool unless one is given), so blocking I/O in them
+    still overlaps with other messages. publish can be called from both kinds of callbacks;
+    publishAsync is the awaitable form, and the one which waits for the rate limit of a queue on the loop.
+    A retried message waits on the loop until it is due, taking one of the maxInFlight slots meanwhile.
+    """
+    def __init__(self, config=None, maxInFlight=None, executor=None):
+        LocalContext.__init__(self, config)
+        self.maxInFlight = maxInFlight or self.config['local.maxInFlight'] or 100
+        self.executor = executor
+        self._loop = None
+        self._loopThread = None
+        self._published = None
+        # Publishing on the loop thread cannot wait for room, so it queues over the capacity.
+        # Sync callbacks on executor threads wait until the loop takes a message from the full level
+        self.queues.block = None
+        self._room = threading.Condition()
+
+    def run(self):
+        asyncio.run(self.runAsync())
+
+    async def runAsync(self):
+        self._loop = asyncio.get_running_loop()
+        self._loopThread = threading.current_thread()
+        self._published = asyncio.Event()
+        inFlight = set()
+        taken = dict()
+        waiter = None
+        try:
+            while True:
+                while not self.terminated and len(inFlight) < self.maxInFlight:
+                    msg = self.queues.pop()
+                    if msg is None:
+                        break
+                    if self.queues.bounded:
+                        with self._room:
+                            self._room.notify_all()
+                    task = asyncio.ensure_future(self._processAsync(msg))
+                    taken[task] = msg
+                    inFlight.add(task)
+                if len(inFlight) == 0:
+                    break
+                if waiter is None and len(inFlight) < self.maxInFlight:
+                    # There is room for more, so a message published meanwhile starts without waiting
+                    # for a message in flight to complete
+                    self._published.clear()
+                    waiter = asyncio.ensure_future(self._published.wait())
+                done, pending = await asyncio.wait(inFlight | set([waiter]) if waiter is not None else inFlight,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if waiter in done:
+                    done.discard(waiter)
+                    waiter = None
+                inFlight = pending - set([waiter])
+                for task in done:
+                    msg = taken.pop(task)
+                    if task.exception() is not None:
+                        logger.error("Unable to process message", exc_info=task.exception())
+                    else:
+                        self.queues.done(msg)
+        finally:
+            if waiter is not None:
+                waiter.cancel()
+            self._loop = None
+            self._loopThread = None
+            self._published = None
+
+    async def _processAsync(self, msg):
+        wait = RetryPolicy.wait(msg)
+        if wait:
+            await asyncio.sleep(wait)
+        tracer = self.tracer
+        if tracer is None:
+            token = activate(msg)
+            try:
+                return await self._dispatchAsync(msg)
+            finally:
+                deactivate(token)
+        state = tracer.start(msg)
+        try:
+            return await self._dispatchAsync(msg)
+        finally:
+            tracer.finish(state)
+
+    async def _dispatchAsync(self, msg):
+        self._incrementRequestCount()
+        if self._checkForStop(): return True
+        if not isinstance(msg, dict) or 'messageType' not in msg:
+            return True
+        dedup = self.dedup
+        if dedup is not None and dedup.seen(msg):
+            return True
+        if self.rateLimits is not None:
+            delay = self.rateLimits.reserve('messageType', msg['messageType'])
+            if delay:
+                await asyncio.sleep(delay)
+        received = msg
+        if self.metrics is not None:
+            self.metrics.message(msg['messageType'])
+        plan = self._plan(msg['messageType'])
+        if plan.filters:
+            messageType = msg['messageType']
+            try:
+                msg = await self._filterMsgAsync(msg, plan)
+            except:
+                logger.exception('Exception filtering message %s', messageType)
+                return self._failed(None, received, sys.exc_info()[1])
+            if msg is None:
+                if dedup is not None:
+                    self._markSeen(received)
+                return True
+            if msg['messageType'] != messageType:
+                plan = self._plan(msg['messageType'])
+        if plan.joins:
+            await self._collectAsync(plan, msg)
+        handled = True
+        if plan.handlers:
+            handled = await self._invokeRuleAsync(plan, msg)
+        if dedup is not None and handled:
+            self._markSeen(received)
+        return handled
+
+    async def _filterMsgAsync(self, msg, plan):
+        for callback in plan.filters:
+            if self._getTerminated(): return None
+            messageType = msg['messageType']
+            msg = await self._call(callback, msg)
+            if msg is None:
+                if self.metrics is not None:
+                    self.metrics.filterDrop(messageType, callback.__name__)
+                break
+        return msg
+
+    async def _collectAsync(self, plan, msg):
+        for rule, group in self._completeGroups(plan, msg):
+            await self._invokeCallbackAsync(rule.callback, group)
+
+    async def _invokeRuleAsync(self, plan, msg):
+        if self._getTerminated(): return True
+
+        callbacks = self._callbacksForMessage(plan, msg)
+        if len(callbacks) == 0:
+            return True
+
+        local, queued = self._fanoutCallbacks(plan, callbacks[1:])
+        if queued:
+            newMsgs = [self._callbackWrappedMessage(msg, callback) for callback in queued]
+            logger.debug('Publishing parallel messages: %s', newMsgs)
+            self.publishBatch(newMsgs, 'priority')
+
+        # In-process siblings are awaited together with the first handler
+        results = await asyncio.gather(self._invokeCallbackAsync(callbacks[0], msg),
+                                       *[self._invokeSiblingAsync(callback, self._callbackWrappedMessage(msg, callback)) for callback in local])
+        return all(results)
+
+    async def _invokeSiblingAsync(self, callback, msg):
+        tracer = self.tracer
+        if tracer is None:
+            return await self._invokeCallbackAsync(callback, msg)
+        state = tracer.start(msg)
+        try:
+            return await self._invokeCallbackAsync(callback, msg)
+        finally:
+            tracer.finish(state)
+
+    async def _invokeCallbackAsync(self, callback, msg):
+        # Siblings run as tasks of their own, each with its copy of the message current
+        token = activate(msg)
+        try:
+            return await self._invokeMeasuredAsync(callback, msg)
+        finally:
+            deactivate(token)
+
+    async def _invokeMeasuredAsync(self, callback, msg):
+        start = timer()
+        try:
+            await self._call(callback, msg)
+        except:
+            if self.metrics is not None:
+                self.metrics.callback(_messageTypeOf(msg), callback.__name__, timer() - start, True)
+            logger.exception('Exception calling callback %s', callback)
+            return self._failed(callback, msg, sys.exc_info()[1])
+        if self.metrics is not None:
+            self.metrics.callback(_messageTypeOf(msg), callback.__name__, timer() - start)
+        return True
+
+    async def _call(self, callback, msg):
+        if asyncio.iscoroutinefunction(callback):
+            return await callback(msg)
+        # So that publish calls made by the callback see the message as their parent
+        return await self._loop.run_in_executor(self.executor, wrapCurrent(callback), msg)
+
+    def publish(self, msg, queueName=None):
+        loop = self._loop
+        if loop is not None and threading.current_thread() is not self._loopThread:
+            # Called by a sync callback on an executor thread. Queued before the callback completes,
+            # so the run loop sees the message before it sees the callback finish
+            if self.terminated:
+                return
+            if self.rateLimits is not None:
+                self.rateLimits.wait('queue', queueName or 'default')
+            self._stamp(msg)
+            if self.queues.bounded and self.queues.overflow == 'block':
+                priority = self._priority(msg, queueName)
+                with self._room:
+                    while self._loop is not None and not self.terminated and self.queues.full(priority):
+                        self._room.wait(0.1)
+            loop.call_soon_threadsafe(self._publishOnLoop, msg, queueName)
+        elif loop is None:
+            LocalContext.publish(self, msg, queueName)
+        else:
+            # Sleeping here would stop the loop, so the rate limit of the queue is only counted
+            if self.rateLimits is not None and not self.terminated:
+                self.rateLimits.reserve('queue', queueName or 'default')
+            self._publishOnLoop(msg, queueName)
+
+    def _publishOnLoop(self, msg, queueName):
+        if self.terminated:
+            return
+        self._enqueue(msg, queueName)
+        if self._published is not None:
+            self._published.set()
+
+    async def publishAsync(self, msg, queueName=None):
+        if self._loop is not None and self.rateLimits is not None and not self.terminated:
+            delay = self.rateLimits.reserve('queue', queueName or 'default')
+            if delay:
+                await asyncio.sleep(delay)
+            self._publishOnLoop(msg, queueName)
+        else:
+            self.publish(msg, queueName)
@@ -0,0 +1,122 @@
+import threading
+
+import logging
+logger = logging.getLogger("hopper.aws")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+AWS clients of LambdaContext, kept for the life of the container.
+
+boto3 is imported, and a client created, when it is first used, so a cold start pays only for the clients
+the invocation needs, and the contexts created later in the container (and warm invocations) reuse them.
+DynamoDB tables are used through the low-level client (Table) instead of a boto3 resource, whose model
+takes as long to load again as the client itself. The region comes from aws.region, or the environment:
+
+    aws:
+        region: ap-southeast-2
+"""
+
+_clients = dict()
+_lock = threading.Lock()
+
+
+def client(service, region=None):
+    """The client of the service, created on the first call and shared afterwards"""
+    key = (service, region)
+    cached = _clients.get(key)
+    if cached is None:
+        with _lock:
+            cached = _clients.get(key)
+            if cached is None:
+                import boto3
+                logger.debug("Creating %s client", service)
+                cached = _clients[key] = boto3.client(service, region_name=region) if region else boto3.client(service)
+    return cached
+
+
+def clientError(error):
+    """
+    The Error of the response when the exception is a botocore ClientError, None for any other exception.
+    botocore is imported once an exception is handled, importing the modules which catch it does not load it
+    """
+    try:
+        from botocore.exceptions import ClientError
+    except ImportError:
+        return None
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {})
+    return None
+
+
+class LazyClient(object):
+    """Stands for the client of the service until its first call, which creates it"""
+    def __init__(self, service, region=None):
+        self.service = service
+        self.region = region
+
+    def __getattr__(self, name):
+        return getattr(client(self.service, self.region), name)
+
+
+class Table(object):
+    """
+    The part of the boto3 Table resource used by hopper (get_item, put_item, update_item, delete_item,
+    meta.client and name) on the low-level client: keys and values are plain Python values, as with the resource
+    """
+    def __init__(self, name, region=None, client=None):
+        self.name = name
+        self.region = region
+        self._client = client
+        self._serializer = None
+        self._deserializer = None
+        self.meta = self
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = client('dynamodb', self.region)
+        return self._client
+
+    def get_item(self, Key, **kwargs):
+        response = self.client.get_item(TableName=self.name, Key=self._serialize(Key), **kwargs)
+        if 'Item' in response:
+            response['Item'] = self._deserialize(response['Item'])
+        return response
+
+    def put_item(self, Item, ExpressionAttributeValues=None, **kwargs):
+        if ExpressionAttributeValues is not None:
+            kwargs['ExpressionAttributeValues'] = self._serialize(ExpressionAttributeValues)
+        return self._attributes(self.client.put_item(TableName=self.name, Item=self._serialize(Item), **kwargs))
+
+    def update_item(self, Key, ExpressionAttributeValues=None, AttributeUpdates=None, **kwargs):
+        if ExpressionAttributeValues is not None:
+            kwargs['ExpressionAttributeValues'] = self._serialize(ExpressionAttributeValues)
+        if AttributeUpdates is not None:
+            kwargs['AttributeUpdates'] = dict((name, dict(update, Value=self._serializeValue(update['Value']))
+                                                     if 'Value' in update else update)
+                                              for name, update in AttributeUpdates.items())
+        return self._attributes(self.client.update_item(TableName=self.name, Key=self._serialize(Key), **kwargs))
+
+    def delete_item(self, Key, **kwargs):
+        return self._attributes(self.client.delete_item(TableName=self.name, Key=self._serialize(Key), **kwargs))
+
+    def _attributes(self, response):
+        if 'Attributes' in response:
+            response['Attributes'] = self._deserialize(response['Attributes'])
+        return response
+
+    def _serialize(self, values):
+        return dict((name, self._serializeValue(value)) for name, value in values.items())
+
+    def _serializeValue(self, value):
+        if self._serializer is None:
+            from boto3.dynamodb.types import TypeSerializer
+            self._serializer = TypeSerializer()
+        return self._serializer.serialize(value)
+
+    def _deserialize(self, values):
+        if self._deserializer is None:
+            from boto3.dynamodb.types import TypeDeserializer
+            self._deserializer = TypeDeserializer()
+        return dict((name, self._deserializer.deserialize(value)) for name, value in values.items())
@@ -0,0 +1,64 @@
+__author__ = 'Denis Mikhalkin'
+
+"""
+Queue backends of LambdaContext.
+
+Every queue of config.yaml names its backend with type. publish hands the encoded message to the backend of
+the queue, which buffers it and sends it in batches, and lambda_handler reads the records of an event through
+the backend matching their eventSource:
+
+    queues:
+        default:
+            type: kinesis
+            stream: HopperQueue
+        bursty:
+            type: sqs
+            url: https://sqs.ap-southeast-2.amazonaws.com/1234567890/HopperBursty   # or name: HopperBursty
+"""
+
+class QueueBackend(object):
+    """
+    Sends the messages of the queues of one type and reads the records of the events they deliver.
+    Subclasses set eventSource, the eventSource of their Lambda event records, and buffer, a PublishBuffer
+    """
+    eventSource = None
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def destination(self, config, queue):
+        """Name of the stream or queue the messages of the queue are sent to"""
+        raise NotImplementedError("destination is not implemented by default")
+
+    def send(self, destination, data, partitionKey, delay=0, deduplicationID=None):
+        """
+        Buffers the data, delivered after delay seconds where the queue supports it. Queues which
+        deduplicate (SQS FIFO) drop a message sent again with the same deduplicationID
+        """
+        self.buffer.add(destination, data, partitionKey, delay, deduplicationID)
+
+    def flush(self):
+        """Sends the buffered messages, returns the ones which could not be delivered"""
+        return self.buffer.flush()
+
+    def pending(self):
+        return self.buffer.pending()
+
+    def payload(self, record):
+        """Encoded message carried by a record of a Lambda event"""
+        raise NotImplementedError("payload is not implemented by default")
+
+    def recordID(self, record):
+        """Identifier of the record in the batchItemFailures of the Lambda response"""
+        raise NotImplementedError("recordID is not implemented by default")
+
+    def partitionKey(self, record):
+        """Records sharing the key are processed in order"""
+        raise NotImplementedError("partitionKey is not implemented by default")
+
+    def ordered(self, record):
+        """
+        True when the queue delivers the records of the partition key in order, so the ones after a failed record
+        are delivered again with it
+        """
+        return True
@@ -0,0 +1,194 @@
+import os
+import json
+import glob
+import uuid
+
+from hop import Message
+import logging
+logger = logging.getLogger("hopper.blobstore")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Claim-check offloading of large message fields.
+
+When a message is published, text fields longer than claimCheck.threshold characters are stored in a
+blob store and replaced by a reference in _system.blobs. The consumer receives a BlobMessage which loads
+a field from the store only when a handler reads it.
+
+Every published message holding a reference owns a marker object next to the blob, named after its
+messageID. The consumer removes its marker once it has processed the message, and the blob is deleted
+when no markers are left. A message republished by a handler takes its own marker before the consumer
+releases the original one, so the blob stays until the last consumer is done.
+
+    claimCheck:
+        threshold: 65536
+        store: s3            # or local
+        bucket: hopper-blobs
+        prefix: claims/
+        # directory: /tmp/hopper-blobs (local store)
+"""
+
+try:
+    _textTypes = (basestring,)
+except NameError:
+    _textTypes = (str,)
+
+
+class BlobStore(object):
+    def put(self, data):
+        """Stores the bytes and returns the key of the new blob"""
+        raise NotImplementedError("put is not implemented by default")
+
+    def get(self, key):
+        raise NotImplementedError("get is not implemented by default")
+
+    def retain(self, key, owner):
+        raise NotImplementedError("retain is not implemented by default")
+
+    def release(self, key, owner):
+        """Removes the marker of the owner, deleting the blob when it was the last one"""
+        raise NotImplementedError("release is not implemented by default")
+
+    @staticmethod
+    def fromConfig(config):
+        if config['claimCheck.store'] == 'local':
+            return LocalBlobStore(config['claimCheck.directory'])
+        if config['claimCheck.store'] == 's3' or config['claimCheck.bucket'] is not None:
+            return S3BlobStore(config['claimCheck.bucket'], config['claimCheck.prefix'])
+        return None
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(os.getcwd(), 'blobs')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def put(self, data):
+        key = uuid.uuid4().hex
+        with open(os.path.join(self.directory, key), 'wb') as stream:
+            stream.write(data)
+        return key
+
+    def get(self, key):
+        with open(os.path.join(self.directory, key), 'rb') as stream:
+            return stream.read()
+
+    def retain(self, key, owner):
+        open(self._marker(key, owner), 'wb').close()
+
+    def release(self, key, owner):
+        try:
+            os.remove(self._marker(key, owner))
+        except OSError:
+            pass
+        if len(glob.glob(self._marker(key, '*'))) == 0:
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+    def _marker(self, key, owner):
+        return os.path.join(self.directory, '%s.ref.%s' % (key, owner))
+
+
+class S3BlobStore(BlobStore):
+    def __init__(self, bucket, prefix=None, client=None):
+        self.bucket = bucket
+        self.prefix = prefix or ''
+        if client is None:
+            from hop.aws import LazyClient
+            client = LazyClient('s3')
+        self.client = client
+
+    def put(self, data):
+        key = self.prefix + uuid.uuid4().hex
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        return key
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def retain(self, key, owner):
+        self.client.put_object(Bucket=self.bucket, Key='%s.ref.%s' % (key, owner), Body=b'')
+
+    def release(self, key, owner):
+        self.client.delete_object(Bucket=self.bucket, Key='%s.ref.%s' % (key, owner))
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix='%s.ref.' % key, MaxKeys=1)
+        if response.get('KeyCount', 0) == 0:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class BlobMessage(Message):
+    """Message whose offloaded fields are loaded from the blob store on first access"""
+    __slots__ = ('blobStore',)
+
+    def __missing__(self, key):
+        blobs = self._blobs()
+        if key not in blobs:
+            raise KeyError(key)
+        value = json.loads(self.blobStore.get(blobs[key]).decode('utf-8'))
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._blobs()
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def clone(self):
+        msg = Message.clone(self)
+        msg.blobStore = self.blobStore
+        msg['_system']['blobs'] = dict(self._blobs())
+        return msg
+
+    def _blobs(self):
+        system = dict.get(self, '_system')
+        return (system.get('blobs') or {}) if system is not None else {}
+
+
+class ClaimCheck(object):
+    def __init__(self, store, threshold=None):
+        self.store = store
+        self.threshold = threshold or 64 * 1024
+        self.offloaded = 0
+
+    def offload(self, msg):
+        """Returns the message to send: large fields moved to the store, every blob reference retained for it"""
+        system = msg.get('_system')
+        blobs = dict(system.get('blobs') or {}) if system is not None else {}
+        large = [field for field, value in msg.items()
+                 if field not in blobs and field not in ('_system', 'messageType') and isinstance(value, _textTypes) and len(value) > self.threshold]
+        if not large and not blobs:
+            return msg
+
+        sent = dict((field, value) for field, value in msg.items() if field not in blobs)
+        for field in large:
+            blobs[field] = self.store.put(json.dumps(sent.pop(field)).encode('utf-8'))
+            self.offloaded += 1
+        header = dict(system) if system is not None else dict()
+        header['blobs'] = blobs
+        sent['_system'] = header
+        owner = header.setdefault('messageID', uuid.uuid4().hex)
+        for key in blobs.values():
+            self.store.retain(key, owner)
+        return sent
+
+    def restore(self, msg):
+        """Wraps a received message holding blob references into a BlobMessage"""
+        system = msg.get('_system')
+        if system is None or not system.get('blobs'):
+            return msg
+        restored = dict.__new__(BlobMessage)
+        dict.update(restored, msg)
+        restored.blobStore = self.store
+        return restored
+
+    def release(self, msg):
+        system = msg.get('_system')
+        if system is None or not system.get('blobs'):
+            return
+        for key in system['blobs'].values():
+            self.store.release(key, system['messageID'])
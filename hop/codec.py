@@ -0,0 +1,94 @@
+import json
+import struct
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Wire format of messages sent through a queue.
+
+An encoded record starts with two bytes: the format version and a tag holding the serialization format
+(low 4 bits) and the compression (high 4 bits). Records without the header are plain JSON, as written
+by earlier versions, so they still decode. The codec of a queue is configured in config.yaml:
+
+    queues:
+        default:
+            codec: msgpack        # json (default) or msgpack
+            compression: zlib     # zlib or lz4, optional
+            compressAbove: 1024   # bytes, payloads smaller than this are not compressed
+"""
+
+VERSION = 1
+
+def _json():
+    return (lambda msg: json.dumps(msg, separators=(',', ':')).encode('utf-8'),
+            lambda payload: json.loads(payload.decode('utf-8')))
+
+def _msgpack():
+    import msgpack
+    return (lambda msg: msgpack.packb(msg, use_bin_type=True),
+            lambda payload: msgpack.unpackb(payload, raw=False))
+
+def _zlib():
+    import zlib
+    return zlib.compress, zlib.decompress
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+# name -> (tag, loader of the (encode, decode) pair). Optional libraries are imported on first use
+FORMATS = {'json': (1, _json), 'msgpack': (2, _msgpack)}
+COMPRESSIONS = {'zlib': (1, _zlib), 'lz4': (2, _lz4)}
+
+_loaded = dict()
+
+def _functions(registry, name):
+    key = (id(registry), name)
+    if key not in _loaded:
+        if name not in registry:
+            raise ValueError('Unknown codec %s' % name)
+        _loaded[key] = registry[name][1]()
+    return _loaded[key]
+
+def _byTag(registry, tag):
+    for name, (registryTag, loader) in registry.items():
+        if registryTag == tag:
+            return _functions(registry, name)
+    raise ValueError('Unknown codec tag %s' % tag)
+
+
+class Codec(object):
+    def __init__(self, format=None, compression=None, compressAbove=None):
+        self.format = format or 'json'
+        self.compression = compression
+        self.compressAbove = compressAbove or 0
+        self.dumps = _functions(FORMATS, self.format)[0]
+        self.formatTag = FORMATS[self.format][0]
+        if compression is not None:
+            self.compress = _functions(COMPRESSIONS, compression)[0]
+            self.compressionTag = COMPRESSIONS[compression][0]
+
+    def encode(self, msg):
+        payload = self.dumps(msg)
+        tag = self.formatTag
+        if self.compression is not None and len(payload) >= self.compressAbove:
+            payload = self.compress(payload)
+            tag |= self.compressionTag << 4
+        return struct.pack('BB', VERSION, tag) + payload
+
+    @staticmethod
+    def forQueue(config, queue):
+        return Codec(config['queues.%s.codec' % queue],
+                     config['queues.%s.compression' % queue],
+                     config['queues.%s.compressAbove' % queue])
+
+
+def decode(data):
+    """Decodes a record written by any codec, or a plain JSON record"""
+    if struct.unpack('B', data[0:1])[0] != VERSION:
+        return _functions(FORMATS, 'json')[1](data)
+    tag = struct.unpack('B', data[1:2])[0]
+    payload = data[2:]
+    if tag >> 4:
+        payload = _byTag(COMPRESSIONS, tag >> 4)[1](payload)
+    return _byTag(FORMATS, tag & 0x0f)[1](payload)
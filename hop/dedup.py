@@ -0,0 +1,210 @@
+import time
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+from hop.join import parseDuration
+import logging
+logger = logging.getLogger("hopper.dedup")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Skipping of messages which have already been processed.
+
+Kinesis delivers records at least once and a failed batch is delivered again, so the same message can reach
+the handlers more than once. When deduplication is enabled, Context._process looks the key of every message
+(its _system.messageID, or the result of a key function) up before the filters run, and records the key once
+the message has been processed. Keys are kept in a bounded cache, optionally in front of a Bloom filter and a
+persistent backend shared by all Lambda invocations. With metrics enabled, the hits and misses per messageType
+are in context.stats() and the exported metrics (dedupHits, dedupMisses):
+
+    dedup:
+        enabled: True
+        maxSize: 10000          # keys kept in memory
+        ttl: 10m                # how long a key is remembered
+        # bloomCapacity: 1000000
+        # bloomErrorRate: 0.001
+        # table: HopperDedup    # DynamoDB table (partition key Object, TTL attribute ExpiresAt)
+"""
+
+try:
+    _textTypes = (unicode,)
+except NameError:
+    _textTypes = (str,)
+
+def _bytes(key):
+    if isinstance(key, bytes):
+        return key
+    if isinstance(key, _textTypes):
+        return key.encode('utf-8')
+    return repr(key).encode('utf-8')
+
+
+def messageID(msg):
+    system = msg.get('_system')
+    return system.get('messageID') if system is not None else None
+
+
+class SeenCache(object):
+    """Keys seen in the last ttl seconds, at most maxSize of them, the least recently seen evicted first"""
+    def __init__(self, maxSize=10000, ttl=600):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.keys = OrderedDict()
+        self.evicted = 0
+
+    def __contains__(self, key):
+        expires = self.keys.pop(key, None)
+        if expires is None:
+            return False
+        if expires <= time.time():
+            return False
+        self.keys[key] = expires
+        return True
+
+    def add(self, key):
+        now = time.time()
+        self.keys.pop(key, None)
+        self.keys[key] = now + self.ttl
+        while self.keys:
+            first = next(iter(self.keys))
+            if len(self.keys) <= self.maxSize and self.keys[first] > now:
+                break
+            del self.keys[first]
+            self.evicted += 1
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class BloomFilter(object):
+    """
+    Bloom filter sized for capacity keys at the given false positive rate. It is cleared once capacity keys
+    have been added, so the false positive rate stays bounded
+    """
+    def __init__(self, capacity=1000000, errorRate=0.001):
+        import math
+        self.capacity = capacity
+        self.size = int(math.ceil(-capacity * math.log(errorRate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        first, second = struct.unpack('<QQ', hashlib.md5(_bytes(key)).digest())
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        if self.count >= self.capacity:
+            self.bits = bytearray(len(self.bits))
+            self.count = 0
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class DynamoDBSeenStore(object):
+    """Seen keys kept as items of a DynamoDB table, removed by its TTL process (attribute ExpiresAt)"""
+    def __init__(self, table, ttl=600):
+        self.table = table
+        self.ttl = ttl
+
+    def __contains__(self, key):
+        item = self.table.get_item(Key=self._key(key)).get('Item')
+        return item is not None and item.get('ExpiresAt', 0) > time.time()
+
+    def add(self, key):
+        self.table.update_item(Key=self._key(key), UpdateExpression='set ExpiresAt = :expires',
+                               ExpressionAttributeValues={':expires': int(time.time() + self.ttl)})
+
+    def _key(self, key):
+        return {'Object': 'dedup#%s' % key}
+
+
+class Deduplicator(object):
+    """
+    Decides whether a message is a duplicate. The cache is checked first. A key missing from the Bloom filter
+    is new, without asking the backend. Without a backend, a key found in the Bloom filter counts as seen,
+    so about bloomErrorRate of the new messages which left the cache are dropped
+    """
+    def __init__(self, key=None, maxSize=None, ttl=None, bloom=None, backend=None):
+        self.key = key or messageID
+        self.cache = SeenCache(maxSize or 10000, parseDuration(ttl) or 600)
+        self.bloom = bloom
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.backendReads = 0
+        # Set by the context, which counts the hits and misses per messageType
+        self.metrics = None
+
+    def seen(self, msg):
+        key = self.key(msg)
+        if key is None:
+            return False
+        found = self._seen(key)
+        if self.metrics is not None:
+            self.metrics.deduplicated(msg.get('messageType'), found)
+        return found
+
+    def _seen(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                return True
+            if self.bloom is not None and key not in self.bloom:
+                self.misses += 1
+                return False
+        if self.backend is not None:
+            self.backendReads += 1
+            found = key in self.backend
+        else:
+            found = self.bloom is not None
+        with self.lock:
+            if found:
+                self.cache.add(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def markSeen(self, msg):
+        key = self.key(msg)
+        if key is None:
+            return
+        with self.lock:
+            self.cache.add(key)
+            if self.bloom is not None:
+                self.bloom.add(key)
+        if self.backend is not None:
+            self.backend.add(key)
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hitRate': self.hitRate(),
+                'backendReads': self.backendReads, 'cached': len(self.cache), 'evicted': self.cache.evicted}
+
+    @staticmethod
+    def fromConfig(config, table=None):
+        """Deduplicator configured by the dedup section, None unless dedup.enabled is set"""
+        if not config['dedup.enabled']:
+            return None
+        ttl = parseDuration(config['dedup.ttl']) or 600
+        bloom = None
+        if config['dedup.bloomCapacity']:
+            bloom = BloomFilter(config['dedup.bloomCapacity'], config['dedup.bloomErrorRate'] or 0.001)
+        backend = DynamoDBSeenStore(table, ttl) if table is not None else None
+        return Deduplicator(maxSize=config['dedup.maxSize'], ttl=ttl, bloom=bloom, backend=backend)
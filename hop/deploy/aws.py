@@ -9,7 +9,8 @@ def _updateTrigger(cfg, enabled=False):
         awslambda.update_event_source_mapping(
             UUID=triggerID, 
             FunctionName=cfg.get('function_name'),
-            Enabled=enabled)
+            Enabled=enabled,
+            FunctionResponseTypes=['ReportBatchItemFailures'])
 
 def _createTrigger(cfg):
     triggerID = _getTriggerID(cfg)
@@ -20,7 +21,9 @@ def _createTrigger(cfg):
             FunctionName=cfg.get('function_name'),
             Enabled=False,
             BatchSize=100,
-            StartingPosition='LATEST'            
+            StartingPosition='LATEST',
+            # lambda_handler reports the records to deliver again as batchItemFailures
+            FunctionResponseTypes=['ReportBatchItemFailures']
         )
 
 def _getTriggerID(cfg):
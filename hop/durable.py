@@ -0,0 +1,360 @@
+import os
+import mmap
+import zlib
+import heapq
+import struct
+import pickle
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger("hopper.durable")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Queues of LocalContext kept on disk, so a run which crashed or was stopped resumes where it stopped.
+
+Every priority level is an append-only log in its own directory, split into segment files named after
+the sequence number of their first message. A segment is preallocated and memory-mapped: publish copies
+the pickled message into the map and pop reads it from there, so neither goes through a system call.
+Consumer offsets are checkpointed (written to a temporary file, fsynced and renamed) every checkpointEvery
+processed messages, and segments which have been consumed entirely are deleted at the checkpoint.
+The maps are flushed to disk every syncEvery messages published (0 leaves it to the operating system).
+
+Delivery is at least once: messages processed after the last checkpoint are processed again after a restart.
+
+    local:
+        durable:
+            directory: /var/lib/hopper/queues
+            segmentSize: 16777216
+            syncEvery: 1000
+            checkpointEvery: 1000
+"""
+
+# Length and CRC32 of the pickled message. A zero length marks the end of the records of a segment
+_RECORD = struct.Struct('<II')
+# Base sequence number of the segment, position in the segment and sequence number of the next message
+_OFFSET = struct.Struct('<QQQ')
+_SUFFIX = '.log'
+
+
+class Segment(object):
+    """Records of one segment file, the file is mapped into memory as a whole"""
+    def __init__(self, path, base, size=None):
+        self.path = path
+        self.base = base
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        # Known for the segment being written, see scan
+        self.end = self.count = 0
+
+    def scan(self, position=0, count=0):
+        """Finds the end of the records following the count records before the position. A torn record ends the segment"""
+        while True:
+            record = self.read(position)
+            if record is None:
+                break
+            position = record[1]
+            count += 1
+        self.end, self.count = position, count
+
+    def read(self, position):
+        """The record at the position and the position of the next one, None at the end of the segment"""
+        if position + _RECORD.size > self.size:
+            return None
+        length, crc = _RECORD.unpack_from(self.map, position)
+        start = position + _RECORD.size
+        if length == 0 or start + length > self.size:
+            return None
+        data = self.map[start:start + length]
+        if zlib.crc32(data) & 0xffffffff != crc:
+            logger.warning('Corrupt record at %s of %s, ignoring the rest of the segment', position, self.path)
+            return None
+        return data, start + length
+
+    def append(self, data):
+        """Writes the record, returns False if the segment has no room for it"""
+        start = self.end + _RECORD.size
+        if start + len(data) > self.size:
+            return False
+        self.map[start:start + len(data)] = data
+        # The header goes last, so a record is not visible until it is complete
+        _RECORD.pack_into(self.map, self.end, len(data), zlib.crc32(data) & 0xffffffff)
+        self.end = start + len(data)
+        self.count += 1
+        return True
+
+    def grow(self, size):
+        """Makes an empty segment bigger, for a record which does not fit"""
+        self.map.close()
+        self.file.truncate(size)
+        self.size = size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def sync(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SegmentLog(object):
+    """
+    Log of one priority level. Messages are numbered by a sequence number, which keeps growing across segments.
+    Popped messages are pending until done is called for them; the checkpoint holds the offset of the
+    oldest message not done yet, so messages still being processed are read again after a restart
+    """
+    def __init__(self, directory, segmentSize=None, syncEvery=None, checkpointEvery=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segmentSize = segmentSize or 16 * 1024 * 1024
+        self.syncEvery = syncEvery if syncEvery is not None else 1000
+        self.checkpointEvery = checkpointEvery or 1000
+        self.unsynced = 0
+        self.completed = 0
+        self.pending = OrderedDict()
+        self.segments = []
+        bases = sorted(int(name[:-len(_SUFFIX)], 16) for name in os.listdir(directory) if name.endswith(_SUFFIX))
+        for base in bases:
+            self.segments.append(Segment(self._path(base), base))
+        if not self.segments:
+            self.segments.append(Segment(self._path(0), 0, self.segmentSize))
+        for segment, following in zip(self.segments, self.segments[1:]):
+            segment.count = following.base - segment.base
+        self.writer = self.segments[-1]
+        self.committed = self._readCheckpoint()
+        self.reader, self.position, self.sequence = self.committed
+        # Only the records of the last segment which have not been consumed are scanned
+        if self.reader is self.writer:
+            self.writer.scan(self.position, self.sequence - self.writer.base)
+        else:
+            self.writer.scan()
+        logger.debug('Opened %s at message %s of %s', directory, self.sequence, self.written())
+
+    def _path(self, base):
+        return os.path.join(self.directory, '%016x%s' % (base, _SUFFIX))
+
+    def _checkpointPath(self):
+        return os.path.join(self.directory, 'offset')
+
+    def _readCheckpoint(self):
+        first = self.segments[0]
+        try:
+            with open(self._checkpointPath(), 'rb') as stream:
+                base, position, sequence = _OFFSET.unpack(stream.read(_OFFSET.size))
+        except (IOError, OSError, struct.error):
+            return first, 0, first.base
+        for segment in self.segments:
+            if segment.base == base:
+                return segment, position, sequence
+        logger.warning('Segment %x of the checkpoint is missing from %s, reading from the start', base, self.directory)
+        return first, 0, first.base
+
+    def written(self):
+        return self.writer.base + self.writer.count
+
+    def __len__(self):
+        return self.written() - self.sequence
+
+    def append(self, data):
+        if not self.writer.append(data):
+            size = max(self.segmentSize, len(data) + 2 * _RECORD.size)
+            if self.writer.count == 0:
+                self.writer.grow(size)
+            else:
+                self.writer.sync()
+                base = self.written()
+                self.writer = Segment(self._path(base), base, size)
+                self.segments.append(self.writer)
+            self.writer.append(data)
+        if self.syncEvery:
+            self.unsynced += 1
+            if self.unsynced >= self.syncEvery:
+                self.sync()
+
+    def read(self):
+        """The next message as (data, sequence number), None when the log has been read to the end"""
+        while True:
+            record = self.reader.read(self.position)
+            if record is not None:
+                break
+            if self.reader is self.writer:
+                return None
+            self.reader = self.segments[self.segments.index(self.reader) + 1]
+            self.position = 0
+            self.sequence = self.reader.base
+        data, self.position = record
+        sequence = self.sequence
+        self.sequence += 1
+        self.pending[sequence] = [self.reader, self.position, sequence + 1, False]
+        return data, sequence
+
+    def done(self, sequence):
+        entry = self.pending.get(sequence)
+        if entry is None:
+            return
+        entry[3] = True
+        while self.pending:
+            first = next(iter(self.pending.values()))
+            if not first[3]:
+                break
+            self.committed = tuple(first[:3])
+            self.pending.popitem(last=False)
+        self.completed += 1
+        if self.completed >= self.checkpointEvery:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Persists the offset of the oldest message which is not done, and deletes the segments before it"""
+        self.completed = 0
+        segment, position, sequence = self.committed
+        path = self._checkpointPath()
+        with open(path + '.tmp', 'wb') as stream:
+            stream.write(_OFFSET.pack(segment.base, position, sequence))
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(path + '.tmp', path)
+        self._compact(segment)
+
+    def _compact(self, segment):
+        while self.segments[0] is not segment:
+            consumed = self.segments.pop(0)
+            consumed.close()
+            os.remove(consumed.path)
+            logger.debug('Removed consumed segment %s', consumed.path)
+
+    def sync(self):
+        self.unsynced = 0
+        self.writer.sync()
+
+    def close(self):
+        self.sync()
+        self.checkpoint()
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+class DurableQueues(object):
+    """
+    Priority queues of LocalContext (see PriorityQueues) where every level is a SegmentLog under directory.
+    The levels found in directory are opened with the queues, so their messages are popped again.
+    The context calls done once it has processed a popped message. The queues are not bounded: the disk holds them
+    """
+    def __init__(self, directory, segmentSize=None, syncEvery=None, checkpointEvery=None):
+        self.directory = directory
+        self.options = (segmentSize, syncEvery, checkpointEvery)
+        self.levels = dict()
+        self.active = []
+        self.activeLevels = set()
+        self.taken = dict()
+        self.size = 0
+        # Attributes of the bounded PriorityQueues, which LocalContext reads
+        self.bounded = False
+        self.overflow = 'block'
+        self.block = None
+        self.congested = set()
+        self.onHigh = []
+        self.onLow = []
+        self.dropped = 0
+        self.spilled = 0
+        self._open()
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.directory):
+            if os.path.isdir(os.path.join(self.directory, name)):
+                self._level(_priority(name))
+        if self.size:
+            logger.info('Resuming %s queued messages from %s', self.size, self.directory)
+
+    def _level(self, priority):
+        log = self.levels.get(priority)
+        if log is None:
+            log = self.levels[priority] = SegmentLog(os.path.join(self.directory, str(priority)), *self.options)
+            if len(log):
+                self.size += len(log)
+                self._activate(priority)
+        return log
+
+    def _activate(self, priority):
+        if priority not in self.activeLevels:
+            self.activeLevels.add(priority)
+            heapq.heappush(self.active, priority)
+
+    def push(self, priority, msg):
+        self._level(priority).append(pickle.dumps(msg, 2))
+        self._activate(priority)
+        self.size += 1
+        return True
+
+    def pop(self):
+        """Returns the oldest message of the lowest non-empty level, or None if all queues are empty"""
+        while self.active:
+            msg = self.popFrom(self.active[0])
+            if msg is not None:
+                return msg
+            self.activeLevels.discard(heapq.heappop(self.active))
+        return None
+
+    def popFrom(self, priority):
+        log = self.levels.get(priority)
+        record = log.read() if log is not None else None
+        if record is None:
+            return None
+        msg = pickle.loads(record[0])
+        self.taken[id(msg)] = (log, record[1])
+        self.size -= 1
+        return msg
+
+    def done(self, msg):
+        taken = self.taken.pop(id(msg), None)
+        if taken is not None:
+            taken[0].done(taken[1])
+
+    def checkpoint(self):
+        for log in self.levels.values():
+            log.sync()
+            log.checkpoint()
+
+    def depth(self, priority):
+        log = self.levels.get(priority)
+        return len(log) if log is not None else 0
+
+    def depths(self):
+        return dict((str(priority), len(log)) for priority, log in self.levels.items())
+
+    def full(self, priority):
+        return False
+
+    def close(self):
+        """Checkpoints and closes the logs. Messages popped but not done yet are popped again once they are reopened"""
+        for log in self.levels.values():
+            log.close()
+        self.levels = dict()
+        self.active = []
+        self.activeLevels = set()
+        self.taken = dict()
+        self.size = 0
+
+    def reopen(self):
+        self.close()
+        self._open()
+
+    def __len__(self):
+        return self.size
+
+
+def _priority(name):
+    """Priority level of a directory name, the levels are usually numbers"""
+    try:
+        return int(name)
+    except ValueError:
+        return name
@@ -0,0 +1,150 @@
+import time
+import random
+import threading
+
+from hop.aws import clientError
+import logging
+logger = logging.getLogger("hopper.dynamodb")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Runtime state of the hopper, kept in the DynamoDB HopperRuntime table
+"""
+
+class RuntimeState(object):
+    """
+    Leased copy of the RuntimeState item.
+
+    The item is read once and then served from memory until the lease (ttl seconds) expires,
+    so the stop and autoStop checks made for every message do not go to DynamoDB.
+    savedReads counts the get_item calls avoided this way.
+
+    With a sharded request counter the counter shard items are read in the same round trip
+    and their sum is reported as the RequestCounter of the item.
+    """
+    KEY = {'Object': 'RuntimeState'}
+
+    def __init__(self, table, ttl=None, shards=None):
+        self.table = table
+        self.ttl = ttl if ttl is not None else 5
+        self.shards = shards or 0
+        self.item = None
+        self.expires = 0
+        self.reads = 0
+        self.savedReads = 0
+
+    def get(self):
+        if self.item is None or time.time() >= self.expires:
+            self.refresh()
+        else:
+            self.savedReads += 1
+        return self.item
+
+    def refresh(self):
+        self.reads += 1
+        try:
+            if self.shards:
+                self.item = self._readShards()
+            else:
+                response = self.table.get_item(Key=RuntimeState.KEY)
+                self.item = response['Item'] if 'Item' in response else dict()
+        except Exception as e:
+            error = clientError(e)
+            if error is None:
+                raise
+            logger.error("Unable to read runtime state: %s", error.get('Message'))
+            if self.item is None:
+                self.item = dict()
+        self.expires = time.time() + self.ttl
+
+    def _readShards(self):
+        from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+        serializer, deserializer = TypeSerializer(), TypeDeserializer()
+        keys = [RuntimeState.KEY] + [counterShardKey(shard) for shard in range(self.shards)]
+        response = self.table.meta.client.batch_get_item(RequestItems={
+            self.table.name: {'Keys': [dict((name, serializer.serialize(value)) for name, value in key.items()) for key in keys]}
+        })
+        if response.get('UnprocessedKeys'):
+            logger.warning("Runtime state read did not return all counter shards")
+        item = dict()
+        requestCount = 0
+        for rawItem in response['Responses'].get(self.table.name, []):
+            loaded = dict((name, deserializer.deserialize(value)) for name, value in rawItem.items())
+            if loaded['Object'] == RuntimeState.KEY['Object']:
+                item.update(loaded)
+            requestCount += loaded.get('RequestCounter', 0)
+        item['RequestCounter'] = requestCount
+        return item
+
+    def set(self, name, value):
+        """Updates the cached item after a write made by this container"""
+        if self.item is not None:
+            self.item[name] = value
+
+    def add(self, name, value):
+        if self.item is not None:
+            self.item[name] = self.item.get(name, 0) + value
+
+    def isTerminated(self):
+        return bool(self.get().get('Terminated', False))
+
+    def getRequestCount(self):
+        return self.get().get('RequestCounter', 0)
+
+
+def counterShardKey(shard):
+    return {'Object': '%s#%d' % (RuntimeState.KEY['Object'], shard)}
+
+
+class RequestCounter(object):
+    """
+    Counts the requests processed by this container without an update_item per message.
+
+    By default increments are accumulated and written as one ADD by flush(), which the context
+    calls once per batch. With blockSize the counter instead reserves blocks of requests up front
+    with a single ADD and consumes them locally, so runtime.autoStopLimit is enforced (to within a
+    block per container) while the batch is still running. With shards the ADDs are spread over
+    that many counter items instead of the single RuntimeState item.
+    """
+    def __init__(self, table, state, blockSize=None, shards=None):
+        self.table = table
+        self.state = state
+        self.blockSize = blockSize or 0
+        self.shards = shards or 0
+        self.pending = 0
+        self.reserved = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def increment(self):
+        with self.lock:
+            if self.blockSize:
+                if self.reserved == 0:
+                    self._add(self.blockSize)
+                    self.reserved = self.blockSize
+                self.reserved -= 1
+            else:
+                self.pending += 1
+
+    def getRequestCount(self):
+        # Requests reserved by this container but not yet used are not counted as processed
+        return self.state.getRequestCount() + self.pending - self.reserved
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                pending, self.pending = self.pending, 0
+                self._add(pending)
+
+    def _add(self, value):
+        key = counterShardKey(random.randrange(self.shards)) if self.shards else RuntimeState.KEY
+        self.table.update_item(
+            Key=key,
+            AttributeUpdates={
+                'RequestCounter': {'Action': 'ADD',
+                'Value': value}
+            }
+        )
+        self.writes += 1
+        self.state.add('RequestCounter', value)
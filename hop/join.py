@@ -0,0 +1,196 @@
+import re
+import json
+import math
+import time
+import threading
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger("hopper.join")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Correlation of messages for @context.join.
+
+Messages of the joined type are grouped by the value of the condition field (looked up in the message,
+then in its _system part). Once a group holds minimumCount messages, the join callback receives the group
+with every new message, until the callback calls context.forget(msgs) or the group is older than the
+discard window.
+"""
+
+_DURATION = re.compile(r'^\s*([0-9.]+)\s*(ms|s|m|h)?\s*$')
+_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, None: 1}
+
+def parseDuration(value):
+    """Seconds in a duration such as '500ms', '5s', '2m' or a plain number of seconds"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    match = _DURATION.match(value)
+    if match is None:
+        raise ValueError('Invalid duration %s' % value)
+    return float(match.group(1)) * _UNITS[match.group(2)]
+
+
+class JoinRule(object):
+    __slots__ = ('callback', 'message', 'condition', 'discard', 'minimumCount', 'id')
+
+    def __init__(self, callback, message, condition, discard=None, minimumCount=1):
+        self.callback = callback
+        self.message = message
+        self.condition = condition
+        self.discard = parseDuration(discard)
+        self.minimumCount = minimumCount or 1
+        self.id = '%s.%s' % (message, callback.__name__)
+
+    def key(self, msg):
+        if self.condition in msg:
+            return msg[self.condition]
+        system = msg.get('_system')
+        if system is not None and self.condition in system:
+            return system[self.condition]
+        return None
+
+
+class MessageGroup(list):
+    """
+    Messages collected by a join. Indexing with a field name returns the value of the field
+    in the latest message which has it
+    """
+    def __init__(self, rule, key, msgs):
+        list.__init__(self, msgs)
+        self.rule = rule
+        self.key = key
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, slice)):
+            return list.__getitem__(self, index)
+        for msg in reversed(self):
+            if index in msg:
+                return msg[index]
+        raise KeyError(index)
+
+    def __contains__(self, item):
+        if isinstance(item, dict):
+            return list.__contains__(self, item)
+        return any(item in msg for msg in self)
+
+    def checkFieldsInMessages(self, *fields):
+        return all(field in self for field in fields)
+
+
+def estimateSize(msg):
+    size = 0
+    for value in msg.values():
+        size += len(value) if hasattr(value, '__len__') else 8
+    return size + 32 * len(msg)
+
+
+class JoinStore(object):
+    def add(self, rule, key, msg):
+        """Adds the message to the group of the key and returns the messages of the group"""
+        raise NotImplementedError("add is not implemented by default")
+
+    def forget(self, rule, key):
+        raise NotImplementedError("forget is not implemented by default")
+
+
+class MemoryJoinStore(JoinStore):
+    """
+    Groups kept in memory, in creation order per rule. Groups older than the discard window of their rule
+    are evicted, and the oldest groups are evicted when the number of messages or their estimated size
+    exceeds the limits
+    """
+    def __init__(self, maxMessages=None, maxBytes=None):
+        self.maxMessages = maxMessages or 100000
+        self.maxBytes = maxBytes or 64 * 1024 * 1024
+        self.groups = dict()
+        self.messages = 0
+        self.bytes = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def add(self, rule, key, msg):
+        now = time.time()
+        size = estimateSize(msg)
+        with self.lock:
+            groups = self.groups.get(rule.id)
+            if groups is None:
+                groups = self.groups[rule.id] = OrderedDict()
+            self._expire(groups, now)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {'created': now, 'expires': now + rule.discard if rule.discard else None,
+                                       'messages': [], 'bytes': 0}
+            group['messages'].append(msg)
+            group['bytes'] += size
+            self.messages += 1
+            self.bytes += size
+            while self.messages > self.maxMessages or self.bytes > self.maxBytes:
+                oldest = min((ruleGroups for ruleGroups in self.groups.values() if ruleGroups),
+                             key=lambda ruleGroups: ruleGroups[next(iter(ruleGroups))]['created'])
+                oldestKey = next(iter(oldest))
+                if oldest is groups and oldestKey == key:
+                    break
+                self._remove(oldest, oldestKey)
+                self.evicted += 1
+            return list(group['messages'])
+
+    def forget(self, rule, key):
+        with self.lock:
+            groups = self.groups.get(rule.id)
+            if groups is not None and key in groups:
+                self._remove(groups, key)
+
+    def _expire(self, groups, now):
+        while groups:
+            key = next(iter(groups))
+            expires = groups[key]['expires']
+            if expires is None or expires > now:
+                break
+            self._remove(groups, key)
+            self.evicted += 1
+
+    def _remove(self, groups, key):
+        group = groups.pop(key)
+        self.messages -= len(group['messages'])
+        self.bytes -= group['bytes']
+
+    def __len__(self):
+        return sum(len(groups) for groups in self.groups.values())
+
+
+class DynamoDBJoinStore(JoinStore):
+    """
+    Groups kept as items of a DynamoDB table (partition key Object), one item per group.
+    The discard window is enforced through the ExpiresAt attribute, which should be the TTL attribute of the table
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def add(self, rule, key, msg):
+        now = int(time.time())
+        expires = now + int(math.ceil(rule.discard)) if rule.discard else 0
+        response = self.table.update_item(
+            Key=self._key(rule, key),
+            UpdateExpression="SET Messages = list_append(if_not_exists(Messages, :empty), :msg), "
+                             "ExpiresAt = if_not_exists(ExpiresAt, :expires)",
+            ExpressionAttributeValues={
+                ':empty': [],
+                ':msg': [json.dumps(msg)],
+                ':expires': expires
+            },
+            ReturnValues='ALL_NEW'
+        )
+        item = response['Attributes']
+        if item['ExpiresAt'] and item['ExpiresAt'] <= now:
+            # Expired but not yet removed by the TTL process, start a new group
+            self.forget(rule, key)
+            return self.add(rule, key, msg)
+        return [json.loads(value) for value in item['Messages']]
+
+    def forget(self, rule, key):
+        self.table.delete_item(Key=self._key(rule, key))
+
+    def _key(self, rule, key):
+        return {'Object': 'join#%s#%s' % (rule.id, key)}
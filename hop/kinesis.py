@@ -1,9 +1,22 @@
+import sys
 import base64
 import json
-import boto3
-import uuid
+import time
+import threading
+from collections import OrderedDict
 
-from hop import Context
+from hop import Context, Message
+from hop.dynamodb import RuntimeState, RequestCounter
+from hop.codec import Codec, decode
+from hop.backend import QueueBackend
+from hop.throttle import AdaptiveBackoff, THROTTLING
+from hop.dedup import DynamoDBSeenStore
+from hop.metrics import EMFExporter
+from hop.tracing import LogCollector
+from hop.blobstore import BlobStore, ClaimCheck
+from hop.retry import RetryPolicy
+from hop.partition import ShardMap
+from hop.aws import LazyClient, Table, clientError
 import logging
 logger = logging.getLogger("hopper.kinesis")
 logger.setLevel(logging.INFO)
@@ -11,66 +24,343 @@ logger.setLevel(logging.INFO)
 __author__ = 'Denis Mikhalkin'
 
 """
-AWS Kinesis source mapped into an AWS Lambda function
+AWS Kinesis source mapped into an AWS Lambda function. Queues of type sqs are handled by hop.sqs
 """
 
+class PublishBuffer(object):
+    """
+    Collects published records per stream and sends them with put_records.
+
+    A stream's batch is sent when it reaches the record or byte limit, when the oldest
+    buffered record is older than maxDelay seconds, or on flush(). Records rejected by
+    a partial failure are retried on their own, with exponential backoff.
+    Records rejected as throttled are retried after the adaptive backoff of the buffer, for up to
+    maxThrottleWait seconds, without using up the retries; the backoff also paces the batches sent
+    after a throttle. Throttles are counted in metrics when the context sets it.
+    With groupByShard, the records of a stream are grouped by the shard of their partition key before they are
+    sent (see hop.partition.ShardMap). A group which does not fit in the rest of a request starts the next one.
+    Only a group larger than a request (maxRecords, maxBytes), or than the shard ingests per second
+    (MAX_SHARD_RECORDS, MAX_SHARD_BYTES, which would be throttled anyway), is split, its rest going in the next request.
+    """
+    MAX_BATCH_RECORDS = 500
+    MAX_BATCH_BYTES = 5 * 1024 * 1024
+    MAX_SHARD_RECORDS = 1000
+    MAX_SHARD_BYTES = 1024 * 1024
+
+    def __init__(self, client, maxRecords=None, maxBytes=None, maxDelay=None, maxRetries=None, retryDelay=None,
+                 maxThrottleWait=None, backoff=None, groupByShard=False, shardMapTTL=None):
+        self.client = client
+        self.maxRecords = min(maxRecords or self.MAX_BATCH_RECORDS, self.MAX_BATCH_RECORDS)
+        self.maxBytes = min(maxBytes or self.MAX_BATCH_BYTES, self.MAX_BATCH_BYTES)
+        self.maxDelay = maxDelay
+        self.maxRetries = maxRetries if maxRetries is not None else 3
+        self.retryDelay = retryDelay if retryDelay is not None else 0.1
+        self.maxThrottleWait = maxThrottleWait if maxThrottleWait is not None else 10
+        self.backoff = backoff or AdaptiveBackoff()
+        self.metrics = None
+        self.groupByShard = groupByShard
+        self.shardMapTTL = shardMapTTL if shardMapTTL is not None else 300
+        self.shardMaps = dict()
+        self.undelivered = []
+        self.records = dict()
+        self.sizes = dict()
+        self.oldest = None
+        self.lock = threading.RLock()
+
+    def add(self, stream, data, partitionKey, delay=0, deduplicationID=None):
+        with self.lock:
+            self._add(stream, data, partitionKey, delay, deduplicationID)
+
+    def _add(self, stream, data, partitionKey, delay=0, deduplicationID=None):
+        record, size = self._record(stream, data, partitionKey, delay, deduplicationID)
+        if stream in self.records and self.sizes[stream] + size > self.maxBytes:
+            self.undelivered.extend(self._flush(stream))
+        if stream not in self.records:
+            self.records[stream] = []
+            self.sizes[stream] = 0
+        self.records[stream].append(record)
+        self.sizes[stream] += size
+        if self.oldest is None:
+            self.oldest = time.time()
+
+        if len(self.records[stream]) >= self.maxRecords:
+            self.undelivered.extend(self._flush(stream))
+        elif self.maxDelay is not None and time.time() - self.oldest >= self.maxDelay:
+            self.undelivered.extend(self._flush())
+
+    def flush(self, stream=None):
+        """
+        Sends the buffered records of the given stream, or of all streams.
+        Returns the records which could not be delivered after all retries, including the ones of the
+        batches sent by add since the last flush
+        """
+        with self.lock:
+            failed = self._flush(stream)
+            failed, self.undelivered = self.undelivered + failed, []
+            return failed
+
+    def _flush(self, stream=None):
+        with self.lock:
+            failed = []
+            for name in ([stream] if stream is not None else list(self.records)):
+                records = self.records.pop(name, None)
+                self.sizes.pop(name, None)
+                if records:
+                    for batch in self._batches(name, records):
+                        failed.extend(self._send(name, batch))
+            if len(self.records) == 0:
+                self.oldest = None
+            return failed
+
+    def pending(self):
+        return sum(len(records) for records in self.records.values())
+
+    def _record(self, stream, data, partitionKey, delay=0, deduplicationID=None):
+        """
+        The entry of the batch request for the data, and its size counted against maxBytes.
+        Kinesis cannot delay a record, a retried message waits when it is received instead,
+        nor deduplicate records
+        """
+        return {'Data': data, 'PartitionKey': partitionKey}, len(data) + len(partitionKey)
+
+    def _batches(self, stream, records):
+        """The requests the records are sent in, grouped by shard with groupByShard"""
+        shardMap = self._shardMap(stream) if self.groupByShard else None
+        if shardMap is None or len(shardMap) <= 1:
+            return [records]
+        groups = OrderedDict()
+        for record in records:
+            groups.setdefault(shardMap.shardFor(record['PartitionKey']), []).append(record)
+        batches = []
+        batch, size = [], 0
+        for group in groups.values():
+            groupSize = sum(len(record['Data']) + len(record['PartitionKey']) for record in group)
+            if batch and (len(batch) + len(group) > self.maxRecords or size + groupSize > self.maxBytes):
+                # The group goes whole in the next request
+                batches.append(batch)
+                batch, size = [], 0
+            shardCount, shardSize = 0, 0
+            for record in group:
+                recordSize = len(record['Data']) + len(record['PartitionKey'])
+                if shardCount >= self.MAX_SHARD_RECORDS or shardSize + recordSize > self.MAX_SHARD_BYTES:
+                    # The rest of the shard goes in the next request
+                    batches.append(batch)
+                    batch, size, shardCount, shardSize = [], 0, 0, 0
+                elif len(batch) >= self.maxRecords or size + recordSize > self.maxBytes:
+                    batches.append(batch)
+                    batch, size = [], 0
+                batch.append(record)
+                size += recordSize
+                shardCount += 1
+                shardSize += recordSize
+        batches.append(batch)
+        return [batch for batch in batches if batch]
+
+    def _shardMap(self, stream):
+        """The shards of the stream, listed again after shardMapTTL seconds as the stream can be resharded"""
+        cached = self.shardMaps.get(stream)
+        if cached is not None and time.time() - cached[1] < self.shardMapTTL:
+            return cached[0]
+        try:
+            shardMap = ShardMap.fromStream(self.client, stream)
+        except Exception as e:
+            if clientError(e) is None:
+                raise
+            logger.warning("Unable to list the shards of %s, records are not grouped by shard", stream, exc_info=True)
+            shardMap = None
+        self.shardMaps[stream] = (shardMap, time.time())
+        return shardMap
+
+    def _send(self, stream, records):
+        attempt = 0
+        waited = 0.0
+        rejected = []
+        while True:
+            waited += self.backoff.wait()
+            failed = self._request(stream, records)
+            if not failed:
+                self.backoff.succeeded()
+                return rejected
+            invalid = [(record, code) for record, code, retryable in failed if not retryable]
+            if invalid:
+                logger.error("%s records rejected by %s: %s", len(invalid), stream, [code for record, code in invalid])
+                rejected.extend(record for record, code in invalid)
+            records = [record for record, code, retryable in failed if retryable]
+            if not records:
+                return rejected
+            throttled = len([record for record, code, retryable in failed if code in THROTTLING])
+            if throttled:
+                self.backoff.throttled()
+                if self.metrics is not None:
+                    self.metrics.throttled('backend', stream, count=throttled)
+                if throttled == len(records) and waited < self.maxThrottleWait:
+                    logger.info("Throttled by %s, sending %s records again in up to %.2fs", stream, throttled, self.backoff.delay)
+                    continue
+            attempt += 1
+            if attempt > self.maxRetries:
+                logger.error("Unable to publish %s records to %s after %s retries", len(records), stream, self.maxRetries)
+                return rejected + records
+            logger.warning("Retrying %s records rejected by %s", len(records), stream)
+            if not throttled:
+                time.sleep(self.retryDelay * (2 ** (attempt - 1)))
+
+    def _request(self, stream, records):
+        """Sends the batch, returns the failed records as (record, error code, whether it can be sent again)"""
+        try:
+            response = self.client.put_records(StreamName=stream, Records=records)
+        except Exception as e:
+            code = (clientError(e) or {}).get('Code')
+            if code in THROTTLING:
+                return [(record, code, True) for record in records]
+            raise
+        if not response.get('FailedRecordCount'):
+            return []
+        return [(record, result['ErrorCode'], True) for record, result in zip(records, response['Records']) if 'ErrorCode' in result]
+
+
+class KinesisBackend(QueueBackend):
+    eventSource = 'aws:kinesis'
+
+    def __init__(self, client, config):
+        QueueBackend.__init__(self, PublishBuffer(client,
+                                                  maxRecords=config['publish.batchSize'],
+                                                  maxBytes=config['publish.maxBatchBytes'],
+                                                  maxDelay=config['publish.maxDelay'],
+                                                  maxRetries=config['publish.maxRetries'],
+                                                  retryDelay=config['publish.retryDelay'],
+                                                  maxThrottleWait=config['publish.maxThrottleWait'],
+                                                  groupByShard=config['publish.groupByShard'],
+                                                  shardMapTTL=config['publish.shardMapTTL']))
+
+    def destination(self, config, queue):
+        return config['queues.%s.stream' % queue]
+
+    def payload(self, record):
+        return base64.b64decode(record['kinesis']['data'])
+
+    def recordID(self, record):
+        return record['kinesis'].get('sequenceNumber')
+
+    def partitionKey(self, record):
+        return record['kinesis'].get('partitionKey')
+
+
+class Undecodable(object):
+    """Payload of a record which could not be decoded"""
+    def __init__(self, payload, error):
+        self.payload = payload
+        self.error = error
+
+    def __repr__(self):
+        return 'Undecodable(%r, %r)' % (self.payload[:100], self.error)
+
+
 class LambdaContext(Context):
-    def __init__(self, config=None):
+    """
+    Context of a Lambda function receiving the messages of its queues. The backend of a queue is chosen
+    by queues.<name>.type: kinesis (the default) or sqs, see hop.backend.
+    The AWS clients are created on first use and shared by the contexts of the container, see hop.aws
+    """
+    def __init__(self, config=None, kinesisClient=None, table=None, blobStore=None, sqsClient=None):
         Context.__init__(self, config)
-        logger.info("Lambda context started")        
-        dynamodb = boto3.resource('dynamodb')
-        self.kinesisClient = boto3.client('kinesis')
-        self.table = dynamodb.Table('HopperRuntime')
+        logger.info("Lambda context started")
+        region = self.config['aws.region']
+        self.kinesisClient = kinesisClient or LazyClient('kinesis', region)
+        self.sqsClient = sqsClient
+        self.table = table or Table(self.config['runtime.table'] or 'HopperRuntime', region)
+        self.backends = {'kinesis': KinesisBackend(self.kinesisClient, self.config)}
+        self.backends['kinesis'].buffer.metrics = self.metrics
+        self.publishBuffer = self.backends['kinesis'].buffer
+        self.queueBackends = dict()
+        self.runtimeState = RuntimeState(self.table, ttl=self.config['runtime.stateTTL'],
+                                         shards=self.config['runtime.counterShards'])
+        self.executor = None
+        # Actions waiting for the messages published by the current invocation to be delivered
+        self.afterDelivery = None
+        self.codecs = dict()
+        blobStore = blobStore or BlobStore.fromConfig(self.config)
+        self.claimCheck = ClaimCheck(blobStore, self.config['claimCheck.threshold']) if blobStore is not None else None
+        if self.dedup is not None and self.config['dedup.table'] is not None:
+            # Seen keys are shared by all invocations, so records retried by Kinesis are skipped too
+            self.dedup.backend = DynamoDBSeenStore(Table(self.config['dedup.table'], region), self.dedup.cache.ttl)
+        if self.tracer is not None and self.config['tracing.collector'] is None:
+            self.tracer.collector = LogCollector()
+        if self.metrics is not None and self.config['metrics.emf']:
+            self.metrics.exporters.append(EMFExporter(self.config['metrics.namespace']))
+        self.requestCounter = RequestCounter(self.table, self.runtimeState,
+                                             blockSize=self.config['runtime.counterBlockSize'],
+                                             shards=self.config['runtime.counterShards'])
 
     def _incrementRequestCount(self):
-        self.table.update_item(
-            Key={
-                'Object': 'RuntimeState',
-            },
-            AttributeUpdates={
-                'RequestCounter': {'Action': 'ADD',
-                'Value': 1}                
-            }
-        )        
+        self.requestCounter.increment()
 
-    def _getRequestCount(self):
-        try:
-            response = self.table.get_item(
-                Key={
-                    'Object': 'RuntimeState',
-                }
-            )
-        except ClientError as e:
-            print(e.response['Error']['Message'])
-            return 0
+    def _markSeen(self, msg):
+        self._whenDelivered(self.dedup.markSeen, msg)
+
+    def _whenDelivered(self, action, msg):
+        """
+        Defers the action on a processed message until the messages it published are delivered,
+        if they are not the message is processed again on its next delivery
+        """
+        if self.afterDelivery is None:
+            action(msg)
         else:
-            item = response['Item'] if 'Item' in response else None
-            return item['RequestCounter'] if item is not None and 'RequestCounter' in item else 0
+            self.afterDelivery.append((action, msg))
+
+    def _getRequestCount(self):
+        return self.requestCounter.getRequestCount()
 
     def _getTerminated(self):
-        try:
-            response = self.table.get_item(
-                Key={
-                    'Object': 'RuntimeState',
-                }
-            )
-        except ClientError as e:
-            print(e.response['Error']['Message'])
-            return 0
-        else:
-            item = response['Item'] if 'Item' in response else None
-            return item['Terminated'] if item is not None and 'Terminated' in item else False
+        return self.runtimeState.isTerminated()
+
+    def _getJoinStore(self):
+        if self.joinStore is None and self.config['join.table'] is not None:
+            from hop.join import DynamoDBJoinStore
+            self.joinStore = DynamoDBJoinStore(Table(self.config['join.table'], self.config['aws.region']))
+        return Context._getJoinStore(self)
 
     def lambda_handler(self, event, context):
-        logger.info("Lambda handler got called with %s%s", type(event), json.dumps(event))
-        if event is not None and 'Records' in event:
-            for record in event['Records']:
-                payload = base64.b64decode(record['kinesis']['data'])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Lambda handler got called with %s%s", type(event), json.dumps(event))
+        else:
+            logger.info("Lambda handler got called with %s records", len(event['Records']) if isinstance(event, dict) and 'Records' in event else 1)
+        # One read of the runtime state per batch, served from the lease afterwards
+        self.runtimeState.refresh()
+        self.afterDelivery = []
+        try:
+            unprocessed = self._handleEvent(event, context)
+        finally:
+            undelivered = self.flush()
+            afterDelivery, self.afterDelivery = self.afterDelivery, None
+            if self.metrics is not None and self.metrics.exporters:
+                # Each invocation reports its own counts
+                self.metrics.export()
+                self.metrics.reset()
+        if undelivered:
+            # Which records published the lost messages is not known, so the whole batch is delivered again
+            logger.error("%s published messages could not be delivered", len(undelivered))
+            if event is None or 'Records' not in event:
+                raise Exception('%s published messages could not be delivered' % len(undelivered))
+            unprocessed = event['Records']
+        else:
+            # Records which failed queue no actions, so all of them belong to processed records
+            for action, msg in afterDelivery:
                 try:
-                    self._process(json.loads(payload))
+                    action(msg)
                 except:
-                    logger.exception("Unable to process message " + str(payload))
-                    pass
+                    logger.exception("Unable to complete the processing of message %s", msg.get('messageType'))
+        if unprocessed:
+            identifiers = [self._recordBackend(record).recordID(record) for record in unprocessed]
+            logger.warning("%s records were not processed and will be delivered again: %s", len(unprocessed), identifiers)
+            return {'batchItemFailures': [{'itemIdentifier': identifier} for identifier in identifiers]}
+
+    def _handleEvent(self, event, lambdaContext=None):
+        """
+        Processes the event, returning the records to be delivered again: the ones which failed without
+        a retry left or a dead-letter queue, and the ones left unprocessed because of the deadline
+        """
+        if event is not None and 'Records' in event:
+            return self._handleRecords(event['Records'], lambdaContext)
         else:
             try:
                 # TODO Convert event into Message object
@@ -82,7 +372,130 @@ class LambdaContext(Context):
                     logger.error("Unexpected type of message: %s" % type(event))
             except:
                 logger.exception("Unable to process message " + str(event))
-                pass            
+                pass
+        return []
+
+    def _handleRecords(self, records, lambdaContext):
+        decoded = []
+        for record in records:
+            payload = self._recordBackend(record).payload(record)
+            try:
+                msg = decode(payload)
+                if self.claimCheck is not None:
+                    msg = self.claimCheck.restore(msg)
+                decoded.append((record, msg))
+            except:
+                logger.exception("Unable to decode message " + str(payload))
+                # Kept in its place, so it fails like a message whose handler raised
+                decoded.append((record, Undecodable(payload, sys.exc_info()[1])))
+
+        concurrency = self.config['lambda.concurrency'] or 1
+        if concurrency <= 1 or len(decoded) <= 1:
+            return self._processRecords(decoded, lambdaContext)
+
+        # Records sharing an ordering key are processed in sequence, different keys in parallel
+        groups = OrderedDict()
+        for record, msg in decoded:
+            groups.setdefault(self._orderingKey(record, msg), []).append((record, msg))
+        if self.executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = [self.executor.submit(self._processRecords, group, lambdaContext) for group in groups.values()]
+        unprocessed = []
+        for future in futures:
+            unprocessed.extend(future.result())
+        positions = dict((id(record), index) for index, record in enumerate(records))
+        return sorted(unprocessed, key=lambda record: positions[id(record)])
+
+    def _processRecords(self, records, lambdaContext):
+        failed = []
+        for index, (record, msg) in enumerate(records):
+            if self._deadlineReached(lambdaContext):
+                return failed + [remaining for remaining, _ in records[index:]]
+            wait = RetryPolicy.wait(msg)
+            if wait:
+                # A retried message is due after the time left, it is left for the next invocation
+                if self._deadlineReached(lambdaContext, wait):
+                    return failed + [remaining for remaining, _ in records[index:]]
+                time.sleep(wait)
+            try:
+                if isinstance(msg, Undecodable):
+                    handled = self._deadLetterPayload(record, msg)
+                else:
+                    handled = self._process(msg)
+            except:
+                logger.exception("Unable to process message " + str(msg))
+                handled = False
+            if not handled:
+                failed.append(record)
+                if self._recordBackend(record).ordered(record):
+                    # The records after it are delivered again too, processing them now would reorder them
+                    return failed + [remaining for remaining, _ in records[index + 1:]]
+                continue
+            if self.claimCheck is not None and not isinstance(msg, Undecodable):
+                # The blob is kept while the record may still be delivered again
+                self._whenDelivered(self.claimCheck.release, msg)
+        return failed
+
+    def _deadLetterPayload(self, record, undecodable):
+        """Sends the payload of a record which could not be decoded to the dead-letter queue as it is"""
+        queue = self.retryPolicy.deadLetterQueue
+        recordID = str(self._recordBackend(record).recordID(record))
+        if queue is None:
+            # Delivered again it would fail the same way until it expires, holding up the records after it
+            logger.error("Dropped record %s which could not be decoded, no dead-letter queue is configured: %r",
+                         recordID, undecodable.payload)
+            return True
+        backend, destination = self._queueBackend(queue)
+        backend.send(destination, undecodable.payload, recordID, deduplicationID=recordID)
+        logger.error("Sent the payload of record %s to the dead-letter queue", recordID)
+        return True
+
+    def _deadLetter(self, msg):
+        if Context._deadLetter(self, msg):
+            return True
+        # Reported as a batch item failure, the record would fail again on every delivery until it expires
+        logger.error("Dropped %s after its last attempt, no dead-letter queue is configured: %s", msg['messageType'], msg)
+        return True
+
+    def _orderingKey(self, record, msg):
+        field = self.config['lambda.orderingField']
+        if field is not None and isinstance(msg, dict) and field in msg:
+            return msg[field]
+        return self._recordBackend(record).partitionKey(record)
+
+    def _backend(self, queueType):
+        backend = self.backends.get(queueType)
+        if backend is None:
+            if queueType != 'sqs':
+                raise ValueError('Unknown queue type %s' % queueType)
+            from hop.sqs import SQSBackend
+            if self.sqsClient is None:
+                self.sqsClient = LazyClient('sqs', self.config['aws.region'])
+            backend = self.backends[queueType] = SQSBackend(self.sqsClient, self.config)
+            backend.buffer.metrics = self.metrics
+        return backend
+
+    def _recordBackend(self, record):
+        """Backend of the queue which delivered a record of a Lambda event"""
+        if record.get('eventSource') == 'aws:sqs':
+            return self._backend('sqs')
+        return self.backends['kinesis']
+
+    def _queueBackend(self, queue):
+        """The backend of the queue and the destination its messages are sent to"""
+        target = self.queueBackends.get(queue)
+        if target is None:
+            backend = self._backend(self.config['queues.%s.type' % queue] or 'kinesis')
+            target = self.queueBackends[queue] = (backend, backend.destination(self.config, queue))
+        return target
+
+    def _deadlineReached(self, lambdaContext, after=0):
+        """True when less than the margin is left, or would be after the given seconds"""
+        if lambdaContext is None or not hasattr(lambdaContext, 'get_remaining_time_in_millis'):
+            return False
+        margin = self.config['lambda.deadlineMargin']
+        return lambdaContext.get_remaining_time_in_millis() - after * 1000 < (margin if margin is not None else 1000)
 
     def stop(self):
         logger.info("Stopping the hopper")
@@ -95,9 +508,31 @@ class LambdaContext(Context):
                 ':r': True,
             }
         )
+        self.runtimeState.set('Terminated', True)
 
     def publish(self, msg, queue=None):
-        self.kinesisClient.put_record(    
-            StreamName=self.config['queues.%s.stream' % (queue or 'default')],
-            Data=json.dumps(msg),
-            PartitionKey=uuid.uuid4().get_hex())
\ No newline at end of file
+        queue = queue or 'default'
+        if self.rateLimits is not None:
+            self.rateLimits.wait('queue', queue)
+        self._stamp(msg)
+        # Before the claim check, which can replace the field of the key
+        partitionKey = self.partitionKeys.key(msg)
+        if self.claimCheck is not None:
+            msg = self.claimCheck.offload(msg)
+        codec = self.codecs.get(queue)
+        if codec is None:
+            codec = Codec.forQueue(self.config, queue)
+            self.codecs[queue] = codec
+        backend, destination = self._queueBackend(queue)
+        system = msg.get('_system')
+        backend.send(destination, codec.encode(msg), partitionKey, RetryPolicy.wait(msg),
+                     system.get('messageID') if system is not None else None)
+
+    def flush(self):
+        """Sends the buffered messages of all queues, returns the ones which could not be delivered"""
+        failed = []
+        for backend in list(self.backends.values()):
+            failed.extend(backend.flush())
+        # After the messages, so an error counting the requests does not lose them
+        self.requestCounter.flush()
+        return failed
@@ -1,25 +1,361 @@
+import os
+import heapq
+import struct
+import pickle
+import time
+import tempfile
+from collections import deque
+from timeit import default_timer as timer
+
 from hop import Context
+from hop.join import estimateSize
+from hop.retry import RetryPolicy
+import logging
+logger = logging.getLogger("hopper.local")
 
 __author__ = 'Denis Mikhalkin'
 
-# http://stackoverflow.com/questions/1857780/sparse-assignment-list-in-python
-class SparseList(list):
-    def __setitem__(self, index, value):
-        missing = index - len(self) + 1
-        if missing > 0:
-            self.extend([None] * missing)
-        list.__setitem__(self, index, value)
-    def __getitem__(self, index):
-        try: return list.__getitem__(self, index)
-        except IndexError: return None
+_LENGTH = struct.Struct('<I')
+
+
+class SpillFile(object):
+    """FIFO of messages pickled to a temporary file, emptied (truncated) once all of them are read back"""
+    def __init__(self, directory=None):
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, self.path = tempfile.mkstemp(prefix='hopper-spill-', dir=directory)
+        self.file = os.fdopen(handle, 'w+b')
+        self.readOffset = 0
+        self.count = 0
+
+    def append(self, msg):
+        data = pickle.dumps(msg, 2)
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(_LENGTH.pack(len(data)) + data)
+        self.count += 1
+
+    def read(self, count):
+        self.file.flush()
+        self.file.seek(self.readOffset)
+        msgs = []
+        while len(msgs) < count and self.count > 0:
+            length = _LENGTH.unpack(self.file.read(_LENGTH.size))[0]
+            msgs.append(pickle.loads(self.file.read(length)))
+            self.count -= 1
+        self.readOffset = self.file.tell()
+        if self.count == 0:
+            self.file.seek(0)
+            self.file.truncate()
+            self.readOffset = 0
+        return msgs
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class PriorityQueues(object):
+    """
+    FIFO queues per priority level, where a lower level is served first.
+    Levels which have messages are kept in a heap, so push and pop are O(log P) in the number of levels.
+    With metrics, the time every message waited in its queue is recorded when it is popped.
+
+    Levels can be bounded by capacity(priority) messages, and all levels together by memoryBudget bytes
+    (estimated from the length of the message fields). A message pushed into a full level is handled
+    by the overflow policy:
+        block       block(priority) is called until there is room, LocalContext processes a message inline
+        dropOldest  the oldest message of the level is dropped
+        dropNewest  the new message is dropped
+        spill       the message is written to a file, and read back as the level drains
+    When a level fills up to highWatermark of its capacity (or the queues to that fraction of the budget)
+    the onHigh callbacks are called, and the onLow callbacks once all of them are back under lowWatermark.
+    """
+    POLICIES = ('block', 'dropOldest', 'dropNewest', 'spill')
+
+    def __init__(self, metrics=None, capacity=None, overflow=None, memoryBudget=None, spillDirectory=None,
+                 highWatermark=None, lowWatermark=None):
+        self.levels = dict()
+        self.active = []
+        self.activeLevels = set()
+        self.size = 0
+        self.metrics = metrics
+        self.pushed = dict()
+        self.capacity = capacity or (lambda priority: None)
+        self.limits = dict()
+        self.overflow = overflow or 'block'
+        if self.overflow not in PriorityQueues.POLICIES:
+            raise ValueError('Unknown overflow policy %s' % self.overflow)
+        self.memoryBudget = memoryBudget
+        self.bytes = 0
+        self.sizes = dict()
+        self.spillDirectory = spillDirectory
+        self.spills = dict()
+        self.highWatermark = highWatermark or 0.8
+        self.lowWatermark = lowWatermark or 0.5
+        self.congested = set()
+        self.onHigh = []
+        self.onLow = []
+        self.block = None
+        self.dropped = 0
+        self.spilled = 0
+        self.bounded = capacity is not None or memoryBudget is not None
+
+    def _level(self, priority):
+        queue = deque()
+        self.levels[priority] = queue
+        self.pushed[priority] = deque()
+        self.sizes[priority] = deque()
+        self.limits[priority] = self.capacity(priority)
+        return queue
+
+    def push(self, priority, msg):
+        """Queues the message, returns False if the overflow policy dropped it"""
+        queue = self.levels.get(priority)
+        if queue is None:
+            queue = self._level(priority)
+        if self.bounded:
+            return self._pushBounded(priority, queue, msg)
+        self._append(priority, queue, msg, 0)
+        return True
+
+    def _append(self, priority, queue, msg, size):
+        if priority not in self.activeLevels:
+            self.activeLevels.add(priority)
+            heapq.heappush(self.active, priority)
+        queue.append(msg)
+        if self.metrics is not None:
+            self.pushed[priority].append(timer())
+        if self.memoryBudget is not None:
+            self.sizes[priority].append(size)
+            self.bytes += size
+        self.size += 1
+
+    def _full(self, priority, queue, size):
+        limit = self.limits[priority]
+        if limit is not None and len(queue) >= limit:
+            return True
+        return self.memoryBudget is not None and self.bytes + size > self.memoryBudget and self.size > 0
+
+    def _pushBounded(self, priority, queue, msg):
+        size = estimateSize(msg) if self.memoryBudget is not None else 0
+        spill = self.spills.get(priority)
+        if spill is not None and len(spill):
+            # Keep the order: once a level spills, new messages go after the spilled ones
+            self._spill(priority, msg)
+        elif self._full(priority, queue, size):
+            policy = self.overflow
+            if policy == 'block':
+                while self._full(priority, queue, size) and self.block is not None and self.block(priority):
+                    pass
+                self._append(priority, queue, msg, size)
+            elif policy == 'dropOldest' and queue:
+                self.dropped += 1
+                self._popFrom(priority, queue)
+                self._append(priority, queue, msg, size)
+            elif policy == 'spill':
+                self._spill(priority, msg)
+            else:
+                self.dropped += 1
+                return False
+        else:
+            self._append(priority, queue, msg, size)
+        self._checkHigh(priority, queue)
+        return True
+
+    def _spill(self, priority, msg):
+        spill = self.spills.get(priority)
+        if spill is None:
+            spill = self.spills[priority] = SpillFile(self.spillDirectory)
+        spill.append(msg)
+        self.spilled += 1
+        self.size += 1
+        if priority not in self.activeLevels:
+            self.activeLevels.add(priority)
+            heapq.heappush(self.active, priority)
+
+    def _refill(self, priority, queue):
+        spill = self.spills[priority]
+        limit = self.limits[priority] or 1000
+        self.size -= len(spill)
+        for msg in spill.read(max(1, limit - len(queue))):
+            self._append(priority, queue, msg, estimateSize(msg) if self.memoryBudget is not None else 0)
+        self.size += len(spill)
+
+    def pop(self):
+        """Returns the oldest message of the lowest non-empty level, or None if all queues are empty"""
+        while self.active:
+            priority = self.active[0]
+            queue = self.levels[priority]
+            spill = self.spills.get(priority)
+            if spill is not None and len(spill) and len(queue) <= (self.limits[priority] or 2) // 2:
+                self._refill(priority, queue)
+            if queue:
+                return self._popFrom(priority, queue)
+            heapq.heappop(self.active)
+            self.activeLevels.discard(priority)
+        return None
+
+    def popFrom(self, priority):
+        """Returns the oldest message of the level, or None if it is empty"""
+        queue = self.levels.get(priority)
+        if queue is None:
+            return None
+        spill = self.spills.get(priority)
+        if not queue and spill is not None and len(spill):
+            self._refill(priority, queue)
+        return self._popFrom(priority, queue) if queue else None
+
+    def _popFrom(self, priority, queue):
+        # An emptied level stays in the heap until pop reaches it
+        msg = queue.popleft()
+        pushed = self.pushed[priority]
+        if pushed:
+            self.metrics.queueWaited(priority, timer() - pushed.popleft())
+        sizes = self.sizes[priority]
+        if sizes:
+            self.bytes -= sizes.popleft()
+        self.size -= 1
+        if self.congested:
+            self._checkLow(priority, queue)
+        return msg
+
+    def _fill(self, priority, queue):
+        limit = self.limits[priority]
+        spill = self.spills.get(priority)
+        return float(len(queue) + (len(spill) if spill is not None else 0)) / limit if limit else 0.0
+
+    def _checkHigh(self, priority, queue):
+        before = len(self.congested)
+        if self._fill(priority, queue) >= self.highWatermark:
+            self.congested.add(priority)
+        if self.memoryBudget is not None and self.bytes >= self.highWatermark * self.memoryBudget:
+            self.congested.add('memory')
+        if before == 0 and self.congested:
+            for callback in self.onHigh:
+                callback()
 
+    def _checkLow(self, priority, queue):
+        if priority in self.congested and self._fill(priority, queue) <= self.lowWatermark:
+            self.congested.discard(priority)
+        if 'memory' in self.congested and self.bytes <= self.lowWatermark * self.memoryBudget:
+            self.congested.discard('memory')
+        if not self.congested:
+            for callback in self.onLow:
+                callback()
+
+    def done(self, msg):
+        """Called once a popped message has been processed, the in-memory queues have nothing to record"""
+        pass
+
+    def depth(self, priority):
+        queue = self.levels.get(priority)
+        spill = self.spills.get(priority)
+        return (len(queue) if queue is not None else 0) + (len(spill) if spill is not None else 0)
+
+    def depths(self):
+        return dict((str(priority), self.depth(priority)) for priority in self.levels)
+
+    def checkpoint(self):
+        """The queues are in memory, there is nothing to keep across a restart"""
+
+    def close(self):
+        for spill in self.spills.values():
+            spill.close()
+        self.spills = dict()
+
+    def __len__(self):
+        return self.size
+
+    def full(self, priority):
+        queue = self.levels.get(priority)
+        if queue is None:
+            return self.memoryBudget is not None and self.bytes > self.memoryBudget
+        spill = self.spills.get(priority)
+        return bool(spill is not None and len(spill)) or self._full(priority, queue, 0)
+
+
+# Nested inline processing by the block policy stops at this depth, the message is queued over the capacity
+MAX_INLINE_DEPTH = 16
+# Messages kept in LocalContext.deadLetters without a dead-letter queue
+DEAD_LETTERS = 1000
 
 class LocalContext(Context):
+    """
+    Context which keeps the queues in memory and processes messages in the calling thread.
+
+    The queues are unbounded unless local.capacity (messages per priority, or local.capacity.<priority>)
+    or local.memoryBudget (bytes) are set, see PriorityQueues for local.overflow and the watermarks.
+    With local.durable.directory, the queues are kept on disk instead and survive a restart, see hop.durable.
+    Retried messages wait until they are due apart from the queues. Messages which failed for good are kept in
+    deadLetters (the latest retry.keepDeadLetters)
+    """
     def __init__(self, config=None):
         Context.__init__(self, config)
-        self.queues = SparseList()
+        self.queues = self._createQueues()
+        self.queues.block = self._makeRoom
+        self._inline = 0
+        if self.metrics is not None:
+            self.metrics.gauge('queueDepth', lambda: self.queues.depths())
+            self.metrics.gauge('queueOverflow', lambda: {'dropped': self.queues.dropped, 'spilled': self.queues.spilled})
+        self.queueIndexes = dict((name, index) for index, name in enumerate(self.config['queues'] or []))
         self.requestCount = 0
         self.terminated = False
+        # Retried messages popped before they are due, a heap of (retryAt, order, message)
+        self.delayed = []
+        self._delayedCount = 0
+        self.deadLetters = deque(maxlen=self.config['retry.keepDeadLetters'] or DEAD_LETTERS)
+
+    def _createQueues(self):
+        config = self.config
+        if config['local.durable.directory']:
+            from hop.durable import DurableQueues
+            return DurableQueues(config['local.durable.directory'], config['local.durable.segmentSize'],
+                                 config['local.durable.syncEvery'], config['local.durable.checkpointEvery'])
+        capacity = None
+        if config['local.capacity'] is not None or any(key.startswith('local.capacity.') for key in config):
+            def capacity(priority):
+                limit = config['local.capacity.%s' % priority]
+                return limit if limit is not None else config['local.capacity']
+        return PriorityQueues(self.metrics, capacity, config['local.overflow'], config['local.memoryBudget'],
+                              config['local.spillDirectory'], config['local.highWatermark'], config['local.lowWatermark'])
+
+    def _makeRoom(self, priority):
+        """Block policy: the producer processes the oldest message of the full level before queueing its own"""
+        if self._inline >= MAX_INLINE_DEPTH or self.terminated:
+            return False
+        msg = self.queues.popFrom(priority)
+        if msg is None:
+            msg = self.queues.pop()
+            if msg is None:
+                return False
+        if RetryPolicy.wait(msg):
+            self._park(msg)
+            return True
+        self._inline += 1
+        try:
+            self._process(msg)
+        finally:
+            self._inline -= 1
+        self.queues.done(msg)
+        return True
+
+    def onHighWatermark(self, callback):
+        """Registers a callback called when the queues fill up to local.highWatermark"""
+        self.queues.onHigh.append(callback)
+        return callback
+
+    def onLowWatermark(self, callback):
+        """Registers a callback called when the queues drain back to local.lowWatermark"""
+        self.queues.onLow.append(callback)
+        return callback
+
+    @property
+    def congested(self):
+        """True between the high and the low watermark, producers can publish less meanwhile"""
+        return bool(self.queues.congested)
 
     def _incrementRequestCount(self):
         self.requestCount += 1
@@ -31,40 +367,67 @@ class LocalContext(Context):
         return self.terminated
 
     def run(self):
-        while not self.terminated:
-            found = False
-            for index in range(len(self.queues)):
-                if self.terminated: return
-                queue = self.queues[index]
-                if queue is not None and len(queue) != 0:
-                    found = True
-                    self._process(queue.pop(0))
+        try:
+            while not self.terminated:
+                msg = self._next()
+                if msg is None:
                     break
-            if not found:
-                break
+                self._process(msg)
+                self.queues.done(msg)
+        finally:
+            # Durable queues resume after the last message done, whichever way run() ended
+            self.queues.checkpoint()
+        if self.metrics is not None:
+            self.metrics.export()
+        if len(self.queues) == 0:
+            self.queues.close()
+
+    def _next(self):
+        """The next message to process: a retried one which is due, else the next queued one which is not delayed"""
+        delayed = self.delayed
+        while not self.terminated:
+            if delayed and delayed[0][0] <= time.time():
+                return heapq.heappop(delayed)[2]
+            msg = self.queues.pop()
+            if msg is None:
+                if not delayed:
+                    return None
+                time.sleep(max(0, delayed[0][0] - time.time()))
+                continue
+            if RetryPolicy.wait(msg):
+                self._park(msg)
+                continue
+            return msg
+        return None
+
+    def _park(self, msg):
+        self._delayedCount += 1
+        heapq.heappush(self.delayed, (msg['_system']['retryAt'], self._delayedCount, msg))
+
+    def _deadLetter(self, msg):
+        # The local queues all feed the handlers, so a dead-letter queue would retry the message forever
+        self.deadLetters.append(msg)
+        return True
+
     def stop(self):
         self.terminated = True
 
     def publish(self, msg, queueName=None):
         if self.terminated:
             return
+        if self.rateLimits is not None:
+            self.rateLimits.wait('queue', queueName or 'default')
+        self._enqueue(msg, queueName)
+
+    def _enqueue(self, msg, queueName):
+        self._stamp(msg)
+        if not self.queues.push(self._priority(msg, queueName), msg):
+            logger.debug('Queue is full, dropped message %s', msg.get('messageType'))
+
+    def _priority(self, msg, queueName):
         if 'priority' in msg:
-            priority = msg['priority']
-        else:
-            priority = self._queueIndex(queueName) if queueName is not None else 1
-        queue = self.queues[priority]
-        if queue is None:
-            queue = []
-            self.queues[priority] = queue
-        queue.append(msg)
+            return msg['priority']
+        return self._queueIndex(queueName) if queueName is not None else 1
 
     def _queueIndex(self, queueName):
-        if 'queues' in self.config:
-            queues = self.config['queues']
-            index = 0
-            for key in queues:
-                if key == queueName:
-                    return index
-                index += 1
-
-        return 1
+        return self.queueIndexes.get(queueName, 1)
@@ -0,0 +1,351 @@
+from __future__ import print_function
+import json
+import time
+import bisect
+import threading
+
+import logging
+logger = logging.getLogger("hopper.metrics")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Counters and latency histograms recorded by a Context, read through context.stats().
+
+Per messageType: messages processed. Per callback: calls, errors and latency. Per filter: messages dropped.
+Per rate limit or throttled queue: the messages which waited and how long (throttles).
+Per messageType: the failed messages published again (retries) and sent to the dead-letter queue (deadLetters).
+With dedup enabled, per messageType: the messages skipped as duplicates (dedupHits) and the ones processed (dedupMisses).
+LocalContext adds per priority queue depth and the time messages waited in the queue.
+ProcessPoolContext workers send their counts to the parent when they stop, so its stats() include them
+once run() returns.
+Exporters receive the snapshot when Metrics.export is called: LambdaContext exports (and resets) after
+every invocation, LocalContext when run() returns.
+
+    metrics:
+        enabled: True
+        emf: True               # CloudWatch embedded metric format log line per Lambda invocation
+        namespace: Hopper
+        # prometheus: metrics.prom
+"""
+
+# Upper bounds of the latency buckets in seconds, the last bucket holds everything slower
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the percentile"""
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return 0.0
+
+    def merge(self, other):
+        self.counts = [count + otherCount for count, otherCount in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99),
+                'buckets': list(self.counts)}
+
+
+class CallbackStats(object):
+    __slots__ = ('calls', 'errors', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def snapshot(self, key):
+        return {'messageType': key[0], 'callback': key[1], 'calls': self.calls, 'errors': self.errors,
+                'latency': self.latency.snapshot()}
+
+
+class Metrics(object):
+    """
+    Updates are not locked, to keep the cost per message around a microsecond: with the GIL, an update racing
+    with another thread (lambda.concurrency or dispatch.fanout: pool) can be lost on rare occasions,
+    so counts under concurrency are approximate. The lock only guards creating entries and snapshots
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.exporters = []
+        self.gauges = dict()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.messages = dict()
+            self.callbacks = dict()
+            self.filterDrops = dict()
+            self.queueWait = dict()
+            self.throttles = dict()
+            self.retries = dict()
+            self.deadLetters = dict()
+            self.dedupHits = dict()
+            self.dedupMisses = dict()
+            self.started = time.time()
+
+    def message(self, messageType):
+        messages = self.messages
+        messages[messageType] = messages.get(messageType, 0) + 1
+
+    def callback(self, messageType, name, elapsed, failed=False):
+        stats = self.callbacks.get((messageType, name))
+        if stats is None:
+            with self.lock:
+                stats = self.callbacks.setdefault((messageType, name), CallbackStats())
+        stats.calls += 1
+        if failed:
+            stats.errors += 1
+        stats.latency.observe(elapsed)
+
+    def filterDrop(self, messageType, name):
+        key = (messageType, name)
+        self.filterDrops[key] = self.filterDrops.get(key, 0) + 1
+
+    def throttled(self, kind, name, waited=0.0, count=1):
+        """Messages which waited for a rate limit (kind messageType or queue) or were throttled by a backend"""
+        key = (kind, name)
+        counts = self.throttles.get(key)
+        if counts is None:
+            with self.lock:
+                counts = self.throttles.setdefault(key, [0, 0.0])
+        counts[0] += count
+        counts[1] += waited
+
+    def retried(self, messageType):
+        retries = self.retries
+        retries[messageType] = retries.get(messageType, 0) + 1
+
+    def deadLettered(self, messageType):
+        deadLetters = self.deadLetters
+        deadLetters[messageType] = deadLetters.get(messageType, 0) + 1
+
+    def deduplicated(self, messageType, duplicate):
+        counts = self.dedupHits if duplicate else self.dedupMisses
+        counts[messageType] = counts.get(messageType, 0) + 1
+
+    def queueWaited(self, priority, elapsed):
+        histogram = self.queueWait.get(priority)
+        if histogram is None:
+            with self.lock:
+                histogram = self.queueWait.setdefault(priority, Histogram())
+        histogram.observe(elapsed)
+
+    def state(self):
+        """The counts, which can be pickled and merged into the metrics of another process"""
+        with self.lock:
+            return {'messages': dict(self.messages), 'callbacks': dict(self.callbacks),
+                    'filterDrops': dict(self.filterDrops), 'queueWait': dict(self.queueWait),
+                    'throttles': dict(self.throttles), 'retries': dict(self.retries),
+                    'deadLetters': dict(self.deadLetters), 'dedupHits': dict(self.dedupHits),
+                    'dedupMisses': dict(self.dedupMisses)}
+
+    def merge(self, state):
+        """Adds the counts of another process, as returned by its state()"""
+        with self.lock:
+            for name in ('messages', 'filterDrops', 'retries', 'deadLetters', 'dedupHits', 'dedupMisses'):
+                counts = getattr(self, name)
+                for key, count in state[name].items():
+                    counts[key] = counts.get(key, 0) + count
+            for key, stats in state['callbacks'].items():
+                merged = self.callbacks.setdefault(key, CallbackStats())
+                merged.calls += stats.calls
+                merged.errors += stats.errors
+                merged.latency.merge(stats.latency)
+            for priority, histogram in state['queueWait'].items():
+                self.queueWait.setdefault(priority, Histogram()).merge(histogram)
+            for key, counts in state['throttles'].items():
+                merged = self.throttles.setdefault(key, [0, 0.0])
+                merged[0] += counts[0]
+                merged[1] += counts[1]
+
+    def gauge(self, name, read):
+        """Registers a function read on every snapshot, such as the depth of the queues"""
+        self.gauges[name] = read
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {
+                'interval': time.time() - self.started,
+                'messages': dict(self.messages),
+                'callbacks': dict(('%s.%s' % key, stats.snapshot(key)) for key, stats in list(self.callbacks.items())),
+                'filterDrops': dict(('%s.%s' % key, count) for key, count in list(self.filterDrops.items())),
+                'queueWait': dict((str(priority), histogram.snapshot()) for priority, histogram in list(self.queueWait.items())),
+                'throttles': dict(('%s.%s' % key, {'count': counts[0], 'waited': counts[1]})
+                                  for key, counts in list(self.throttles.items())),
+                'retries': dict(self.retries),
+                'deadLetters': dict(self.deadLetters),
+                'dedupHits': dict(self.dedupHits),
+                'dedupMisses': dict(self.dedupMisses)
+            }
+        for name, read in self.gauges.items():
+            snapshot[name] = read()
+        return snapshot
+
+    def export(self):
+        if not self.exporters:
+            return
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            try:
+                exporter.export(snapshot)
+            except:
+                logger.exception('Unable to export metrics with %s', exporter)
+
+    @staticmethod
+    def fromConfig(config):
+        if config['metrics.enabled'] is False:
+            return None
+        metrics = Metrics()
+        if config['metrics.prometheus']:
+            metrics.exporters.append(PrometheusExporter(config['metrics.prometheus']))
+        return metrics
+
+
+class EMFExporter(object):
+    """Writes the snapshot as CloudWatch embedded metric format documents, one per callback"""
+    def __init__(self, namespace=None, write=None):
+        self.namespace = namespace or 'Hopper'
+        self.write = write or (lambda line: print(line))
+
+    def export(self, snapshot):
+        timestamp = int(time.time() * 1000)
+        for stats in snapshot['callbacks'].values():
+            latency = stats['latency']
+            self.write(json.dumps({
+                '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['MessageType', 'Callback']],
+                    'Metrics': [{'Name': 'Invocations', 'Unit': 'Count'}, {'Name': 'Errors', 'Unit': 'Count'},
+                                {'Name': 'Latency', 'Unit': 'Milliseconds'}, {'Name': 'LatencyMax', 'Unit': 'Milliseconds'}]
+                }]},
+                'MessageType': str(stats['messageType']), 'Callback': stats['callback'],
+                'Invocations': stats['calls'], 'Errors': stats['errors'],
+                'Latency': latency['sum'] / latency['count'] * 1000 if latency['count'] else 0,
+                'LatencyMax': latency['max'] * 1000
+            }, separators=(',', ':')))
+        for key, count in snapshot['filterDrops'].items():
+            messageType, name = key.rsplit('.', 1)
+            self.write(json.dumps({
+                '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                    'Namespace': self.namespace, 'Dimensions': [['MessageType', 'Filter']],
+                    'Metrics': [{'Name': 'FilterDrops', 'Unit': 'Count'}]}]},
+                'MessageType': messageType, 'Filter': name, 'FilterDrops': count
+            }, separators=(',', ':')))
+        for key, counts in snapshot.get('throttles', {}).items():
+            kind, name = key.split('.', 1)
+            self.write(json.dumps({
+                '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                    'Namespace': self.namespace, 'Dimensions': [['Kind', 'Name']],
+                    'Metrics': [{'Name': 'Throttles', 'Unit': 'Count'}, {'Name': 'ThrottleWait', 'Unit': 'Milliseconds'}]}]},
+                'Kind': kind, 'Name': name, 'Throttles': counts['count'], 'ThrottleWait': counts['waited'] * 1000
+            }, separators=(',', ':')))
+        for messageType in set(snapshot.get('retries', {})) | set(snapshot.get('deadLetters', {})):
+            self.write(json.dumps({
+                '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                    'Namespace': self.namespace, 'Dimensions': [['MessageType']],
+                    'Metrics': [{'Name': 'Retries', 'Unit': 'Count'}, {'Name': 'DeadLetters', 'Unit': 'Count'}]}]},
+                'MessageType': str(messageType), 'Retries': snapshot['retries'].get(messageType, 0),
+                'DeadLetters': snapshot['deadLetters'].get(messageType, 0)
+            }, separators=(',', ':')))
+        for messageType in set(snapshot.get('dedupHits', {})) | set(snapshot.get('dedupMisses', {})):
+            self.write(json.dumps({
+                '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                    'Namespace': self.namespace, 'Dimensions': [['MessageType']],
+                    'Metrics': [{'Name': 'DedupHits', 'Unit': 'Count'}, {'Name': 'DedupMisses', 'Unit': 'Count'}]}]},
+                'MessageType': str(messageType), 'DedupHits': snapshot['dedupHits'].get(messageType, 0),
+                'DedupMisses': snapshot['dedupMisses'].get(messageType, 0)
+            }, separators=(',', ':')))
+
+
+def prometheusText(snapshot):
+    """The snapshot in the Prometheus text exposition format"""
+    lines = ['# TYPE hopper_messages_total counter']
+    for messageType, count in sorted(snapshot['messages'].items()):
+        lines.append('hopper_messages_total{messageType="%s"} %d' % (messageType, count))
+    lines.append('# TYPE hopper_callback_errors_total counter')
+    for stats in _sortedValues(snapshot['callbacks']):
+        lines.append('hopper_callback_errors_total{%s} %d' % (_labels(stats), stats['errors']))
+    lines.append('# TYPE hopper_callback_seconds histogram')
+    for stats in _sortedValues(snapshot['callbacks']):
+        lines.extend(_histogramLines('hopper_callback_seconds', _labels(stats), stats['latency']))
+    lines.append('# TYPE hopper_filter_drops_total counter')
+    for key, count in sorted(snapshot['filterDrops'].items()):
+        messageType, name = key.rsplit('.', 1)
+        lines.append('hopper_filter_drops_total{messageType="%s",filter="%s"} %d' % (messageType, name, count))
+    lines.append('# TYPE hopper_throttles_total counter')
+    for key, counts in sorted(snapshot.get('throttles', {}).items()):
+        kind, name = key.split('.', 1)
+        lines.append('hopper_throttles_total{kind="%s",name="%s"} %d' % (kind, name, counts['count']))
+    lines.append('# TYPE hopper_retries_total counter')
+    for messageType, count in sorted(snapshot.get('retries', {}).items()):
+        lines.append('hopper_retries_total{messageType="%s"} %d' % (messageType, count))
+    lines.append('# TYPE hopper_dead_letters_total counter')
+    for messageType, count in sorted(snapshot.get('deadLetters', {}).items()):
+        lines.append('hopper_dead_letters_total{messageType="%s"} %d' % (messageType, count))
+    lines.append('# TYPE hopper_dedup_hits_total counter')
+    for messageType, count in sorted(snapshot.get('dedupHits', {}).items()):
+        lines.append('hopper_dedup_hits_total{messageType="%s"} %d' % (messageType, count))
+    lines.append('# TYPE hopper_dedup_misses_total counter')
+    for messageType, count in sorted(snapshot.get('dedupMisses', {}).items()):
+        lines.append('hopper_dedup_misses_total{messageType="%s"} %d' % (messageType, count))
+    if 'queueDepth' in snapshot:
+        lines.append('# TYPE hopper_queue_depth gauge')
+        for priority, depth in sorted(snapshot['queueDepth'].items()):
+            lines.append('hopper_queue_depth{priority="%s"} %d' % (priority, depth))
+    lines.append('# TYPE hopper_queue_wait_seconds histogram')
+    for priority, histogram in sorted(snapshot['queueWait'].items()):
+        lines.extend(_histogramLines('hopper_queue_wait_seconds', 'priority="%s"' % priority, histogram))
+    return '\n'.join(lines) + '\n'
+
+def _sortedValues(stats):
+    return [stats[key] for key in sorted(stats)]
+
+def _labels(stats):
+    return 'messageType="%s",callback="%s"' % (stats['messageType'], stats['callback'])
+
+def _histogramLines(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram['buckets']):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, histogram['count']))
+    lines.append('%s_sum{%s} %s' % (name, labels, repr(histogram['sum'])))
+    lines.append('%s_count{%s} %d' % (name, labels, histogram['count']))
+    return lines
+
+
+class PrometheusExporter(object):
+    """Rewrites the file with the Prometheus text format, for the node exporter textfile collector"""
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, snapshot):
+        with open(self.path, 'w') as stream:
+            stream.write(prometheusText(snapshot))
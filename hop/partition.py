@@ -0,0 +1,141 @@
+import time
+import uuid
+import bisect
+import hashlib
+import random
+
+import logging
+logger = logging.getLogger("hopper.partition")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Partition keys of published messages.
+
+Messages sharing a partition key go to the same Kinesis shard (or SQS FIFO message group), so they are
+received in order by the same invocation. The key is chosen per messageType, messages of other types get
+a random key:
+
+    partition:
+        messageTypes:
+            pageUrl:
+                field: url              # the value of a field of the message
+            pageBody:
+                correlation: True       # a hash of _system.parentMessageID, shared by the messages one message published
+            pageView:
+                correlation: traceID    # a hash of another _system field: traceID puts a whole trace on one shard,
+                                        # it is only stamped with tracing enabled (random keys otherwise)
+        salts:
+            pageUrl: 4                  # keys spread over this many partitions
+        hotKeyRate: 1000                # keys published more often per second are spread over hotKeySalts
+        hotKeySalts: 4
+
+Key functions are registered with context.partitionBy(messageType, key=function). A salted key is suffixed
+with one of its salts, so its messages are spread over shards and no longer keep their order.
+"""
+
+# Partition keys are at most 256 characters for Kinesis and 128 for an SQS MessageGroupId
+MAX_KEY_LENGTH = 128
+
+
+class PartitionKeys(object):
+    def __init__(self, hotKeyRate=None, hotKeySalts=None):
+        self.strategies = dict()
+        self.salts = dict()
+        self.hotKeyRate = hotKeyRate
+        self.hotKeySalts = hotKeySalts or 4
+        self.counts = dict()
+        self.window = time.time()
+
+    def register(self, messageType, field=None, key=None, correlation=False, salts=None):
+        """
+        Partition key of the messages of the type: the value of field, key(msg) or a hash of the _system field
+        correlation names, parentMessageID when it is True
+        """
+        if field is not None:
+            self.strategies[messageType] = lambda msg: msg.get(field)
+        elif key is not None:
+            self.strategies[messageType] = key
+        elif correlation:
+            self.strategies[messageType] = correlationKey('parentMessageID' if correlation is True else correlation)
+        if salts:
+            self.salts[messageType] = salts
+
+    def key(self, msg):
+        """The partition key of a published message, random when its type has no strategy or it has no key"""
+        strategy = self.strategies.get(msg['messageType'])
+        if strategy is None:
+            return uuid.uuid4().hex
+        key = strategy(msg)
+        if key is None:
+            return uuid.uuid4().hex
+        key = str(key)
+        if len(key) > MAX_KEY_LENGTH:
+            key = hashlib.md5(key.encode('utf-8')).hexdigest()
+        salts = self.salts.get(msg['messageType'])
+        if salts is None and self.hotKeyRate is not None and self._hot(key):
+            salts = self.hotKeySalts
+        if salts:
+            return '%s#%d' % (key, random.randrange(salts))
+        return key
+
+    def _hot(self, key):
+        """True once the key is published more than hotKeyRate times within the current second"""
+        now = time.time()
+        if now - self.window >= 1:
+            self.counts = dict()
+            self.window = now
+        count = self.counts[key] = self.counts.get(key, 0) + 1
+        if count == self.hotKeyRate + 1:
+            logger.info('Spreading hot partition key %s over %s partitions', key, self.hotKeySalts)
+        return count > self.hotKeyRate
+
+    @staticmethod
+    def fromConfig(config):
+        section = config['partition'] or {}
+        keys = PartitionKeys(config['partition.hotKeyRate'], config['partition.hotKeySalts'])
+        for messageType, strategy in (section.get('messageTypes') or {}).items():
+            keys.register(messageType, field=strategy.get('field'), correlation=strategy.get('correlation'))
+        keys.salts.update(section.get('salts') or {})
+        return keys
+
+
+def correlationKey(field='parentMessageID'):
+    """
+    Key function hashing a _system field. The messages published by one message share its parentMessageID,
+    while a traceID is shared by all the messages descending from a root, which can make one shard hot
+    """
+    def key(msg):
+        system = msg.get('_system')
+        if system is None or field not in system:
+            return None
+        return hashlib.md5(str(system[field]).encode('utf-8')).hexdigest()
+    return key
+
+
+class ShardMap(object):
+    """Hash key ranges of the open shards of a Kinesis stream, to find the shard of a partition key"""
+    def __init__(self, shards):
+        shards = sorted(shards, key=lambda shard: int(shard['HashKeyRange']['StartingHashKey']))
+        self.starts = [int(shard['HashKeyRange']['StartingHashKey']) for shard in shards]
+        self.shardIDs = [shard['ShardId'] for shard in shards]
+
+    def shardFor(self, partitionKey):
+        hashKey = int(hashlib.md5(partitionKey.encode('utf-8')).hexdigest(), 16)
+        return self.shardIDs[max(0, bisect.bisect_right(self.starts, hashKey) - 1)]
+
+    def __len__(self):
+        return len(self.shardIDs)
+
+    @staticmethod
+    def fromStream(client, stream):
+        shards = []
+        kwargs = {'StreamName': stream}
+        while True:
+            response = client.list_shards(**kwargs)
+            # Closed shards (split or merged) do not receive records any more
+            shards.extend(shard for shard in response['Shards']
+                          if 'EndingSequenceNumber' not in shard.get('SequenceNumberRange', {}))
+            if not response.get('NextToken'):
+                return ShardMap(shards)
+            kwargs = {'NextToken': response['NextToken']}
@@ -0,0 +1,280 @@
+import sys
+import time
+import multiprocessing
+from collections import deque
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from hop.local import LocalContext
+from hop.retry import RetryPolicy
+import logging
+logger = logging.getLogger("hopper.pool")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Local context which runs handlers in a pool of worker processes
+"""
+
+# Seconds the parent waits for a result before checking that the workers are alive
+WORKER_CHECK_INTERVAL = 1
+
+def _multiprocessing():
+    # Workers inherit the registered handlers from the parent, so they have to be forked
+    if hasattr(multiprocessing, 'get_all_start_methods'):
+        forks = 'fork' in multiprocessing.get_all_start_methods()
+    else:
+        forks = sys.platform != 'win32'
+    if not forks:
+        raise RuntimeError('ProcessPoolContext needs fork, which %s does not have, use LocalContext' % sys.platform)
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+class ProcessPoolContext(LocalContext):
+    """
+    LocalContext which dispatches messages to worker processes.
+
+    The parent process owns the queues and dispatches messages to the workers through a shared task queue.
+    Messages published by handlers are sent back to the parent and queued there. The request count and the
+    terminated flag are shared between all processes, so stop() and runtime.autoStopLimit apply to the pool.
+
+    Handlers and filters must be registered before run() is called. The workers are forked, so the pool is not
+    available on Windows (its constructor raises RuntimeError). A worker which exits is replaced, the message it was
+    processing is retried or dead-lettered as if its handler raised.
+    concurrency maps a messageType to the maximum number of its messages processed at the same time (at least 1),
+    in addition to the local.concurrency.<messageType> config entries. Messages of a type at its limit wait
+    in the parent, up to twice the number of workers of them; the parent stops taking messages from the queues
+    while that many wait, and puts them back into the queues if it stops before dispatching them.
+    """
+    def __init__(self, config=None, workers=None, concurrency=None):
+        self._mp = _multiprocessing()
+        self._sharedCount = self._mp.Value('l', 0)
+        self._sharedTerminated = self._mp.Value('b', 0)
+        self._results = None
+        LocalContext.__init__(self, config)
+        # The parent only dispatches, so a full queue takes the message over its capacity instead of blocking
+        self.queues.block = None
+        self.workers = workers or self.config['local.workers'] or self._mp.cpu_count()
+        self.concurrency = dict(concurrency or {})
+
+    @property
+    def terminated(self):
+        return bool(self._sharedTerminated.value)
+
+    @terminated.setter
+    def terminated(self, value):
+        self._sharedTerminated.value = 1 if value else 0
+
+    @property
+    def requestCount(self):
+        return self._sharedCount.value
+
+    @requestCount.setter
+    def requestCount(self, value):
+        self._sharedCount.value = value
+
+    def _incrementRequestCount(self):
+        with self._sharedCount.get_lock():
+            self._sharedCount.value += 1
+
+    def _concurrencyLimit(self, messageType):
+        if messageType in self.concurrency:
+            return self.concurrency[messageType]
+        return self.config['local.concurrency.%s' % messageType]
+
+    def _checkConcurrency(self):
+        limits = dict((key[len('local.concurrency.'):], self.config[key]) for key in self.config
+                      if key.startswith('local.concurrency.'))
+        limits.update(self.concurrency)
+        for messageType, limit in limits.items():
+            # Its messages would wait in the parent forever
+            if limit is not None and limit < 1:
+                raise ValueError('Concurrency limit of %s must be at least 1, not %s' % (messageType, limit))
+
+    def _pop(self):
+        """The next queued message and its priority, the level pop served stays at the top of the heap"""
+        msg = self.queues.pop()
+        return (self.queues.active[0], msg) if msg is not None else (None, None)
+
+    def run(self):
+        self._checkConcurrency()
+        results = self._mp.Queue()
+        # Each worker has its own task queue, so the messages a worker was given are known if it dies
+        workers = [self._startWorker(results) for i in range(self.workers)]
+        # Ids of the messages sent to each worker, in the order it processes them
+        assigned = [deque() for worker in workers]
+
+        inFlight = 0
+        running = dict()
+        # Messages sent to the workers by their id, the queues are told when they are done
+        dispatched = dict()
+        # (priority, message) of the types at their limit, at most maxDeferred of them
+        deferred = dict()
+        waiting = 0
+        maxDeferred = self.workers * 2
+
+        def dispatch(msg):
+            index = min(range(len(workers)), key=lambda index: len(assigned[index]))
+            dispatched[id(msg)] = msg
+            assigned[index].append(id(msg))
+            workers[index][1].put((id(msg), msg))
+
+        try:
+            while True:
+                while not self.terminated and inFlight < self.workers * 2 and waiting < maxDeferred:
+                    priority, msg = self._pop()
+                    if msg is None:
+                        break
+                    messageType = _messageType(msg)
+                    limit = self._concurrencyLimit(messageType)
+                    if limit is not None and running.get(messageType, 0) >= limit:
+                        deferred.setdefault(messageType, deque()).append((priority, msg))
+                        waiting += 1
+                        continue
+                    dispatch(msg)
+                    inFlight += 1
+                    running[messageType] = running.get(messageType, 0) + 1
+
+                if inFlight == 0:
+                    break
+
+                try:
+                    received = [results.get(timeout=WORKER_CHECK_INTERVAL)]
+                except Empty:
+                    # A worker which died never reports its message done
+                    received = self._replaceDeadWorkers(workers, assigned, dispatched, results)
+                for result in received:
+                    if result[0] == 'publish':
+                        LocalContext.publish(self, result[1], result[2])
+                    elif result[0] == 'deadLetter':
+                        LocalContext._deadLetter(self, result[1])
+                    elif result[0] == 'done':
+                        messageType, key = result[1], result[2]
+                        self.queues.done(dispatched.pop(key))
+                        for keys in assigned:
+                            if key in keys:
+                                keys.remove(key)
+                                break
+                        queued = deferred.get(messageType)
+                        if queued and not self.terminated:
+                            priority, msg = queued.popleft()
+                            waiting -= 1
+                            dispatch(msg)
+                        else:
+                            inFlight -= 1
+                            running[messageType] -= 1
+        finally:
+            self._requeue(deferred)
+            # The messages the workers did not finish are read again after a restart of durable queues
+            self.queues.checkpoint()
+            for process, tasks in workers:
+                tasks.put(None)
+            if self.metrics is not None:
+                # Read before joining, a worker does not exit until what it put on the queue is taken
+                self._mergeMetrics(results, len(workers))
+            for process, tasks in workers:
+                process.join(5)
+                if process.is_alive():
+                    logger.warning("Terminating worker %s which did not stop", process.pid)
+                    process.terminate()
+        if self.metrics is not None:
+            self.metrics.export()
+
+    def _startWorker(self, results):
+        tasks = self._mp.Queue()
+        process = self._mp.Process(target=self._work, args=(tasks, results))
+        process.daemon = True
+        process.start()
+        return process, tasks
+
+    def _replaceDeadWorkers(self, workers, assigned, dispatched, results):
+        """
+        Starts a worker in place of each one which exited. The message a worker was processing is retried (or
+        dead-lettered) as if its handler raised, the ones waiting for it go to its replacement. Returns the
+        results reporting the failed messages done
+        """
+        done = []
+        for index, (process, tasks) in enumerate(workers):
+            if process.is_alive():
+                continue
+            workers[index] = self._startWorker(results)
+            keys = list(assigned[index])
+            if not keys:
+                logger.error("Worker %s exited with %s", process.pid, process.exitcode)
+                continue
+            msg = dispatched[keys[0]]
+            logger.error("Worker %s exited with %s processing %s", process.pid, process.exitcode, _messageType(msg))
+            for key in keys[1:]:
+                workers[index][1].put((key, dispatched[key]))
+            self._failed(None, msg, RuntimeError('Worker exited with %s' % process.exitcode))
+            done.append(('done', _messageType(msg), keys[0]))
+        return done
+
+    def _mergeMetrics(self, results, workers):
+        """Adds the counts the workers send when they stop to the metrics of the parent"""
+        while workers:
+            try:
+                result = results.get(timeout=5)
+            except Exception:
+                logger.warning("%s workers did not send their metrics", workers)
+                return
+            if result[0] == 'metrics':
+                self.metrics.merge(result[1])
+                workers -= 1
+
+    def _requeue(self, deferred):
+        """Puts the messages which were not dispatched back into the queues"""
+        for queued in deferred.values():
+            for priority, msg in queued:
+                self.queues.push(priority, msg)
+                # A durable queue keeps the copy just pushed, instead of delivering the taken one again
+                self.queues.done(msg)
+
+    def _work(self, tasks, results):
+        self._results = results
+        if self.metrics is not None:
+            # Counted from zero in the worker, the parent adds its counts when it stops
+            self.metrics.reset()
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            key, msg = task
+            try:
+                # A retried message which is not due yet holds the worker until it is
+                wait = RetryPolicy.wait(msg)
+                if wait:
+                    time.sleep(wait)
+                self._process(msg)
+            except:
+                logger.exception("Unable to process message %s", msg)
+            finally:
+                results.put(('done', _messageType(msg), key))
+        if self.metrics is not None:
+            results.put(('metrics', self.metrics.state()))
+
+    def publish(self, msg, queueName=None):
+        if self.terminated:
+            return
+        if self._results is not None:
+            # Stamped here, where the message being processed is known
+            self._stamp(msg)
+            self._results.put(('publish', msg, queueName))
+        else:
+            LocalContext.publish(self, msg, queueName)
+
+    def _deadLetter(self, msg):
+        if self._results is not None:
+            self._results.put(('deadLetter', msg))
+            return True
+        return LocalContext._deadLetter(self, msg)
+
+
+def _messageType(msg):
+    if isinstance(msg, dict) and 'messageType' in msg:
+        return msg['messageType']
+    return None
@@ -0,0 +1,73 @@
+import time
+import random
+
+import logging
+logger = logging.getLogger("hopper.retry")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Retries of messages whose callbacks raised.
+
+When a handler raises, a copy of the message addressed to that handler only is published again, with the
+number of the attempt in _system.attempts and the time it can be processed at in _system.retryAt. The delay
+doubles with every attempt (jittered, up to maxDelay). Once maxAttempts have failed, the copy is published to
+the dead-letter queue with the error in _system.error. Records which cannot be decoded are sent to the dead-letter
+queue as they are. Without a dead-letter queue, LambdaContext logs the message (or the payload) as an error and
+drops it: delivered again, a poison record would fail until it expires and hold up the records after it in its
+shard. The dead-letter queue must not be one the function receives. LocalContext keeps the failed messages in
+context.deadLetters instead.
+
+    retry:
+        maxAttempts: 3          # attempts of a handler, including the first one
+        delay: 1                # seconds before the second attempt
+        maxDelay: 30
+        # queue: default        # where retries are published
+        # deadLetterQueue: deadLetter   # a queue of config.yaml, such as an SQS queue
+        keepDeadLetters: 1000   # failed messages kept by LocalContext
+"""
+
+class RetryPolicy(object):
+    def __init__(self, maxAttempts=None, delay=None, maxDelay=None, queue=None, deadLetterQueue=None):
+        self.maxAttempts = maxAttempts or 1
+        self.delay = delay if delay is not None else 1
+        self.maxDelay = maxDelay if maxDelay is not None else 30
+        self.queue = queue
+        self.deadLetterQueue = deadLetterQueue
+
+    @staticmethod
+    def attempts(msg):
+        """Attempts made to process the message so far, including the current one"""
+        system = msg.get('_system')
+        return system['attempts'] if system is not None and 'attempts' in system else 1
+
+    @staticmethod
+    def wait(msg):
+        """Seconds until the retried message is due, 0 for other messages"""
+        system = msg.get('_system') if isinstance(msg, dict) else None
+        if system is None or 'retryAt' not in system:
+            return 0
+        return max(0, system['retryAt'] - time.time())
+
+    def delayFor(self, attempts):
+        """Delay before the attempt following the given number of failed ones, between half and all of the backoff"""
+        delay = min(self.maxDelay, self.delay * (2 ** (attempts - 1)))
+        return random.uniform(delay / 2.0, delay)
+
+    def retry(self, copy, attempts):
+        """Stamps the copy of a message which failed attempts times as the next attempt"""
+        copy['_system']['attempts'] = attempts + 1
+        copy['_system']['retryAt'] = time.time() + self.delayFor(attempts)
+        return copy
+
+    @staticmethod
+    def deadLetter(copy, attempts, callback, error):
+        copy['_system']['attempts'] = attempts
+        copy['_system']['error'] = {'callback': callback.__name__ if callback is not None else None,
+                                    'error': repr(error), 'failed': time.time()}
+        return copy
+
+    @staticmethod
+    def fromConfig(config):
+        return RetryPolicy(config['retry.maxAttempts'], config['retry.delay'], config['retry.maxDelay'],
+                           config['retry.queue'], config['retry.deadLetterQueue'])
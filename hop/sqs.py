@@ -0,0 +1,92 @@
+import math
+import base64
+
+from hop.aws import clientError
+from hop.backend import QueueBackend
+from hop.kinesis import PublishBuffer
+from hop.throttle import THROTTLING
+import logging
+logger = logging.getLogger("hopper.sqs")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+SQS queues of LambdaContext. Messages are sent with send_message_batch, base64 encoded as the codec output
+is binary. Records of SQS events whose body is plain JSON (sent by other producers) are read as they are.
+Messages sent to a FIFO queue (.fifo) are grouped by their partition key, which keeps their order, and
+deduplicated by their _system.messageID (MessageDeduplicationId), so the queue does not need content-based
+deduplication and a message sent again within its five minute window is delivered once.
+Retried messages are sent with DelaySeconds (up to 15 minutes) on standard queues, FIFO queues only
+have the delay of the queue
+"""
+
+# Longest DelaySeconds of a message
+MAX_DELAY = 900
+
+class SQSPublishBuffer(PublishBuffer):
+    """PublishBuffer sending up to 10 messages, 256 KB, per send_message_batch request"""
+    MAX_BATCH_RECORDS = 10
+    MAX_BATCH_BYTES = 256 * 1024
+
+    def _record(self, queueUrl, data, partitionKey, delay=0, deduplicationID=None):
+        body = base64.b64encode(data).decode('ascii')
+        entry = {'MessageBody': body}
+        if queueUrl.endswith('.fifo'):
+            entry['MessageGroupId'] = partitionKey
+            if deduplicationID is not None:
+                entry['MessageDeduplicationId'] = deduplicationID
+        elif delay:
+            entry['DelaySeconds'] = min(MAX_DELAY, int(math.ceil(delay)))
+        return entry, len(body)
+
+    def _request(self, queueUrl, entries):
+        try:
+            response = self.client.send_message_batch(
+                QueueUrl=queueUrl, Entries=[dict(entry, Id=str(index)) for index, entry in enumerate(entries)])
+        except Exception as e:
+            code = (clientError(e) or {}).get('Code')
+            if code in THROTTLING:
+                return [(entry, code, True) for entry in entries]
+            raise
+        # A sender fault means the request was wrong (such as a message over the size limit), sending it again would not help
+        return [(entries[int(failure['Id'])], failure.get('Code'), not failure.get('SenderFault'))
+                for failure in response.get('Failed', [])]
+
+
+class SQSBackend(QueueBackend):
+    eventSource = 'aws:sqs'
+
+    def __init__(self, client, config):
+        QueueBackend.__init__(self, SQSPublishBuffer(client,
+                                                     maxRecords=config['publish.sqsBatchSize'],
+                                                     maxDelay=config['publish.maxDelay'],
+                                                     maxRetries=config['publish.maxRetries'],
+                                                     retryDelay=config['publish.retryDelay'],
+                                                     maxThrottleWait=config['publish.maxThrottleWait']))
+        self.client = client
+        self.urls = dict()
+
+    def destination(self, config, queue):
+        url = config['queues.%s.url' % queue]
+        if url is not None:
+            return url
+        name = config['queues.%s.name' % queue]
+        if name not in self.urls:
+            self.urls[name] = self.client.get_queue_url(QueueName=name)['QueueUrl']
+        return self.urls[name]
+
+    def payload(self, record):
+        body = record['body']
+        if body.startswith('{'):
+            return body.encode('utf-8')
+        return base64.b64decode(body)
+
+    def recordID(self, record):
+        return record['messageId']
+
+    def partitionKey(self, record):
+        # Only FIFO queues keep an order, within a message group
+        return record.get('attributes', {}).get('MessageGroupId') or record['messageId']
+
+    def ordered(self, record):
+        return 'MessageGroupId' in record.get('attributes', {})
@@ -0,0 +1,130 @@
+import time
+import random
+import threading
+from timeit import default_timer as timer
+
+import logging
+logger = logging.getLogger("hopper.throttle")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Rate limits and backoff.
+
+Limits are token buckets per messageType, applied when a message is dispatched to its handlers, and per queue,
+applied when a message is published. A message over the limit waits for its token. Limits come from
+@context.handle(messageType, rateLimit=...) or config.yaml:
+
+    throttle:
+        burst: 1                # seconds of the rate which can be used at once
+        messageTypes:
+            pageUrl: 10         # messages handled per second
+        queues:
+            default: 1000       # messages published per second
+
+Records a queue rejects as throttled (such as ProvisionedThroughputExceededException) are retried after an
+AdaptiveBackoff delay instead of counting as failed: the delay grows multiplicatively on every throttled send
+and shrinks additively on every successful one, with jitter so concurrent senders do not retry in step.
+"""
+
+# Error codes of Kinesis and SQS telling that the request rate is over the limit
+THROTTLING = frozenset(['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestThrottled',
+                        'KMSThrottlingException', 'LimitExceededException'])
+
+
+class TokenBucket(object):
+    """rate tokens per second, of which up to burst are saved while unused"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, self.rate))
+        self.tokens = self.burst
+        self.updated = timer()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Takes the tokens, returns the seconds to wait before using them (tokens taken ahead are owed)"""
+        with self.lock:
+            now = timer()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def tryAcquire(self, tokens=1):
+        """Takes the tokens if they are available now"""
+        with self.lock:
+            now = timer()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
+class AdaptiveBackoff(object):
+    """Delay between sends to a throttled destination, multiplicative increase and additive decrease"""
+    def __init__(self, initial=None, maximum=None, step=None):
+        self.initial = initial or 0.05
+        self.maximum = maximum or 5.0
+        self.step = step or self.initial
+        self.delay = 0.0
+        self.sleep = time.sleep
+
+    def throttled(self):
+        self.delay = min(self.maximum, self.delay * 2 if self.delay else self.initial)
+
+    def succeeded(self):
+        if self.delay:
+            self.delay = max(0.0, self.delay - self.step)
+
+    def wait(self):
+        """Sleeps for the current delay, between half of it and all of it. Returns the seconds slept"""
+        if not self.delay:
+            return 0.0
+        delay = random.uniform(self.delay / 2, self.delay)
+        self.sleep(delay)
+        return delay
+
+
+class RateLimits(object):
+    """Token buckets by kind (messageType or queue) and name. Waits are counted in the metrics as throttles"""
+    def __init__(self, metrics=None, burst=None):
+        self.buckets = dict()
+        self.metrics = metrics
+        self.burst = burst
+        self.sleep = time.sleep
+
+    def limit(self, kind, name, rate, burst=None):
+        if burst is None and self.burst is not None:
+            burst = max(1.0, rate * self.burst)
+        self.buckets[(kind, name)] = TokenBucket(rate, burst)
+
+    def reserve(self, kind, name):
+        """Seconds the message has to wait for the limit of the name, 0 if it has none"""
+        bucket = self.buckets.get((kind, name))
+        if bucket is None:
+            return 0.0
+        delay = bucket.reserve()
+        if delay and self.metrics is not None:
+            self.metrics.throttled(kind, name, delay)
+        return delay
+
+    def wait(self, kind, name):
+        delay = self.reserve(kind, name)
+        if delay:
+            logger.debug('Waiting %.3fs for the rate limit of %s %s', delay, kind, name)
+            self.sleep(delay)
+        return delay
+
+    @staticmethod
+    def fromConfig(config, metrics=None):
+        """RateLimits of the throttle section, None without limits"""
+        limits = None
+        for key in config:
+            for kind, prefix in (('messageType', 'throttle.messageTypes.'), ('queue', 'throttle.queues.')):
+                if key.startswith(prefix):
+                    if limits is None:
+                        limits = RateLimits(metrics, config['throttle.burst'])
+                    limits.limit(kind, key[len(prefix):], config[key])
+        return limits
@@ -0,0 +1,218 @@
+from __future__ import print_function
+import json
+import time
+import random
+import threading
+from collections import deque
+
+import logging
+logger = logging.getLogger("hopper.tracing")
+
+__author__ = 'Denis Mikhalkin'
+
+"""
+Lineage of messages across hops.
+
+Publish links every message to the message being processed, tracing enabled or not, in its _system part:
+    parentMessageID  messageID of the message being processed when it was published
+The copies of a message run by its sibling handlers (and its retries) stand for it: they carry lineageID,
+the messageID of the original, which is their parentMessageID and the parentMessageID of the messages they
+publish. So the messages published by all the handlers of a message can be joined on parentMessageID.
+
+When tracing is enabled, publish also stamps:
+    traceID          shared by all messages descending from the same root message
+    sampled          decided once per trace with probability sampleRate, inherited by the descendants
+    published        time.time() of the publish
+and _process records a span for every sampled message: when it was published, when its processing started
+and how long it took. Spans go to a collector: LocalCollector keeps them in memory (LocalContext),
+LogCollector prints one JSON line per span (LambdaContext, for CloudWatch Logs Insights).
+
+    tracing:
+        enabled: True
+        sampleRate: 0.01
+        # collector: local    # or log
+        # maxSpans: 10000     # spans kept by the local collector
+"""
+
+try:
+    import contextvars
+    _current = contextvars.ContextVar('hopperCurrentMessage', default=None)
+
+    def currentMessage():
+        return _current.get()
+
+    def _activate(msg):
+        return _current.set(msg)
+
+    def _restore(token):
+        _current.reset(token)
+
+    def wrapCurrent(f):
+        """f running in a copy of the calling context, so an executor thread sees the current message"""
+        context = contextvars.copy_context()
+        return lambda *args: context.run(f, *args)
+except ImportError:
+    _local = threading.local()
+
+    def currentMessage():
+        return getattr(_local, 'msg', None)
+
+    def _activate(msg):
+        previous = currentMessage()
+        _local.msg = msg
+        return previous
+
+    def _restore(token):
+        _local.msg = token
+
+    def wrapCurrent(f):
+        msg = currentMessage()
+
+        def call(*args):
+            token = _activate(msg)
+            try:
+                return f(*args)
+            finally:
+                _restore(token)
+        return call
+
+
+def activate(msg):
+    """Makes the message (or the latest one of a joined group) current while it is processed"""
+    if isinstance(msg, list):
+        msg = msg[-1] if msg else None
+    return _activate(msg)
+
+
+def deactivate(token):
+    _restore(token)
+
+
+def lineageOf(system):
+    """messageID of the message the _system header stands for: its own, or the original's for a copy"""
+    return system.get('lineageID') or system.get('messageID')
+
+
+def link(msg):
+    """
+    Called by publish: links the message to the message being processed. Returns the _system of the
+    parent, None when there is none or the message is a copy, which keeps the links of its original
+    """
+    system = msg.get('_system')
+    if system is None:
+        from hop import SystemHeader
+        system = msg['_system'] = SystemHeader()
+    if 'lineageID' in system:
+        return None
+    parent = currentMessage()
+    parentSystem = parent.get('_system') if isinstance(parent, dict) else None
+    if parentSystem is None:
+        return None
+    parentID = lineageOf(parentSystem)
+    if parentID is not None:
+        system['parentMessageID'] = parentID
+    return parentSystem
+
+
+def copyLineage(system, copy):
+    """Gives the copy of a message run by another handler (or retried) the links of the message"""
+    lineageID = lineageOf(system)
+    if lineageID is None:
+        return
+    copy['lineageID'] = copy['parentMessageID'] = lineageID
+    for key in ('traceID', 'sampled'):
+        if key in system:
+            copy[key] = system[key]
+
+
+class Tracer(object):
+    def __init__(self, sampleRate=None, collector=None):
+        self.sampleRate = 1.0 if sampleRate is None else sampleRate
+        self.collector = collector or LocalCollector()
+
+    def stamp(self, msg):
+        """Called by publish: links the message to the message being processed, or starts a new trace"""
+        parentSystem = link(msg)
+        system = msg['_system']
+        if parentSystem is not None and 'traceID' in parentSystem:
+            system['traceID'] = parentSystem['traceID']
+            system['sampled'] = parentSystem.get('sampled', False)
+        elif 'traceID' not in system:
+            self._root(system)
+        system['published'] = time.time()
+
+    def _root(self, system):
+        system['traceID'] = system['messageID']
+        system['sampled'] = random.random() < self.sampleRate
+
+    def start(self, msg):
+        """Makes the message the current one. Returns the state finish needs"""
+        if not isinstance(msg, dict):
+            return _activate(None), None
+        system = msg.get('_system')
+        if system is None or 'messageID' not in system:
+            return _activate(msg), None
+        if 'traceID' not in system:
+            # Received without being published through a tracing context, such as the event of a Lambda
+            self._root(system)
+        span = None
+        if system.get('sampled'):
+            span = {'traceID': system['traceID'], 'messageID': system['messageID'],
+                    'parentMessageID': system.get('parentMessageID'), 'messageType': msg.get('messageType'),
+                    'published': system.get('published'), 'started': time.time()}
+        return _activate(msg), span
+
+    def finish(self, state):
+        token, span = state
+        _restore(token)
+        if span is not None:
+            span['duration'] = time.time() - span['started']
+            span['queueWait'] = span['started'] - span['published'] if span['published'] is not None else None
+            try:
+                self.collector.record(span)
+            except:
+                logger.exception('Unable to record span %s', span)
+
+    @staticmethod
+    def fromConfig(config, collector=None):
+        if not config['tracing.enabled']:
+            return None
+        if config['tracing.collector'] == 'log':
+            collector = LogCollector()
+        elif config['tracing.collector'] == 'local':
+            collector = LocalCollector(config['tracing.maxSpans'])
+        return Tracer(config['tracing.sampleRate'], collector)
+
+
+class LocalCollector(object):
+    """Keeps the latest maxSpans spans in memory"""
+    def __init__(self, maxSpans=None):
+        self.spans = deque(maxlen=maxSpans or 10000)
+
+    def record(self, span):
+        self.spans.append(span)
+
+    def trace(self, traceID):
+        return sorted((span for span in list(self.spans) if span['traceID'] == traceID), key=lambda span: span['started'])
+
+    def criticalPath(self, traceID):
+        """Spans from the root of the trace to the span which finished last, each one the parent of the next"""
+        spans = self.trace(traceID)
+        if not spans:
+            return []
+        byID = dict((span['messageID'], span) for span in spans)
+        span = max(spans, key=lambda span: span['started'] + span['duration'])
+        path = [span]
+        while span['parentMessageID'] in byID:
+            span = byID[span['parentMessageID']]
+            path.append(span)
+        return list(reversed(path))
+
+
+class LogCollector(object):
+    """Prints every span as a JSON line, which CloudWatch Logs Insights can query"""
+    def __init__(self, write=None):
+        self.write = write or (lambda line: print(line))
+
+    def record(self, span):
+        self.write(json.dumps({'span': span}, separators=(',', ':')))
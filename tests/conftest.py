@@ -0,0 +1,8 @@
+import sys
+
+__author__ = 'Denis Mikhalkin'
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # asyncio-based context
+    collect_ignore.append('test_aio.py')
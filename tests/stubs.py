@@ -0,0 +1,128 @@
+__author__ = 'Denis Mikhalkin'
+
+"""
+In-memory stand-ins for the boto3 clients used by LambdaContext
+"""
+
+class StubKinesisClient(object):
+    def __init__(self, failures=None, errorCode='InternalFailure', shards=1):
+        # Maps partition key -> number of put_records attempts that should reject it with errorCode
+        self.failures = failures or dict()
+        self.errorCode = errorCode
+        self.calls = []
+        self.delivered = []
+        # Open shards splitting the hash key space evenly, listed two per page
+        size = 2 ** 128 // shards
+        self.shards = [{'ShardId': 'shardId-%012d' % index,
+                        'HashKeyRange': {'StartingHashKey': str(index * size),
+                                         'EndingHashKey': str(2 ** 128 - 1 if index == shards - 1 else (index + 1) * size - 1)},
+                        'SequenceNumberRange': {'StartingSequenceNumber': '0'}}
+                       for index in range(shards)]
+        self.listCalls = 0
+
+    def list_shards(self, StreamName=None, NextToken=None):
+        self.listCalls += 1
+        start = int(NextToken) if NextToken is not None else 0
+        response = {'Shards': self.shards[start:start + 2]}
+        if start + 2 < len(self.shards):
+            response['NextToken'] = str(start + 2)
+        return response
+
+    def put_records(self, StreamName, Records):
+        self.calls.append((StreamName, list(Records)))
+        results = []
+        for record in Records:
+            key = record['PartitionKey']
+            if self.failures.get(key, 0) > 0:
+                self.failures[key] -= 1
+                results.append({'ErrorCode': self.errorCode, 'ErrorMessage': 'stub'})
+            else:
+                self.delivered.append((StreamName, record))
+                results.append({'SequenceNumber': str(len(self.delivered)), 'ShardId': 'shardId-000000000000'})
+        return {'FailedRecordCount': len([r for r in results if 'ErrorCode' in r]), 'Records': results}
+
+
+class StubSQSClient(object):
+    def __init__(self, failures=None, senderFaults=None):
+        # Maps the (decoded) message data -> number of send_message_batch attempts that should fail it
+        self.failures = failures or dict()
+        # Data of the messages rejected as invalid
+        self.senderFaults = senderFaults or set()
+        self.calls = []
+        self.delivered = []
+        self.urlLookups = 0
+
+    def get_queue_url(self, QueueName):
+        self.urlLookups += 1
+        return {'QueueUrl': 'https://sqs.ap-southeast-2.amazonaws.com/1234567890/%s' % QueueName}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        import base64
+        self.calls.append((QueueUrl, list(Entries)))
+        successful, failed = [], []
+        for entry in Entries:
+            data = base64.b64decode(entry['MessageBody'])
+            if data in self.senderFaults:
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidParameterValue'})
+            elif self.failures.get(data, 0) > 0:
+                self.failures[data] -= 1
+                failed.append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError'})
+            else:
+                self.delivered.append((QueueUrl, entry))
+                successful.append({'Id': entry['Id'], 'MessageId': str(len(self.delivered))})
+        response = {'Successful': successful}
+        if failed:
+            response['Failed'] = failed
+        return response
+
+
+class StubTable(object):
+    def __init__(self, name='HopperRuntime'):
+        self.name = name
+        self.items = dict()
+        self.calls = []
+        self.meta = StubTableMeta(self)
+
+    def get_item(self, Key):
+        self.calls.append(('get_item', Key))
+        item = self.items.get(Key['Object'])
+        return {'Item': dict(item)} if item is not None else {}
+
+    def update_item(self, Key, AttributeUpdates=None, UpdateExpression=None, ExpressionAttributeValues=None, ReturnValues=None):
+        self.calls.append(('update_item', Key))
+        item = self.items.setdefault(Key['Object'], {'Object': Key['Object']})
+        for name, update in (AttributeUpdates or {}).items():
+            if update['Action'] == 'ADD':
+                item[name] = item.get(name, 0) + update['Value']
+            else:
+                item[name] = update['Value']
+        if UpdateExpression is not None and UpdateExpression.startswith('set '):
+            for assignment in UpdateExpression[4:].split(','):
+                name, value = [part.strip() for part in assignment.split('=')]
+                item[name] = ExpressionAttributeValues[value]
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': dict(item)}
+        return {}
+
+    def countCalls(self, name):
+        return len([call for call in self.calls if call[0] == name])
+
+
+class StubTableMeta(object):
+    def __init__(self, table):
+        self.client = StubDynamoDBClient(table)
+
+
+class StubDynamoDBClient(object):
+    def __init__(self, table):
+        self.table = table
+
+    def batch_get_item(self, RequestItems):
+        from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+        serializer, deserializer = TypeSerializer(), TypeDeserializer()
+        keys = RequestItems[self.table.name]['Keys']
+        self.table.calls.append(('batch_get_item', keys))
+        items = [self.table.items.get(deserializer.deserialize(key['Object'])) for key in keys]
+        return {'Responses': {self.table.name: [dict((name, serializer.serialize(value)) for name, value in item.items())
+                                                for item in items if item is not None]},
+                'UnprocessedKeys': {}}
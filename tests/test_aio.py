@@ -0,0 +1,202 @@
+import asyncio
+import time
+
+from hop import ContextConfig
+from hop.aio import AsyncLocalContext
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class AsyncLocalContextTest(unittest.TestCase):
+
+    def test_async_handlers_overlap(self):
+        context = AsyncLocalContext(maxInFlight=50)
+        received = []
+
+        @context.handle('download')
+        async def download(msg):
+            await asyncio.sleep(0.1)
+            received.append(msg['index'])
+
+        for i in range(50):
+            context.publish(context.message(messageType='download', index=i))
+        start = time.time()
+        context.run()
+        self.assertEqual(sorted(received), list(range(50)))
+        self.assertTrue(time.time() - start < 2)
+
+    def test_in_flight_limit(self):
+        context = AsyncLocalContext(maxInFlight=3)
+        active = [0, 0]
+
+        @context.handle('download')
+        async def download(msg):
+            active[0] += 1
+            active[1] = max(active[0], active[1])
+            await asyncio.sleep(0.01)
+            active[0] -= 1
+
+        for i in range(10):
+            context.publish(context.message(messageType='download'))
+        context.run()
+        self.assertEqual(active[1], 3)
+
+    def test_sync_callbacks_and_async_filters(self):
+        context = AsyncLocalContext()
+        received = []
+
+        @context.filter('pageUrl')
+        async def urlFilter(msg):
+            return msg if msg['url'] != 'skip' else None
+
+        @context.handle('pageBody')
+        def pageBody(msg):
+            time.sleep(0.01)
+            for url in ['a', 'skip', 'b']:
+                context.publish(context.message(messageType='pageUrl', url=url))
+
+        @context.handle('pageUrl')
+        async def pageUrl(msg):
+            await context.publishAsync(context.message(messageType='done', url=msg['url']))
+
+        @context.handle('done')
+        def done(msg):
+            received.append(msg['url'])
+
+        context.publish(context.message(messageType='pageBody'))
+        context.run()
+        self.assertEqual(sorted(received), ['a', 'b'])
+
+    def test_stop(self):
+        context = AsyncLocalContext(maxInFlight=1)
+        received = []
+
+        @context.handle('testMessage')
+        async def handler(msg):
+            received.append(msg)
+            context.stop()
+
+        for i in range(5):
+            context.publish(context.message(messageType='testMessage'))
+        context.run()
+        self.assertEqual(len(received), 1)
+
+    def test_tracing_parents_from_executor(self):
+        context = AsyncLocalContext()
+        context.trace()
+        received = dict()
+
+        @context.handle('pageView')
+        def pageView(msg):
+            received['pageView'] = msg
+            context.publish(context.message(messageType='enriched'))
+
+        @context.handle('enriched')
+        async def enriched(msg):
+            received['enriched'] = msg
+
+        context.publish(context.message(messageType='pageView'))
+        context.run()
+        self.assertEqual(received['enriched']['_system']['parentMessageID'], received['pageView']['_system']['messageID'])
+        self.assertEqual(len(context.tracer.collector.spans), 2)
+
+    def test_fork_join_on_parent_without_tracing(self):
+        context = AsyncLocalContext(ContextConfig({'dispatch': {'fanout': 'inline'}}))
+        groups = []
+
+        @context.handle('internalPageView')
+        def geoIPLookup(msg):
+            context.publish(context.message(messageType='enrichedPageView', country='AU'))
+
+        @context.handle('internalPageView')
+        async def resolveUserAgent(msg):
+            context.publish(context.message(messageType='enrichedPageView', deviceType='phone'))
+
+        @context.join('parentMessageID', message='enrichedPageView', minimumCount=2)
+        def collectPageViews(msgs):
+            groups.append(msgs.key)
+
+        msg = context.message(messageType='internalPageView')
+        context.publish(msg)
+        context.run()
+        self.assertEqual(groups, [msg['_system']['messageID']])
+
+    def test_async_join_callback(self):
+        context = AsyncLocalContext(ContextConfig({'metrics': {'enabled': True}}))
+        groups = []
+
+        @context.handle('internalPageView')
+        async def lookup(msg):
+            context.publish(context.message(messageType='enrichedPageView', country='AU'))
+            context.publish(context.message(messageType='enrichedPageView', deviceType='phone'))
+
+        @context.join('parentMessageID', message='enrichedPageView', minimumCount=2)
+        async def collectPageViews(msgs):
+            await asyncio.sleep(0)
+            groups.append((msgs['country'], msgs['deviceType']))
+
+        context.publish(context.message(messageType='internalPageView'))
+        context.run()
+        self.assertEqual(groups, [('AU', 'phone')])
+        self.assertEqual(context.stats()['callbacks']['enrichedPageView.collectPageViews']['calls'], 1)
+
+    def test_tracing_inline_siblings(self):
+        context = AsyncLocalContext(ContextConfig({'dispatch': {'fanout': 'inline'}}))
+        context.trace()
+        received = dict()
+
+        @context.handle('test')
+        async def first(msg):
+            received['original'] = msg
+
+        @context.handle('test')
+        def second(msg):
+            context.publish(context.message(messageType='child'))
+
+        @context.handle('child')
+        async def child(msg):
+            received['child'] = msg
+
+        context.publish(context.message(messageType='test'))
+        context.run()
+        self.assertEqual(received['child']['_system']['traceID'], received['original']['_system']['traceID'])
+        self.assertEqual(len(context.tracer.collector.spans), 3)
+
+    def test_bounded_queue_blocks_executor_publisher(self):
+        context = AsyncLocalContext(ContextConfig({'local': {'capacity': 5}}), maxInFlight=2)
+        depths = []
+        received = []
+
+        @context.handle('pageBody')
+        def pageBody(msg):
+            for i in range(50):
+                context.publish(context.message(messageType='pageUrl', index=i))
+                depths.append(len(context.queues))
+
+        @context.handle('pageUrl')
+        async def pageUrl(msg):
+            received.append(msg['index'])
+
+        context.publish(context.message(messageType='pageBody'))
+        context.run()
+        self.assertEqual(sorted(received), list(range(50)))
+        self.assertTrue(max(depths) <= 6, max(depths))
+
+    def test_failed_async_handler_is_retried(self):
+        context = AsyncLocalContext(ContextConfig({'retry': {'maxAttempts': 3, 'delay': 0.01}}))
+        attempts = []
+
+        @context.handle('pageUrl')
+        async def pageUrl(msg):
+            attempts.append(msg['url'])
+            raise ValueError('failed')
+
+        context.publish(context.message(messageType='pageUrl', url='a'))
+        context.run()
+        self.assertEqual(attempts, ['a', 'a', 'a'])
+        self.assertEqual(context.deadLetters[0]['_system']['attempts'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import subprocess
+from decimal import Decimal
+
+from hop import ContextConfig
+from hop.aws import Table, LazyClient, client
+from hop.dynamodb import RuntimeState, RequestCounter
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class RecordingDynamoDBClient(object):
+    """Low-level client answering with the response given for each operation"""
+    def __init__(self, responses=None):
+        self.responses = responses or dict()
+        self.calls = []
+
+    def __getattr__(self, operation):
+        def call(**kwargs):
+            self.calls.append((operation, kwargs))
+            return dict(self.responses.get(operation, {}))
+        return call
+
+
+class TableTest(unittest.TestCase):
+
+    def test_values_are_serialized_and_items_deserialized(self):
+        lowLevel = RecordingDynamoDBClient({'get_item': {'Item': {'Object': {'S': 'RuntimeState'}, 'RequestCounter': {'N': '5'}}}})
+        table = Table('HopperRuntime', client=lowLevel)
+        state = RuntimeState(table)
+        self.assertEqual(state.getRequestCount(), 5)
+        self.assertEqual(lowLevel.calls[0], ('get_item', {'TableName': 'HopperRuntime', 'Key': {'Object': {'S': 'RuntimeState'}}}))
+
+    def test_attribute_updates(self):
+        lowLevel = RecordingDynamoDBClient()
+        counter = RequestCounter(Table('HopperRuntime', client=lowLevel), RuntimeState(None))
+        counter.increment()
+        counter.flush()
+        operation, kwargs = lowLevel.calls[0]
+        self.assertEqual(operation, 'update_item')
+        self.assertEqual(kwargs['AttributeUpdates'], {'RequestCounter': {'Action': 'ADD', 'Value': {'N': '1'}}})
+
+    def test_update_expression_values_and_returned_attributes(self):
+        lowLevel = RecordingDynamoDBClient({'update_item': {'Attributes': {'Messages': {'L': [{'S': 'a'}]}, 'ExpiresAt': {'N': '0'}}}})
+        table = Table('HopperJoin', client=lowLevel)
+        response = table.update_item(Key={'Object': 'join'}, UpdateExpression='SET Messages = :msg',
+                                     ExpressionAttributeValues={':msg': ['a'], ':empty': []}, ReturnValues='ALL_NEW')
+        self.assertEqual(response['Attributes'], {'Messages': ['a'], 'ExpiresAt': Decimal(0)})
+        self.assertEqual(lowLevel.calls[0][1]['ExpressionAttributeValues'], {':msg': {'L': [{'S': 'a'}]}, ':empty': {'L': []}})
+        self.assertEqual(table.meta.client, lowLevel)
+
+
+class ClientsTest(unittest.TestCase):
+
+    def test_clients_are_shared(self):
+        self.assertTrue(client('kinesis', 'ap-southeast-2') is client('kinesis', 'ap-southeast-2'))
+
+    def test_lazy_client_is_created_on_first_call(self):
+        lazy = LazyClient('sqs', 'ap-southeast-2')
+        self.assertEqual(lazy.meta.region_name, 'ap-southeast-2')
+        self.assertTrue(lazy.get_queue_url.__self__ is client('sqs', 'ap-southeast-2'))
+
+    def test_importing_hop_does_not_load_yaml_or_botocore(self):
+        output = subprocess.check_output([sys.executable, '-c',
+                                          'import sys; import hop.kinesis, hop.sqs, hop.local; '
+                                          'print(sorted(name for name in ("yaml", "boto3", "botocore") if name in sys.modules))'],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.decode('ascii').strip(), '[]')
+
+    def test_config_sections_as_keywords(self):
+        config = ContextConfig(runtime={'autoStop': True}, aws={'region': 'ap-southeast-2'})
+        self.assertEqual((config['runtime.autoStop'], config['aws.region']), (True, 'ap-southeast-2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import base64
+import os
+import shutil
+import tempfile
+
+from hop import ContextConfig
+from hop.blobstore import LocalBlobStore, BlobMessage
+from hop.kinesis import LambdaContext
+from tests.stubs import StubKinesisClient, StubTable
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class CountingBlobStore(LocalBlobStore):
+    def __init__(self, directory):
+        LocalBlobStore.__init__(self, directory)
+        self.reads = 0
+
+    def get(self, key):
+        self.reads += 1
+        return LocalBlobStore.get(self, key)
+
+
+class ClaimCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = CountingBlobStore(self.directory)
+        self.body = u'<html>' + u'x' * 5000 + u'</html>'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def createContext(self):
+        config = ContextConfig({'claimCheck': {'threshold': 1000}, 'queues': {'default': {'stream': 'HopperQueue'}},
+                                'publish': {'retryDelay': 0}})
+        return LambdaContext(config, kinesisClient=StubKinesisClient(), table=StubTable(), blobStore=self.store)
+
+    def deliver(self, producer, consumer):
+        """Feeds the records published by the producer to the consumer"""
+        records = [{'kinesis': {'data': base64.b64encode(record['Data']).decode('ascii'),
+                                'sequenceNumber': str(index), 'partitionKey': record['PartitionKey']}}
+                   for index, (stream, record) in enumerate(producer.kinesisClient.delivered)]
+        del producer.kinesisClient.delivered[:]
+        return consumer.lambda_handler({'Records': records}, None)
+
+    def blobs(self):
+        return [name for name in os.listdir(self.directory) if '.ref.' not in name]
+
+    def test_large_field_is_offloaded_and_loaded_on_access(self):
+        producer, consumer = self.createContext(), self.createContext()
+        received = []
+
+        @consumer.handle('pageBody')
+        def pageBody(msg):
+            self.assertTrue(isinstance(msg, BlobMessage))
+            self.assertTrue('body' in msg)
+            self.assertEqual(self.store.reads, 0)
+            received.append(msg['body'])
+            received.append(msg.get('body'))
+
+        producer.publish(producer.message(messageType='pageBody', body=self.body, url='http://abc.com'))
+        producer.flush()
+        data = producer.kinesisClient.delivered[0][1]['Data']
+        self.assertTrue(len(data) < 1000)
+        self.assertEqual(len(self.blobs()), 1)
+
+        self.deliver(producer, consumer)
+        self.assertEqual(received, [self.body, self.body])
+        self.assertEqual(self.store.reads, 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_unread_field_is_not_loaded(self):
+        producer, consumer = self.createContext(), self.createContext()
+
+        @consumer.handle('pageBody')
+        def pageBody(msg):
+            self.assertEqual(msg['url'], 'http://abc.com')
+
+        producer.publish(producer.message(messageType='pageBody', body=self.body, url='http://abc.com'))
+        producer.flush()
+        self.deliver(producer, consumer)
+        self.assertEqual(self.store.reads, 0)
+
+    def test_blob_kept_until_last_consumer(self):
+        producer, consumer = self.createContext(), self.createContext()
+        received = []
+
+        @consumer.handle('pageBody')
+        def pageBody(msg):
+            if msg['hops'] < 2:
+                newMsg = msg.clone()
+                newMsg['hops'] = msg['hops'] + 1
+                consumer.publish(newMsg)
+            else:
+                received.append(msg['body'])
+
+        producer.publish(producer.message(messageType='pageBody', body=self.body, hops=0))
+        producer.flush()
+        for hop in range(2):
+            self.deliver(producer if hop == 0 else consumer, consumer)
+            self.assertEqual(len(self.blobs()), 1)
+            self.assertEqual(len(consumer.kinesisClient.delivered), 1)
+            self.assertTrue(len(consumer.kinesisClient.delivered[0][1]['Data']) < 1000)
+        self.deliver(consumer, consumer)
+        self.assertEqual(received, [self.body])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_blob_kept_until_published_messages_delivered(self):
+        producer, consumer = self.createContext(), self.createContext()
+        received = []
+
+        @consumer.handle('pageBody')
+        def pageBody(msg):
+            received.append(msg['body'])
+            consumer.publish(consumer.message(messageType='pageUrl', url='http://abc.com/next'))
+
+        producer.publish(producer.message(messageType='pageBody', body=self.body))
+        producer.flush()
+        delivered = list(producer.kinesisClient.delivered)
+        consumer.kinesisClient.put_records = lambda StreamName, Records: {
+            'FailedRecordCount': len(Records), 'Records': [{'ErrorCode': 'InternalFailure'} for record in Records]}
+        self.assertTrue(self.deliver(producer, consumer)['batchItemFailures'])
+        self.assertEqual(len(self.blobs()), 1)
+        # Delivered again, the body can still be loaded
+        del consumer.kinesisClient.put_records
+        producer.kinesisClient.delivered.extend(delivered)
+        self.assertIsNone(self.deliver(producer, consumer))
+        self.assertEqual(received, [self.body, self.body])
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
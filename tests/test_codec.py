@@ -0,0 +1,62 @@
+from hop import ContextConfig, Message
+from hop.codec import Codec, decode
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+def available(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+class CodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.msg = Message('pageBody', {'body': u'<html>' + u'text ' * 1000 + u'</html>'})
+
+    def assertRoundTrip(self, codec):
+        loaded = decode(codec.encode(self.msg))
+        self.assertEqual(loaded['body'], self.msg['body'])
+        self.assertEqual(loaded['_system']['messageID'], self.msg['_system']['messageID'])
+
+    def test_json(self):
+        self.assertRoundTrip(Codec())
+
+    def test_zlib_above_threshold(self):
+        codec = Codec('json', 'zlib', compressAbove=1024)
+        encoded = codec.encode(self.msg)
+        self.assertTrue(len(encoded) < len(Codec().encode(self.msg)) / 10)
+        self.assertRoundTrip(codec)
+
+    def test_not_compressed_below_threshold(self):
+        codec = Codec('json', 'zlib', compressAbove=1000000)
+        self.assertEqual(codec.encode(self.msg), Codec().encode(self.msg))
+        self.assertRoundTrip(codec)
+
+    def test_plain_json_records(self):
+        self.assertEqual(decode(b'{"messageType": "pageUrl", "url": "http://abc.com"}')['url'], 'http://abc.com')
+
+    @unittest.skipUnless(available('msgpack'), 'msgpack is not installed')
+    def test_msgpack(self):
+        self.assertRoundTrip(Codec('msgpack'))
+        self.assertRoundTrip(Codec('msgpack', 'zlib'))
+
+    @unittest.skipUnless(available('lz4'), 'lz4 is not installed')
+    def test_lz4(self):
+        self.assertRoundTrip(Codec('json', 'lz4'))
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, Codec, 'xml')
+
+    def test_for_queue(self):
+        config = ContextConfig({'queues': {'default': {'codec': 'json', 'compression': 'zlib', 'compressAbove': 10}}})
+        codec = Codec.forQueue(config, 'default')
+        self.assertEqual((codec.format, codec.compression, codec.compressAbove), ('json', 'zlib', 10))
+        self.assertEqual(Codec.forQueue(config, 'priority').compression, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 import sys
 sys.path.append('e:\\WS\\Hopper')
 
+from hop import ContextConfig
 from hop.local import LocalContext
 
 __author__ = 'Denis Mikhalkin'
@@ -70,7 +71,101 @@ class ContextTest(unittest.TestCase):
         self.context.publish(self.context.message(messageType='testMessage'))
         self.context.run()
         self.assertTrue(passed[0])
-                   
+
+    def test_filter_order(self):
+        called = []
+
+        @self.context.filter('testMessage')
+        def unordered(msg):
+            called.append('unordered')
+            return msg
+
+        @self.context.filter('testMessage', 2)
+        def second(msg):
+            called.append('second')
+            return msg
+
+        @self.context.filter('testMessage', 1)
+        def first(msg):
+            called.append('first')
+            return msg
+
+        self.context.publish(self.context.message(messageType='testMessage'))
+        self.context.run()
+        self.assertEqual(called, ['first', 'second', 'unordered'])
+
+    def test_each_handler_receives_message_once(self):
+        called = []
+
+        @self.context.handle('testMessage')
+        def first(msg):
+            called.append('first')
+
+        @self.context.handle('testMessage')
+        def second(msg):
+            called.append('second')
+
+        self.context.publish(self.context.message(messageType='testMessage'))
+        self.context.run()
+        self.assertEqual(sorted(called), ['first', 'second'])
+
+    def test_rules_registered_after_dispatch(self):
+        called = []
+
+        @self.context.handle('testMessage')
+        def first(msg):
+            called.append('first')
+
+        self.context.publish(self.context.message(messageType='testMessage'))
+        self.context.run()
+
+        @self.context.filter('testMessage')
+        def dropAll(msg):
+            return None
+
+        self.context.publish(self.context.message(messageType='testMessage'))
+        self.context.run()
+        self.assertEqual(called, ['first'])
+
+
+class FanoutTest(unittest.TestCase):
+
+    def createContext(self, fanout):
+        context = LocalContext(ContextConfig({'dispatch': {'fanout': fanout}}))
+        called = []
+
+        @context.handle('testMessage')
+        def first(msg):
+            called.append(('first', msg['value']))
+
+        @context.handle('testMessage')
+        def second(msg):
+            called.append(('second', msg['value']))
+            msg['value'] = 'changed'
+
+        @context.handle('testMessage', isolated=True)
+        def heavy(msg):
+            called.append(('heavy', msg['value']))
+
+        context.publish(context.message(messageType='testMessage', value=1))
+        context.run()
+        return context, called
+
+    def test_queue_fanout(self):
+        context, called = self.createContext('queue')
+        self.assertEqual(sorted(called), [('first', 1), ('heavy', 1), ('second', 1)])
+        self.assertEqual(context.requestCount, 3)
+
+    def test_inline_fanout_queues_only_isolated_handlers(self):
+        context, called = self.createContext('inline')
+        self.assertEqual(called, [('first', 1), ('second', 1), ('heavy', 1)])
+        self.assertEqual(context.requestCount, 2)
+
+    def test_pool_fanout(self):
+        context, called = self.createContext('pool')
+        self.assertEqual(sorted(called), [('first', 1), ('heavy', 1), ('second', 1)])
+        self.assertEqual(context.requestCount, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
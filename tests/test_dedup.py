@@ -0,0 +1,188 @@
+import time
+
+from hop import ContextConfig, Message
+from hop.dedup import SeenCache, BloomFilter, DynamoDBSeenStore, Deduplicator
+from hop.kinesis import LambdaContext
+from hop.local import LocalContext
+from hop.metrics import prometheusText
+from tests.stubs import StubKinesisClient, StubTable
+from tests.test_kinesis import kinesisEvent, StubLambdaContext
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class SeenCacheTest(unittest.TestCase):
+
+    def test_evictsLeastRecentlySeen(self):
+        cache = SeenCache(maxSize=2)
+        cache.add('a')
+        cache.add('b')
+        self.assertTrue('a' in cache)
+        cache.add('c')
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.evicted, 1)
+
+    def test_expires(self):
+        cache = SeenCache(ttl=0.05)
+        cache.add('a')
+        self.assertTrue('a' in cache)
+        time.sleep(0.1)
+        self.assertFalse('a' in cache)
+        self.assertEqual(len(cache), 0)
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_noFalseNegatives(self):
+        bloom = BloomFilter(capacity=1000, errorRate=0.01)
+        for i in range(1000):
+            bloom.add('key%d' % i)
+        self.assertTrue(all('key%d' % i in bloom for i in range(1000)))
+        falsePositives = len([i for i in range(1000, 11000) if 'key%d' % i in bloom])
+        self.assertTrue(falsePositives < 300, falsePositives)
+
+    def test_clearedAtCapacity(self):
+        bloom = BloomFilter(capacity=10)
+        for i in range(11):
+            bloom.add(i)
+        self.assertTrue(10 in bloom)
+        self.assertEqual(bloom.count, 1)
+
+
+class DeduplicatorTest(unittest.TestCase):
+
+    def test_skipsRepeatedMessageID(self):
+        context = LocalContext()
+        context.deduplicate()
+        handled = []
+        context.handle('test')(lambda msg: handled.append(msg['value']))
+        msg = context.message(messageType='test', value=1)
+        context.publish(msg)
+        context.publish(msg)
+        context.publish(context.message(messageType='test', value=2))
+        context.run()
+        self.assertEqual(handled, [1, 2])
+        self.assertEqual((context.dedup.hits, context.dedup.misses), (1, 2))
+        self.assertAlmostEqual(context.dedup.hitRate(), 1 / 3.0)
+
+    def test_hitsAndMissesInStats(self):
+        context = LocalContext(ContextConfig({'dedup': {'enabled': True}, 'metrics': {'enabled': True}}))
+        context.handle('test')(lambda msg: None)
+        msg = context.message(messageType='test')
+        for i in range(3):
+            context.publish(msg)
+        context.run()
+        stats = context.stats()
+        self.assertEqual((stats['dedupHits'], stats['dedupMisses']), ({'test': 2}, {'test': 1}))
+        text = prometheusText(stats)
+        self.assertIn('hopper_dedup_hits_total{messageType="test"} 2', text)
+        self.assertIn('hopper_dedup_misses_total{messageType="test"} 1', text)
+
+    def test_keyFunction(self):
+        context = LocalContext()
+        context.deduplicate(key=lambda msg: msg.get('url'))
+        handled = []
+        context.handle('pageUrl')(lambda msg: handled.append(msg['url']))
+        for url in ['http://a', 'http://b', 'http://a']:
+            context.publish(context.message(messageType='pageUrl', url=url))
+        context.publish({'messageType': 'pageUrl'})
+        context.run()
+        self.assertEqual(handled, ['http://a', 'http://b'])
+
+    def test_filteredMessageIsSeen(self):
+        context = LocalContext()
+        context.deduplicate()
+        calls = []
+        context.filter('test')(lambda msg: calls.append(msg) or None)
+        msg = context.message(messageType='test')
+        context.publish(msg)
+        context.publish(msg)
+        context.run()
+        self.assertEqual(len(calls), 1)
+
+    def test_fanoutCopiesAreNotDuplicates(self):
+        context = LocalContext()
+        context.deduplicate()
+        handled = []
+
+        @context.handle('test')
+        def first(msg):
+            handled.append('first')
+
+        @context.handle('test')
+        def second(msg):
+            handled.append('second')
+
+        context.publish(context.message(messageType='test'))
+        context.run()
+        self.assertEqual(sorted(handled), ['first', 'second'])
+
+    def test_bloomSkipsBackendForNewKeys(self):
+        backend = DynamoDBSeenStore(StubTable())
+        dedup = Deduplicator(maxSize=1, bloom=BloomFilter(1000), backend=backend)
+        first, second = Message('test', None), Message('test', None)
+        self.assertFalse(dedup.seen(first))
+        dedup.markSeen(first)
+        dedup.markSeen(second)
+        self.assertEqual(dedup.backendReads, 0)
+        # first left the cache, so the backend confirms it
+        self.assertTrue(dedup.seen(first))
+        self.assertEqual(dedup.backendReads, 1)
+        self.assertFalse(dedup.seen(Message('test', None)))
+        self.assertEqual(dedup.backendReads, 1)
+
+    def test_fromConfig(self):
+        self.assertEqual(Deduplicator.fromConfig(ContextConfig()), None)
+        dedup = Deduplicator.fromConfig(ContextConfig({'dedup': {'enabled': True, 'ttl': '1m', 'bloomCapacity': 100}}))
+        self.assertEqual(dedup.cache.ttl, 60)
+        self.assertEqual(dedup.bloom.capacity, 100)
+        self.assertEqual(LocalContext(ContextConfig({'dedup': {'enabled': True}})).dedup.cache.maxSize, 10000)
+
+
+class LambdaDedupTest(unittest.TestCase):
+
+    def test_retriedBatchSkipsProcessedRecords(self):
+        table = StubTable()
+        config = ContextConfig({'dedup': {'enabled': True}, 'queues': {'default': {'stream': 'HopperQueue'}}})
+        context = LambdaContext(config, kinesisClient=StubKinesisClient(), table=table)
+        context.dedup.backend = DynamoDBSeenStore(table)
+        handled = []
+        context.handle('test')(lambda msg: handled.append(msg['value']))
+        msgs = [Message('test', {'value': value}) for value in range(3)]
+        context.lambda_handler(kinesisEvent(*msgs[:2]), StubLambdaContext())
+        # Another invocation (new in-memory cache) receives the whole batch again
+        retry = LambdaContext(config, kinesisClient=StubKinesisClient(), table=table)
+        retry.dedup.backend = DynamoDBSeenStore(table)
+        retry.handle('test')(lambda msg: handled.append(msg['value']))
+        retry.lambda_handler(kinesisEvent(*msgs), StubLambdaContext())
+        self.assertEqual(handled, [0, 1, 2])
+
+    def test_undeliveredBatchIsNotSeen(self):
+        class RejectingClient(StubKinesisClient):
+            rejecting = True
+            def put_records(self, StreamName, Records):
+                if not self.rejecting:
+                    return StubKinesisClient.put_records(self, StreamName, Records)
+                return {'FailedRecordCount': len(Records),
+                        'Records': [{'ErrorCode': 'InternalFailure', 'ErrorMessage': 'stub'} for record in Records]}
+
+        client = RejectingClient()
+        config = ContextConfig({'dedup': {'enabled': True}, 'queues': {'default': {'stream': 'HopperQueue'}},
+                                'publish': {'retryDelay': 0}})
+        context = LambdaContext(config, kinesisClient=client, table=StubTable())
+        handled = []
+        def publishChild(msg):
+            handled.append(msg['value'])
+            context.publish(Message('child', {'value': msg['value']}))
+        context.handle('test')(publishChild)
+        event = kinesisEvent(*[Message('test', {'value': value}) for value in range(2)])
+        self.assertEqual(len(context.lambda_handler(event, StubLambdaContext())['batchItemFailures']), 2)
+        # The children were lost, so the redelivered batch is processed again
+        client.rejecting = False
+        self.assertIsNone(context.lambda_handler(event, StubLambdaContext()))
+        self.assertEqual(handled, [0, 1, 0, 1])
+        self.assertEqual(len(client.delivered), 2)
+        self.assertIsNone(context.lambda_handler(event, StubLambdaContext()))
+        self.assertEqual(handled, [0, 1, 0, 1])
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+
+from hop import ContextConfig
+from hop.local import LocalContext
+from hop.durable import DurableQueues, Segment
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class DurableQueuesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def popDone(self, queues, count):
+        msgs = []
+        for i in range(count):
+            msg = queues.pop()
+            if msg is None:
+                break
+            queues.done(msg)
+            msgs.append(msg)
+        return msgs
+
+    def test_lowest_level_first_fifo_within_level(self):
+        queues = DurableQueues(self.directory)
+        for priority, index in [(2, 'c'), (0, 'a'), (2, 'd'), (1, 'b')]:
+            queues.push(priority, {'index': index})
+        self.assertEqual((len(queues), queues.depth(2)), (4, 2))
+        self.assertEqual([msg['index'] for msg in self.popDone(queues, 5)], ['a', 'b', 'c', 'd'])
+        self.assertEqual(len(queues), 0)
+        queues.close()
+
+    def test_resumes_after_crash_from_checkpoint(self):
+        queues = DurableQueues(self.directory, checkpointEvery=2)
+        for i in range(10):
+            queues.push(1, {'index': i})
+        self.popDone(queues, 5)
+        # Popped but not processed when the process died
+        queues.pop()
+        # No close, as after a crash
+        resumed = DurableQueues(self.directory)
+        self.assertEqual(len(resumed), 6)
+        self.assertEqual([msg['index'] for msg in self.popDone(resumed, 10)], [4, 5, 6, 7, 8, 9])
+        resumed.close()
+
+    def test_close_keeps_pending_messages(self):
+        queues = DurableQueues(self.directory)
+        for i in range(3):
+            queues.push(0, {'index': i})
+        first, second = queues.pop(), queues.pop()
+        queues.done(second)
+        queues.close()
+        resumed = DurableQueues(self.directory)
+        self.assertEqual([msg['index'] for msg in self.popDone(resumed, 10)], [0, 1, 2])
+        resumed.close()
+
+    def test_segments_roll_over_and_consumed_ones_are_removed(self):
+        queues = DurableQueues(self.directory, segmentSize=256, checkpointEvery=10)
+        for i in range(100):
+            queues.push(1, {'index': i, 'body': 'x' * 20})
+        levelDirectory = os.path.join(self.directory, '1')
+        segments = [name for name in os.listdir(levelDirectory) if name.endswith('.log')]
+        self.assertTrue(len(segments) > 10)
+        self.assertEqual([msg['index'] for msg in self.popDone(queues, 100)], list(range(100)))
+        queues.checkpoint()
+        self.assertEqual(len([name for name in os.listdir(levelDirectory) if name.endswith('.log')]), 1)
+        queues.push(1, {'index': 100})
+        queues.close()
+        resumed = DurableQueues(self.directory, segmentSize=256)
+        self.assertEqual([msg['index'] for msg in self.popDone(resumed, 10)], [100])
+        resumed.close()
+
+    def test_message_larger_than_segment(self):
+        queues = DurableQueues(self.directory, segmentSize=64)
+        queues.push(1, {'body': 'y' * 1000})
+        queues.push(1, {'body': 'z'})
+        self.assertEqual([msg['body'][0] for msg in self.popDone(queues, 3)], ['y', 'z'])
+        queues.close()
+
+    def test_torn_record_ends_segment(self):
+        path = os.path.join(self.directory, 'segment.log')
+        segment = Segment(path, 0, 1024)
+        segment.append(b'first')
+        segment.append(b'second')
+        # Header of a record whose payload never made it to disk
+        segment.map[segment.end:segment.end + 8] = b'\x05\x00\x00\x00\x01\x02\x03\x04'
+        segment.close()
+        reopened = Segment(path, 0)
+        reopened.scan()
+        self.assertEqual(reopened.count, 2)
+        self.assertEqual(reopened.read(0)[0], b'first')
+        reopened.close()
+
+
+class DurableLocalContextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = ContextConfig({'local': {'durable': {'directory': self.directory, 'checkpointEvery': 1}}})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stopped_run_resumes(self):
+        received = []
+        context = LocalContext(self.config)
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            received.append(msg['url'])
+            if len(received) == 3:
+                context.stop()
+
+        for i in range(5):
+            context.publish(context.message(messageType='pageUrl', url=i))
+        context.run()
+        context.queues.close()
+        self.assertEqual(received, [0, 1, 2])
+
+        resumed = LocalContext(self.config)
+        resumed.handle('pageUrl')(lambda msg: received.append(msg['url']))
+        resumed.run()
+        self.assertEqual(received, [0, 1, 2, 3, 4])
+        self.assertEqual(len(resumed.queues), 0)
+
+    def test_stopped_run_checkpoints(self):
+        config = ContextConfig({'local': {'durable': {'directory': self.directory, 'checkpointEvery': 1000}}})
+        received = []
+        context = LocalContext(config)
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            received.append(msg['url'])
+            if len(received) == 3:
+                context.stop()
+
+        for i in range(5):
+            context.publish(context.message(messageType='pageUrl', url=i))
+        context.run()
+        # Restarted without closing the queues, as after the process was killed
+        resumed = LocalContext(config)
+        resumed.handle('pageUrl')(lambda msg: received.append(msg['url']))
+        resumed.run()
+        self.assertEqual(received, [0, 1, 2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
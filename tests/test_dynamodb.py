@@ -0,0 +1,131 @@
+from hop import ContextConfig
+from hop.dynamodb import RuntimeState, RequestCounter
+from hop.kinesis import LambdaContext
+from tests.stubs import StubKinesisClient, StubTable
+from tests.test_kinesis import kinesisEvent
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class RuntimeStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = StubTable()
+        self.table.items['RuntimeState'] = {'Object': 'RuntimeState', 'RequestCounter': 5, 'Terminated': False}
+
+    def test_reads_once_per_lease(self):
+        state = RuntimeState(self.table, ttl=60)
+        for i in range(10):
+            self.assertFalse(state.isTerminated())
+            self.assertEqual(state.getRequestCount(), 5)
+        self.assertEqual(self.table.countCalls('get_item'), 1)
+        self.assertEqual(state.savedReads, 19)
+
+    def test_rereads_after_lease_expires(self):
+        state = RuntimeState(self.table, ttl=0)
+        state.isTerminated()
+        self.table.items['RuntimeState']['Terminated'] = True
+        self.assertTrue(state.isTerminated())
+        self.assertEqual(self.table.countCalls('get_item'), 2)
+
+    def test_missing_item(self):
+        state = RuntimeState(StubTable())
+        self.assertFalse(state.isTerminated())
+        self.assertEqual(state.getRequestCount(), 0)
+
+
+class RequestCounterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = StubTable()
+        self.state = RuntimeState(self.table, ttl=60)
+
+    def test_batches_increments_until_flush(self):
+        counter = RequestCounter(self.table, self.state)
+        for i in range(10):
+            counter.increment()
+        self.assertEqual(counter.getRequestCount(), 10)
+        self.assertEqual(self.table.countCalls('update_item'), 0)
+        counter.flush()
+        counter.flush()
+        self.assertEqual(self.table.countCalls('update_item'), 1)
+        self.assertEqual(self.table.items['RuntimeState']['RequestCounter'], 10)
+        self.assertEqual(counter.getRequestCount(), 10)
+
+    def test_reserves_blocks(self):
+        counter = RequestCounter(self.table, self.state, blockSize=4)
+        for i in range(5):
+            counter.increment()
+        counter.flush()
+        self.assertEqual(self.table.countCalls('update_item'), 2)
+        self.assertEqual(self.table.items['RuntimeState']['RequestCounter'], 8)
+        self.assertEqual(counter.getRequestCount(), 5)
+
+    def test_sharded_counter(self):
+        state = RuntimeState(self.table, ttl=0, shards=4)
+        counter = RequestCounter(self.table, state, shards=4)
+        for batch in range(20):
+            counter.increment()
+            counter.flush()
+        self.assertNotIn('RuntimeState', self.table.items)
+        self.assertTrue(len(self.table.items) > 1)
+        self.assertEqual(state.getRequestCount(), 20)
+        self.assertEqual(self.table.countCalls('get_item'), 0)
+
+
+class LambdaContextRuntimeStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = StubTable()
+        config = ContextConfig({'runtime': {'autoStop': True, 'autoStopLimit': 3, 'stateTTL': 60},
+                                'queues': {'default': {'stream': 'HopperQueue'}}})
+        self.context = LambdaContext(config, kinesisClient=StubKinesisClient(), table=self.table)
+
+    def test_one_read_per_batch(self):
+        received = []
+
+        @self.context.handle('testMessage')
+        def handler(msg):
+            received.append(msg)
+
+        @self.context.filter('testMessage')
+        def nopFilter(msg):
+            return msg
+
+        self.context.lambda_handler(kinesisEvent(self.context.message(messageType='testMessage'),
+                                                 self.context.message(messageType='testMessage')), None)
+        self.assertEqual(len(received), 2)
+        self.assertEqual(self.table.countCalls('get_item'), 1)
+        self.assertTrue(self.context.runtimeState.savedReads > 0)
+
+    def test_auto_stop_uses_cached_count(self):
+        received = []
+
+        @self.context.handle('testMessage')
+        def handler(msg):
+            received.append(msg)
+
+        msgs = [self.context.message(messageType='testMessage') for i in range(5)]
+        self.context.lambda_handler(kinesisEvent(*msgs), None)
+        self.assertEqual(len(received), 3)
+        self.assertEqual(self.table.countCalls('get_item'), 1)
+        self.assertEqual(self.table.countCalls('update_item'), 1)
+        self.assertEqual(self.table.items['RuntimeState']['RequestCounter'], 5)
+
+    def test_stop_is_seen_without_reading(self):
+        received = []
+
+        @self.context.handle('testMessage')
+        def handler(msg):
+            received.append(msg)
+            self.context.stop()
+
+        msgs = [self.context.message(messageType='testMessage') for i in range(3)]
+        self.context.lambda_handler(kinesisEvent(*msgs), None)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(self.table.items['RuntimeState']['Terminated'], True)
+
+
+if __name__ == '__main__':
+    unittest.main()
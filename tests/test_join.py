@@ -0,0 +1,190 @@
+import time
+
+from hop import ContextConfig
+from hop.join import parseDuration, JoinRule, MessageGroup, MemoryJoinStore, DynamoDBJoinStore
+from hop.local import LocalContext
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class StubJoinTable(object):
+    """Understands the list_append update issued by DynamoDBJoinStore"""
+    def __init__(self):
+        self.items = dict()
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues):
+        item = self.items.setdefault(Key['Object'], {'Object': Key['Object']})
+        item['Messages'] = item.get('Messages', ExpressionAttributeValues[':empty']) + ExpressionAttributeValues[':msg']
+        item.setdefault('ExpiresAt', ExpressionAttributeValues[':expires'])
+        return {'Attributes': dict(item)}
+
+    def delete_item(self, Key):
+        self.items.pop(Key['Object'], None)
+
+
+class JoinTest(unittest.TestCase):
+
+    def test_parseDuration(self):
+        self.assertEqual(parseDuration('500ms'), 0.5)
+        self.assertEqual(parseDuration('5s'), 5)
+        self.assertEqual(parseDuration('2m'), 120)
+        self.assertEqual(parseDuration(3), 3)
+        self.assertEqual(parseDuration(None), None)
+        self.assertRaises(ValueError, parseDuration, 'soon')
+
+    def test_joinFiresAtMinimumCount(self):
+        context = LocalContext()
+        groups = []
+
+        @context.join('parent', message='enriched', minimumCount=2)
+        def merge(msgs):
+            groups.append(list(msgs))
+
+        context.publish({'messageType': 'enriched', 'parent': 'a', 'ua': 'firefox'})
+        context.publish({'messageType': 'enriched', 'parent': 'b', 'geo': 'AU'})
+        context.publish({'messageType': 'enriched', 'parent': 'a', 'geo': 'US'})
+        context.publish({'messageType': 'enriched', 'geo': 'none'})
+        context.run()
+
+        self.assertEqual(len(groups), 1)
+        self.assertEqual([msg.get('ua', msg.get('geo')) for msg in groups[0]], ['firefox', 'US'])
+
+    def test_forgetDiscardsGroup(self):
+        context = LocalContext()
+        merged = []
+
+        @context.join('parent', message='enriched', minimumCount=2)
+        def merge(msgs):
+            if msgs.checkFieldsInMessages('ua', 'geo'):
+                merged.append({'ua': msgs['ua'], 'geo': msgs['geo']})
+                context.forget(msgs)
+
+        for field, value in [('ua', 'firefox'), ('geo', 'US'), ('ua', 'chrome')]:
+            context.publish({'messageType': 'enriched', 'parent': 'a', field: value})
+        context.run()
+
+        self.assertEqual(merged, [{'ua': 'firefox', 'geo': 'US'}])
+        self.assertEqual(len(context.joinStore), 1)
+        context.publish({'messageType': 'enriched', 'parent': 'a', 'geo': 'AU'})
+        context.run()
+        self.assertEqual(merged[1], {'ua': 'chrome', 'geo': 'AU'})
+
+    def test_handlersStillReceiveJoinedType(self):
+        context = LocalContext()
+        handled = []
+        context.join('parent', message='enriched')(lambda msgs: None)
+        context.handle('enriched')(lambda msg: handled.append(msg['parent']))
+        context.publish({'messageType': 'enriched', 'parent': 'a'})
+        context.run()
+        self.assertEqual(handled, ['a'])
+
+    def forkJoin(self, fanout):
+        context = LocalContext(ContextConfig({'dispatch': {'fanout': fanout}}))
+        groups = []
+
+        @context.handle('internalPageView')
+        def geoIPLookup(msg):
+            context.publish(context.message(messageType='enrichedPageView', country='AU'))
+
+        @context.handle('internalPageView')
+        def resolveUserAgent(msg):
+            context.publish(context.message(messageType='enrichedPageView', deviceType='phone'))
+
+        @context.join('parentMessageID', message='enrichedPageView', minimumCount=2)
+        def collectPageViews(msgs):
+            groups.append(msgs.key)
+
+        msg = context.message(messageType='internalPageView')
+        context.publish(msg)
+        context.run()
+        self.assertEqual(groups, [msg['_system']['messageID']])
+
+    def test_forkJoinOnParentWithQueueFanout(self):
+        self.forkJoin('queue')
+
+    def test_forkJoinOnParentWithInlineFanout(self):
+        self.forkJoin('inline')
+
+    def test_forkJoinOnParentWithPoolFanout(self):
+        self.forkJoin('pool')
+
+    def test_systemFieldCondition(self):
+        rule = JoinRule(lambda msgs: None, 'enriched', 'messageID')
+        msg = {'messageType': 'enriched', '_system': {'messageID': 'm1'}}
+        self.assertEqual(rule.key(msg), 'm1')
+        self.assertEqual(rule.key({'messageType': 'enriched'}), None)
+
+    def test_messageGroup(self):
+        group = MessageGroup(None, 'a', [{'ua': 'firefox', 'geo': 'AU'}, {'geo': 'US'}])
+        self.assertEqual(group['geo'], 'US')
+        self.assertEqual(group[0]['geo'], 'AU')
+        self.assertTrue('ua' in group)
+        self.assertTrue(group.checkFieldsInMessages('ua', 'geo'))
+        self.assertFalse(group.checkFieldsInMessages('ua', 'referrer'))
+        self.assertRaises(KeyError, lambda: group['referrer'])
+
+
+class MemoryJoinStoreTest(unittest.TestCase):
+
+    def test_discardWindow(self):
+        store = MemoryJoinStore()
+        rule = JoinRule(lambda msgs: None, 'enriched', 'parent', discard='50ms')
+        store.add(rule, 'a', {'parent': 'a'})
+        self.assertEqual(len(store.add(rule, 'a', {'parent': 'a'})), 2)
+        time.sleep(0.1)
+        self.assertEqual(len(store.add(rule, 'b', {'parent': 'b'})), 1)
+        self.assertEqual(store.evicted, 1)
+        self.assertEqual(len(store.add(rule, 'a', {'parent': 'a'})), 1)
+
+    def test_evictsOldestGroupOverMessageLimit(self):
+        store = MemoryJoinStore(maxMessages=3)
+        first = JoinRule(lambda msgs: None, 'enriched', 'parent')
+        second = JoinRule(lambda msgs: None, 'clicked', 'parent')
+        store.add(first, 'a', {'parent': 'a'})
+        store.add(second, 'b', {'parent': 'b'})
+        store.add(first, 'c', {'parent': 'c'})
+        store.add(second, 'd', {'parent': 'd'})
+        self.assertEqual(store.evicted, 1)
+        self.assertEqual(store.messages, 3)
+        self.assertEqual(len(store.add(first, 'a', {'parent': 'a'})), 1)
+
+    def test_evictsOverByteLimit(self):
+        store = MemoryJoinStore(maxBytes=1000)
+        rule = JoinRule(lambda msgs: None, 'enriched', 'parent')
+        for key in range(10):
+            store.add(rule, key, {'parent': key, 'body': 'x' * 300})
+        self.assertTrue(store.bytes <= 1000)
+        self.assertEqual(len(store), 2)
+        # A single group larger than the limit is kept
+        self.assertEqual(len(store.add(rule, 'big', {'body': 'x' * 2000})), 1)
+        self.assertEqual(len(store), 1)
+
+
+class DynamoDBJoinStoreTest(unittest.TestCase):
+
+    def test_addAndForget(self):
+        table = StubJoinTable()
+        store = DynamoDBJoinStore(table)
+        rule = JoinRule(lambda msgs: None, 'enriched', 'parent', discard='1m')
+        store.add(rule, 'a', {'parent': 'a', 'ua': 'firefox'})
+        msgs = store.add(rule, 'a', {'parent': 'a', 'geo': 'US'})
+        self.assertEqual([msg.get('ua', msg.get('geo')) for msg in msgs], ['firefox', 'US'])
+        self.assertTrue(table.items['join#enriched.<lambda>#a']['ExpiresAt'] > time.time())
+        store.forget(rule, 'a')
+        self.assertEqual(table.items, {})
+
+    def test_expiredGroupStartsOver(self):
+        table = StubJoinTable()
+        store = DynamoDBJoinStore(table)
+        rule = JoinRule(lambda msgs: None, 'enriched', 'parent', discard='1s')
+        store.add(rule, 'a', {'parent': 'a'})
+        table.items['join#enriched.<lambda>#a']['ExpiresAt'] = int(time.time()) - 1
+        self.assertEqual(len(store.add(rule, 'a', {'parent': 'a'})), 1)
+
+    def test_lambdaContextUsesConfiguredTable(self):
+        from hop.kinesis import LambdaContext
+        from tests.stubs import StubKinesisClient, StubTable
+        context = LambdaContext(ContextConfig({'queues': {'default': {'stream': 'HopperQueue'}}}),
+                                kinesisClient=StubKinesisClient(), table=StubTable())
+        self.assertTrue(isinstance(context._getJoinStore(), MemoryJoinStore))
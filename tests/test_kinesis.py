@@ -0,0 +1,215 @@
+import base64
+import json
+import time
+
+from hop import ContextConfig
+from hop.codec import decode
+from hop.kinesis import LambdaContext, PublishBuffer
+from tests.stubs import StubKinesisClient, StubTable
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+def kinesisRecord(msg, sequenceNumber, partitionKey=None):
+    return {'kinesis': {'data': base64.b64encode(json.dumps(msg).encode('utf-8')).decode('ascii'),
+                        'sequenceNumber': str(sequenceNumber),
+                        'partitionKey': partitionKey or str(sequenceNumber)}}
+
+def kinesisEvent(*msgs):
+    return {'Records': [kinesisRecord(msg, index) for index, msg in enumerate(msgs)]}
+
+class StubLambdaContext(object):
+    def __init__(self, remaining=300000):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining
+
+class PublishBufferTest(unittest.TestCase):
+
+    def test_batches_by_record_count(self):
+        client = StubKinesisClient()
+        buffer = PublishBuffer(client)
+        for i in range(600):
+            buffer.add('stream', '{}', str(i))
+        self.assertEqual(len(client.calls), 1)
+        self.assertEqual(len(client.calls[0][1]), 500)
+        buffer.flush()
+        self.assertEqual(len(client.calls), 2)
+        self.assertEqual(len(client.delivered), 600)
+
+    def test_batches_by_size(self):
+        client = StubKinesisClient()
+        buffer = PublishBuffer(client, maxBytes=1000)
+        for i in range(5):
+            buffer.add('stream', 'x' * 299, str(i))
+        self.assertEqual([len(records) for _, records in client.calls], [3])
+        buffer.flush()
+        self.assertEqual([len(records) for _, records in client.calls], [3, 2])
+
+    def test_groups_per_stream(self):
+        client = StubKinesisClient()
+        buffer = PublishBuffer(client)
+        buffer.add('a', '{}', '1')
+        buffer.add('b', '{}', '2')
+        buffer.add('a', '{}', '3')
+        buffer.flush()
+        self.assertEqual(sorted((stream, len(records)) for stream, records in client.calls), [('a', 2), ('b', 1)])
+
+    def test_retries_only_rejected_records(self):
+        client = StubKinesisClient(failures={'2': 1})
+        buffer = PublishBuffer(client, retryDelay=0)
+        for i in range(3):
+            buffer.add('stream', '{}', str(i))
+        self.assertEqual(buffer.flush(), [])
+        self.assertEqual([len(records) for _, records in client.calls], [3, 1])
+        self.assertEqual(client.calls[1][1][0]['PartitionKey'], '2')
+        self.assertEqual(len(client.delivered), 3)
+
+    def test_returns_records_failed_after_retries(self):
+        client = StubKinesisClient(failures={'1': 10})
+        buffer = PublishBuffer(client, maxRetries=2, retryDelay=0)
+        buffer.add('stream', '{}', '0')
+        buffer.add('stream', '{}', '1')
+        failed = buffer.flush()
+        self.assertEqual([record['PartitionKey'] for record in failed], ['1'])
+        self.assertEqual(len(client.calls), 3)
+
+    def test_flushes_after_delay(self):
+        client = StubKinesisClient()
+        buffer = PublishBuffer(client, maxDelay=0)
+        buffer.add('stream', '{}', '0')
+        self.assertEqual(len(client.delivered), 1)
+        self.assertEqual(buffer.pending(), 0)
+
+
+class LambdaContextPublishTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StubKinesisClient()
+        self.table = StubTable()
+        config = ContextConfig({'queues': {'default': {'stream': 'HopperQueue'}}})
+        self.context = LambdaContext(config, kinesisClient=self.client, table=self.table)
+
+    def test_fan_out_is_sent_in_one_batch_after_handler(self):
+        @self.context.handle('pageBody')
+        def pageBody(msg):
+            for i in range(100):
+                self.context.publish(self.context.message(messageType='pageUrl', url=str(i)))
+            self.assertEqual(len(self.client.calls), 0)
+
+        self.context.lambda_handler(kinesisEvent(self.context.message(messageType='pageBody')), None)
+        self.assertEqual(len(self.client.calls), 1)
+        stream, records = self.client.calls[0]
+        self.assertEqual(stream, 'HopperQueue')
+        self.assertEqual(len(records), 100)
+        self.assertEqual(decode(records[0]['Data'])['url'], '0')
+
+    def test_fan_out_copies_are_sent_in_one_batch(self):
+        self.context.config['queues.priority.stream'] = 'HopperQueuePriority'
+        for name in ['first', 'second', 'third']:
+            self.context.handle('pageView')(lambda msg: None)
+            self.context.rules['handler']['pageView'][-1].__name__ = name
+
+        self.context.lambda_handler(kinesisEvent(self.context.message(messageType='pageView')), None)
+        self.assertEqual(len(self.client.calls), 1)
+        stream, records = self.client.calls[0]
+        self.assertEqual(stream, 'HopperQueuePriority')
+        self.assertEqual([decode(record['Data'])['_system']['flow']['currentState']['callback'] for record in records],
+                         ['second', 'third'])
+
+    def test_flushes_when_handler_fails(self):
+        @self.context.handle('pageBody')
+        def pageBody(msg):
+            self.context.publish(self.context.message(messageType='pageUrl'))
+            raise ValueError('failed')
+
+        self.context.lambda_handler(self.context.message(messageType='pageBody'), None)
+        self.assertEqual(len(self.client.delivered), 1)
+
+    def test_undelivered_messages_fail_the_batch(self):
+        class RejectingClient(StubKinesisClient):
+            def put_records(self, StreamName, Records):
+                self.calls.append((StreamName, list(Records)))
+                return {'FailedRecordCount': len(Records),
+                        'Records': [{'ErrorCode': 'InternalFailure', 'ErrorMessage': 'stub'} for record in Records]}
+
+        client = RejectingClient()
+        context = LambdaContext(ContextConfig({'queues': {'default': {'stream': 'HopperQueue'}},
+                                               'publish': {'retryDelay': 0}}), kinesisClient=client, table=self.table)
+        context.handle('pageBody')(lambda msg: context.publish(context.message(messageType='pageUrl')))
+        event = kinesisEvent(context.message(messageType='pageBody'), context.message(messageType='pageBody'))
+        self.assertEqual(context.lambda_handler(event, None),
+                         {'batchItemFailures': [{'itemIdentifier': record['kinesis']['sequenceNumber']} for record in event['Records']]})
+        self.assertRaises(Exception, context.lambda_handler, context.message(messageType='pageBody'), None)
+
+    def test_messages_are_sent_when_counting_fails(self):
+        def failingAdd(value):
+            raise ValueError('counter')
+        self.context.requestCounter._add = failingAdd
+        self.context.requestCounter.pending = 1
+        self.context.publish(self.context.message(messageType='pageUrl'))
+        self.assertRaises(ValueError, self.context.flush)
+        self.assertEqual(len(self.client.delivered), 1)
+
+
+class LambdaContextConcurrencyTest(unittest.TestCase):
+
+    def createContext(self, concurrency):
+        config = ContextConfig({'lambda': {'concurrency': concurrency, 'deadlineMargin': 100},
+                                'queues': {'default': {'stream': 'HopperQueue'}}})
+        return LambdaContext(config, kinesisClient=StubKinesisClient(), table=StubTable())
+
+    def test_processes_records_in_parallel(self):
+        context = self.createContext(10)
+        received = []
+
+        @context.handle('testMessage')
+        def handler(msg):
+            time.sleep(0.05)
+            received.append(msg['index'])
+            context.publish(context.message(messageType='result'))
+
+        start = time.time()
+        result = context.lambda_handler(kinesisEvent(*[context.message(messageType='testMessage', index=i) for i in range(20)]),
+                                        StubLambdaContext())
+        self.assertIsNone(result)
+        self.assertEqual(sorted(received), list(range(20)))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(len(context.kinesisClient.delivered), 20)
+        self.assertEqual(context.table.items['RuntimeState']['RequestCounter'], 20)
+
+    def test_keeps_order_within_partition_key(self):
+        context = self.createContext(4)
+        received = []
+
+        @context.handle('testMessage')
+        def handler(msg):
+            time.sleep(0.001 * (msg['index'] % 3))
+            received.append((msg['key'], msg['index']))
+
+        records = [kinesisRecord(context.message(messageType='testMessage', key=i % 3, index=i), i, partitionKey=str(i % 3))
+                   for i in range(30)]
+        context.lambda_handler({'Records': records}, StubLambdaContext())
+        for key in range(3):
+            self.assertEqual([index for k, index in received if k == key], list(range(key, 30, 3)))
+
+    def test_reports_records_left_at_deadline(self):
+        for concurrency in [1, 2]:
+            context = self.createContext(concurrency)
+            lambdaContext = StubLambdaContext()
+
+            @context.handle('testMessage')
+            def handler(msg):
+                if msg['index'] == 1:
+                    lambdaContext.remaining = 50
+
+            records = [kinesisRecord(context.message(messageType='testMessage', index=i), i, partitionKey='key')
+                       for i in range(4)]
+            result = context.lambda_handler({'Records': records}, lambdaContext)
+            self.assertEqual(result, {'batchItemFailures': [{'itemIdentifier': '2'}, {'itemIdentifier': '3'}]})
+
+
+if __name__ == '__main__':
+    unittest.main()
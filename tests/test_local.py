@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+
+from hop import ContextConfig
+from hop.local import LocalContext, PriorityQueues, SpillFile
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class PriorityQueuesTest(unittest.TestCase):
+
+    def test_lowest_level_first_fifo_within_level(self):
+        queues = PriorityQueues()
+        queues.push(2, 'c')
+        queues.push(0, 'a')
+        queues.push(2, 'd')
+        queues.push(1, 'b')
+        self.assertEqual(len(queues), 4)
+        self.assertEqual([queues.pop() for i in range(5)], ['a', 'b', 'c', 'd', None])
+        self.assertEqual(len(queues), 0)
+
+    def test_level_reactivated_after_drained(self):
+        queues = PriorityQueues()
+        queues.push(1, 'a')
+        self.assertEqual(queues.pop(), 'a')
+        queues.push(1, 'b')
+        queues.push(0, 'c')
+        self.assertEqual(queues.depth(1), 1)
+        self.assertEqual([queues.pop(), queues.pop()], ['c', 'b'])
+
+
+class BoundedQueuesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_drop_newest(self):
+        queues = PriorityQueues(capacity=lambda priority: 2, overflow='dropNewest')
+        self.assertEqual([queues.push(1, msg) for msg in 'abc'], [True, True, False])
+        self.assertEqual([queues.pop() for i in range(3)], ['a', 'b', None])
+        self.assertEqual(queues.dropped, 1)
+
+    def test_drop_oldest(self):
+        queues = PriorityQueues(capacity=lambda priority: 2, overflow='dropOldest')
+        for msg in 'abcd':
+            queues.push(1, msg)
+        self.assertEqual([queues.pop() for i in range(3)], ['c', 'd', None])
+        self.assertEqual(queues.dropped, 2)
+
+    def test_capacity_per_level(self):
+        queues = PriorityQueues(capacity=lambda priority: {0: 1}.get(priority), overflow='dropNewest')
+        self.assertFalse(queues.push(0, 'a') and queues.push(0, 'b'))
+        self.assertTrue(all(queues.push(1, msg) for msg in 'xyz'))
+
+    def test_spill_keeps_order(self):
+        queues = PriorityQueues(capacity=lambda priority: 4, overflow='spill', spillDirectory=self.directory)
+        for i in range(20):
+            queues.push(1, {'index': i})
+        self.assertEqual((len(queues), queues.depth(1), queues.spilled), (20, 20, 16))
+        queues.push(0, {'index': -1})
+        self.assertEqual([queues.pop()['index'] for i in range(21)], list(range(-1, 20)))
+        self.assertEqual(queues.pop(), None)
+        self.assertEqual(len(queues), 0)
+        queues.close()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_spill_file(self):
+        spill = SpillFile(self.directory)
+        for i in range(5):
+            spill.append({'index': i})
+        self.assertEqual([msg['index'] for msg in spill.read(3)], [0, 1, 2])
+        spill.append({'index': 5})
+        self.assertEqual([msg['index'] for msg in spill.read(10)], [3, 4, 5])
+        self.assertEqual(os.path.getsize(spill.path), 0)
+        spill.close()
+
+    def test_memory_budget(self):
+        queues = PriorityQueues(memoryBudget=1000, overflow='dropNewest')
+        body = 'x' * 300
+        self.assertEqual([queues.push(level, {'body': body}) for level in [0, 1, 2, 3]], [True, True, True, False])
+        queues.pop()
+        self.assertTrue(queues.push(3, {'body': body}))
+        self.assertTrue(queues.bytes <= 1000)
+
+    def test_watermarks(self):
+        queues = PriorityQueues(capacity=lambda priority: 10, highWatermark=0.8, lowWatermark=0.2)
+        events = []
+        queues.onHigh.append(lambda: events.append('high'))
+        queues.onLow.append(lambda: events.append('low'))
+        for i in range(9):
+            queues.push(1, i)
+        self.assertEqual(events, ['high'])
+        self.assertEqual(queues.congested, set([1]))
+        for i in range(6):
+            queues.pop()
+        self.assertEqual(events, ['high'])
+        queues.pop()
+        self.assertEqual(events, ['high', 'low'])
+
+
+class LocalContextQueueTest(unittest.TestCase):
+
+    def test_named_queue_priority(self):
+        context = LocalContext(ContextConfig({'queues': {'priority': {}}}))
+        received = []
+
+        @context.handle('testMessage')
+        def handler(msg):
+            received.append(msg['name'])
+
+        context.publish(context.message(messageType='testMessage', name='default'))
+        context.publish(context.message(messageType='testMessage', name='priority'), 'priority')
+        context.run()
+        self.assertEqual(received, ['priority', 'default'])
+
+    def test_block_processes_inline(self):
+        context = LocalContext(ContextConfig({'local': {'capacity': 5}}))
+        received = []
+
+        @context.handle('pageBody')
+        def pageBody(msg):
+            for i in range(100):
+                context.publish(context.message(messageType='pageUrl', index=i))
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            received.append(msg['index'])
+            self.assertTrue(len(context.queues) <= 5)
+
+        context.publish(context.message(messageType='pageBody'))
+        context.run()
+        self.assertEqual(received, list(range(100)))
+
+    def test_producer_slows_down_when_congested(self):
+        context = LocalContext(ContextConfig({'local': {'capacity': 10, 'overflow': 'dropNewest'}}))
+        published = []
+        context.onHighWatermark(lambda: published.append('high'))
+
+        @context.handle('pageBody')
+        def pageBody(msg):
+            for i in range(100):
+                if context.congested:
+                    break
+                context.publish(context.message(messageType='pageUrl'))
+                published.append(i)
+
+        context.publish(context.message(messageType='pageBody'))
+        context.run()
+        self.assertEqual(published, list(range(7)) + ['high', 7])
+        self.assertEqual(context.queues.dropped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
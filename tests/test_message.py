@@ -2,6 +2,11 @@
 import sys
 sys.path.append('e:\\WS\\Hopper')
 
+import json
+import pickle
+from datetime import datetime, timedelta
+
+from hop import Message, _timestamp
 from hop.local import LocalContext
 
 __author__ = 'Denis Mikhalkin'
@@ -29,3 +34,42 @@ class MessageTest(unittest.TestCase):
         self.assertIsNotNone(msg['_system']['timestamp'])
         self.assertEqual(type(msg['_system']['timestamp']), str)
 
+
+    def test_timestamp_format(self):
+        # Formatted as str(datetime.utcnow()) was
+        for now in [0.0, 1500000000.25, 1500000000.999999, 1500000000.9999996]:
+            self.assertEqual(_timestamp(now), str(datetime(1970, 1, 1) + timedelta(seconds=now)))
+
+    def test_ids_are_unique(self):
+        ids = set(self.context.message(messageType='abc')['_system']['messageID'] for i in range(1000))
+        self.assertEqual(len(ids), 1000)
+
+    def test_clone_shares_fields(self):
+        body = 'x' * 100000
+        msg = self.context.message(messageType='pageBody', body=body)
+        msg['_system']['flow'] = {'currentState': {}}
+        clone = msg.clone()
+        self.assertTrue(clone['body'] is body)
+        self.assertEqual(type(clone), Message)
+        self.assertNotEqual(clone['_system']['messageID'], msg['_system']['messageID'])
+        self.assertFalse('flow' in clone['_system'])
+        clone['body'] = 'changed'
+        self.assertEqual(msg['body'], body)
+
+    def test_system_header_is_a_dict(self):
+        msg = self.context.message(messageType='abc')
+        self.assertTrue(isinstance(msg['_system'], dict))
+        msg['_system']['flow'] = {'currentState': {'callback': 'handler'}}
+        self.assertTrue('flow' in msg['_system'])
+        self.assertEqual(sorted(msg['_system'].keys()), ['flow', 'messageID', 'timestamp'])
+        loaded = json.loads(json.dumps(msg))
+        self.assertEqual(loaded['_system']['timestamp'], msg['_system']['timestamp'])
+        self.assertEqual(loaded['_system']['messageID'], msg['_system']['messageID'])
+        self.assertEqual(loaded['_system']['flow'], msg['_system']['flow'])
+
+    def test_pickle(self):
+        msg = self.context.message(messageType='abc', value=1)
+        msg['_system']['flow'] = {}
+        loaded = pickle.loads(pickle.dumps(msg, 2))
+        self.assertEqual(loaded, msg)
+        self.assertEqual(dict(loaded['_system']), dict(msg['_system']))
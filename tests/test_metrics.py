@@ -0,0 +1,155 @@
+import os
+import json
+import pickle
+import shutil
+import tempfile
+
+from hop import ContextConfig, Message
+from hop.kinesis import LambdaContext
+from hop.local import LocalContext
+from hop.metrics import Histogram, Metrics, EMFExporter, PrometheusExporter, prometheusText
+from tests.stubs import StubKinesisClient, StubTable
+from tests.test_kinesis import kinesisEvent, StubLambdaContext
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class HistogramTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for i in range(98):
+            histogram.observe(0.0003)
+        histogram.observe(0.2)
+        histogram.observe(50)
+        self.assertEqual(histogram.percentile(0.5), 0.0005)
+        self.assertEqual(histogram.percentile(0.99), 0.25)
+        self.assertEqual(histogram.percentile(1), 50)
+        self.assertEqual(histogram.snapshot()['count'], 100)
+
+
+class ContextMetricsTest(unittest.TestCase):
+
+    def createContext(self, config=None):
+        context = LocalContext(config)
+
+        @context.filter('pageUrl')
+        def urlFilter(msg):
+            return msg if msg.get('url') else None
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            if msg['url'] == 'bad':
+                raise ValueError(msg['url'])
+
+        return context
+
+    def test_stats(self):
+        context = self.createContext()
+        for url in ['http://a', 'bad', None, 'http://b']:
+            context.publish(context.message(messageType='pageUrl', url=url))
+        context.publish(context.message(messageType='pageUrl', url='http://c', priority=0))
+        self.assertEqual(context.stats()['queueDepth'], {'0': 1, '1': 4})
+        context.run()
+
+        stats = context.stats()
+        self.assertEqual(stats['messages'], {'pageUrl': 5})
+        self.assertEqual(stats['filterDrops'], {'pageUrl.urlFilter': 1})
+        handler = stats['callbacks']['pageUrl.pageUrl']
+        self.assertEqual((handler['calls'], handler['errors'], handler['latency']['count']), (4, 1, 4))
+        self.assertEqual(stats['queueDepth'], {'0': 0, '1': 0})
+        self.assertEqual(stats['queueWait']['1']['count'], 4)
+        self.assertEqual(stats['queueWait']['0']['count'], 1)
+
+    def test_merge(self):
+        metrics, other = Metrics(), Metrics()
+        metrics.message('pageUrl')
+        metrics.callback('pageUrl', 'handler', 0.001)
+        other.message('pageUrl')
+        other.callback('pageUrl', 'handler', 0.2, True)
+        other.retried('pageUrl')
+        metrics.merge(pickle.loads(pickle.dumps(other.state(), 2)))
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['messages'], {'pageUrl': 2})
+        callback = snapshot['callbacks']['pageUrl.handler']
+        self.assertEqual((callback['calls'], callback['errors']), (2, 1))
+        self.assertEqual(callback['latency']['max'], 0.2)
+        self.assertEqual(snapshot['retries'], {'pageUrl': 1})
+
+    def test_disabled(self):
+        context = self.createContext(ContextConfig({'metrics': {'enabled': False}}))
+        context.publish(context.message(messageType='pageUrl', url='http://a'))
+        context.run()
+        self.assertEqual(context.stats(), {})
+
+    def test_prometheusExport(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'metrics.prom')
+            context = self.createContext(ContextConfig({'metrics': {'prometheus': path}}))
+            context.publish(context.message(messageType='pageUrl', url='http://a'))
+            context.run()
+            with open(path) as stream:
+                text = stream.read()
+        finally:
+            shutil.rmtree(directory)
+        self.assertTrue('hopper_messages_total{messageType="pageUrl"} 1\n' in text)
+        self.assertTrue('hopper_callback_seconds_count{messageType="pageUrl",callback="pageUrl"} 1\n' in text)
+        self.assertTrue('hopper_callback_seconds_bucket{messageType="pageUrl",callback="pageUrl",le="+Inf"} 1\n' in text)
+        self.assertTrue('hopper_queue_depth{priority="1"} 0\n' in text)
+
+    def test_prometheusTextOfEmptySnapshot(self):
+        self.assertTrue(prometheusText(Metrics().snapshot()).startswith('# TYPE hopper_messages_total counter'))
+
+    def test_prometheusExporterRewritesTheFile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'metrics.prom')
+            metrics = Metrics()
+            exporter = PrometheusExporter(path)
+            for count in range(2):
+                metrics.message('pageUrl')
+                exporter.export(metrics.snapshot())
+            with open(path) as stream:
+                text = stream.read()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([line for line in text.splitlines() if line.startswith('hopper_messages_total')],
+                         ['hopper_messages_total{messageType="pageUrl"} 2'])
+
+
+class EMFTest(unittest.TestCase):
+
+    def test_retriesAndDeadLetters(self):
+        lines = []
+        metrics = Metrics()
+        metrics.retried('pageUrl')
+        metrics.retried('pageUrl')
+        metrics.deadLettered('pageUrl')
+        EMFExporter('Test', lines.append).export(metrics.snapshot())
+        documents = [json.loads(line) for line in lines]
+        self.assertEqual([(document['MessageType'], document['Retries'], document['DeadLetters']) for document in documents],
+                         [('pageUrl', 2, 1)])
+        self.assertEqual(documents[0]['_aws']['CloudWatchMetrics'][0]['Dimensions'], [['MessageType']])
+
+    def test_lambdaExportsPerInvocation(self):
+        lines = []
+        config = ContextConfig({'metrics': {'emf': True, 'namespace': 'Test'}, 'queues': {'default': {'stream': 'HopperQueue'}}})
+        context = LambdaContext(config, kinesisClient=StubKinesisClient(), table=StubTable())
+        context.metrics.exporters[0].write = lines.append
+        context.handle('test')(lambda msg: None)
+        context.filter('test')(lambda msg: msg if msg['value'] else None)
+
+        context.lambda_handler(kinesisEvent(Message('test', {'value': 1}), Message('test', {'value': 0})), StubLambdaContext())
+        documents = [json.loads(line) for line in lines]
+        self.assertEqual(len(documents), 2)
+        invocations = [document for document in documents if 'Invocations' in document][0]
+        self.assertEqual(invocations['_aws']['CloudWatchMetrics'][0]['Namespace'], 'Test')
+        self.assertEqual((invocations['MessageType'], invocations['Callback'], invocations['Invocations']), ('test', '<lambda>', 1))
+        self.assertEqual([document['FilterDrops'] for document in documents if 'FilterDrops' in document], [1])
+
+        # Counters start over with the next invocation
+        del lines[:]
+        context.lambda_handler(kinesisEvent(Message('test', {'value': 1})), StubLambdaContext())
+        self.assertEqual([json.loads(line)['Invocations'] for line in lines], [1])
@@ -0,0 +1,178 @@
+import hashlib
+
+from hop import ContextConfig
+from hop.codec import decode
+from hop.kinesis import LambdaContext, PublishBuffer
+from hop.partition import PartitionKeys, ShardMap
+from tests.stubs import StubKinesisClient, StubTable
+from tests.test_kinesis import kinesisEvent
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+def publishedKeys(client):
+    return [record['PartitionKey'] for stream, record in client.delivered]
+
+
+class PartitionKeysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StubKinesisClient()
+        config = ContextConfig({'queues': {'default': {'stream': 'HopperQueue'}}, 'tracing': {'enabled': True},
+                                'partition': {'messageTypes': {'pageUrl': {'field': 'url'},
+                                                               'pageBody': {'correlation': True}}}})
+        self.context = LambdaContext(config, kinesisClient=self.client, table=StubTable())
+
+    def test_field_key(self):
+        for url in ['a', 'b', 'a']:
+            self.context.publish(self.context.message(messageType='pageUrl', url=url))
+        self.context.publish(self.context.message(messageType='pageUrl'))
+        self.context.flush()
+        keys = publishedKeys(self.client)
+        self.assertEqual(keys[:3], ['a', 'b', 'a'])
+        self.assertEqual(len(keys[3]), 32)
+
+    def test_correlation_key_is_shared_by_siblings(self):
+        context = LambdaContext(ContextConfig({'queues': {'default': {'stream': 'HopperQueue'}},
+                                               'partition': {'messageTypes': {'pageBody': {'correlation': True}}}}),
+                                kinesisClient=self.client, table=StubTable())
+        root = context.message(messageType='pageUrl')
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            for i in range(2):
+                context.publish(context.message(messageType='pageBody'))
+
+        @context.handle('pageBody')
+        def pageBody(msg):
+            context.publish(context.message(messageType='pageBody'))
+
+        context.lambda_handler(root, None)
+        keys = publishedKeys(self.client)
+        self.assertEqual(keys, [hashlib.md5(root['_system']['messageID'].encode('utf-8')).hexdigest()] * 2)
+        # Their children are keyed by their own parents, so a tree spreads over shards
+        child = decode(self.client.delivered[0][1]['Data'])
+        del self.client.delivered[:]
+        context.lambda_handler(kinesisEvent(child), None)
+        self.assertEqual(publishedKeys(self.client), [hashlib.md5(child['_system']['messageID'].encode('utf-8')).hexdigest()])
+
+    def test_correlation_key_is_shared_by_a_trace(self):
+        self.context.partitionBy('pageBody', correlation='traceID')
+        root = self.context.message(messageType='pageBody')
+        self.context.publish(root)
+
+        @self.context.handle('pageBody')
+        def pageBody(msg):
+            self.context.publish(self.context.message(messageType='pageBody'))
+
+        self.context.lambda_handler(root, None)
+        keys = publishedKeys(self.client)
+        self.assertEqual(keys, [hashlib.md5(root['_system']['traceID'].encode('utf-8')).hexdigest()] * 2)
+
+    def test_trace_correlation_key_needs_tracing(self):
+        context = LambdaContext(ContextConfig({'queues': {'default': {'stream': 'HopperQueue'}},
+                                               'partition': {'messageTypes': {'pageBody': {'correlation': 'traceID'}}}}),
+                                kinesisClient=self.client, table=StubTable())
+        msg = context.message(messageType='pageBody')
+        self.assertEqual(len(context.partitionKeys.key(msg)), 32)
+        self.assertNotEqual(context.partitionKeys.key(msg), context.partitionKeys.key(msg))
+
+    def test_key_function_and_long_keys(self):
+        self.context.partitionBy('pageUrl', key=lambda msg: msg['url'] * 200)
+        self.context.publish(self.context.message(messageType='pageUrl', url='a'))
+        self.context.flush()
+        self.assertEqual(publishedKeys(self.client), [hashlib.md5(('a' * 200).encode('utf-8')).hexdigest()])
+
+    def test_salts(self):
+        keys = PartitionKeys()
+        keys.register('pageUrl', field='url', salts=4)
+        salted = set(keys.key({'messageType': 'pageUrl', 'url': 'a'}) for i in range(100))
+        self.assertEqual(salted, set(['a#0', 'a#1', 'a#2', 'a#3']))
+
+    def test_hot_keys_are_salted(self):
+        keys = PartitionKeys(hotKeyRate=10, hotKeySalts=2)
+        keys.register('pageUrl', field='url')
+        published = [keys.key({'messageType': 'pageUrl', 'url': 'hot'}) for i in range(100)]
+        self.assertEqual(published[:10], ['hot'] * 10)
+        self.assertEqual(set(published[10:]), set(['hot#0', 'hot#1']))
+        self.assertEqual(keys.key({'messageType': 'pageUrl', 'url': 'cold'}), 'cold')
+
+
+class ShardMapTest(unittest.TestCase):
+
+    def test_lists_open_shards_of_all_pages(self):
+        client = StubKinesisClient(shards=5)
+        client.shards[0]['SequenceNumberRange']['EndingSequenceNumber'] = '10'
+        shardMap = ShardMap.fromStream(client, 'stream')
+        self.assertEqual(len(shardMap), 4)
+        self.assertEqual(client.listCalls, 3)
+
+    def test_shard_of_a_key(self):
+        shardMap = ShardMap(StubKinesisClient(shards=4).shards)
+        for key in ['a', 'b', 'c', 'd', 'e']:
+            hashKey = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+            self.assertEqual(shardMap.shardFor(key), 'shardId-%012d' % (hashKey * 4 // 2 ** 128))
+
+
+class ShardBatchingTest(unittest.TestCase):
+
+    def test_batches_are_grouped_by_shard(self):
+        client = StubKinesisClient(shards=4)
+        buffer = PublishBuffer(client, groupByShard=True)
+        shardMap = ShardMap(client.shards)
+        for i in range(100):
+            buffer.add('stream', b'x', str(i))
+        self.assertEqual(buffer.flush(), [])
+        self.assertEqual(len(client.calls), 1)
+        shards = [shardMap.shardFor(record['PartitionKey']) for record in client.calls[0][1]]
+        self.assertEqual(shards, sorted(shards, key=shards.index))
+        self.assertEqual(len(set(shards)), 4)
+
+    def test_a_request_holds_at_most_a_second_of_a_shard(self):
+        client = StubKinesisClient(shards=2)
+        buffer = PublishBuffer(client, groupByShard=True)
+        buffer.MAX_SHARD_BYTES = 100
+        for i in range(20):
+            buffer.add('stream', b'0123456789', 'hot')
+        buffer.flush()
+        self.assertEqual([len(records) for stream, records in client.calls], [7, 7, 6])
+        self.assertEqual(client.listCalls, 1)
+
+    def test_a_shard_group_is_not_split_between_requests(self):
+        client = StubKinesisClient(shards=2)
+        buffer = PublishBuffer(client, maxRecords=5, groupByShard=True)
+        shardMap = ShardMap(client.shards)
+        keys = dict()
+        for i in range(100):
+            keys.setdefault(shardMap.shardFor(str(i)), []).append(str(i))
+        first, second = [shardKeys[:3] for shardKeys in keys.values()]
+        records = [{'Data': b'x', 'PartitionKey': key} for key in first + second]
+        batches = buffer._batches('stream', records)
+        self.assertEqual([[record['PartitionKey'] for record in batch] for batch in batches], [first, second])
+
+    def test_without_list_permission(self):
+        from botocore.exceptions import ClientError
+
+        class DeniedClient(StubKinesisClient):
+            def list_shards(self, **kwargs):
+                raise ClientError({'Error': {'Code': 'AccessDeniedException'}}, 'ListShards')
+
+        client = DeniedClient()
+        buffer = PublishBuffer(client, groupByShard=True)
+        buffer.add('stream', b'x', 'a')
+        self.assertEqual(buffer.flush(), [])
+        self.assertEqual(len(client.delivered), 1)
+
+    def test_lambda_context_config(self):
+        client = StubKinesisClient(shards=2)
+        config = ContextConfig({'queues': {'default': {'stream': 'HopperQueue'}}, 'publish': {'groupByShard': True}})
+        context = LambdaContext(config, kinesisClient=client, table=StubTable())
+        context.publish(context.message(messageType='pageUrl'))
+        context.flush()
+        self.assertEqual(client.listCalls, 1)
+        self.assertEqual(decode(client.delivered[0][1]['Data'])['messageType'], 'pageUrl')
+
+
+if __name__ == '__main__':
+    unittest.main()
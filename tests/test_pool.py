@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import time
+
+from hop import ContextConfig
+from hop.pool import ProcessPoolContext
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+def drain(queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.get(timeout=0.5))
+        except Exception:
+            return items
+
+class ProcessPoolContextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.received = multiprocessing.Queue()
+
+    def test_handlers_run_in_workers_and_publish_back(self):
+        context = ProcessPoolContext(workers=3)
+
+        @context.handle('pageBody')
+        def pageBody(msg):
+            for i in range(10):
+                context.publish(context.message(messageType='pageUrl', url=str(i)))
+
+        @context.filter('pageUrl')
+        def urlFilter(msg):
+            return msg if msg['url'] != '0' else None
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            self.received.put(msg['url'])
+
+        context.publish(context.message(messageType='pageBody'))
+        context.run()
+        self.assertEqual(sorted(drain(self.received)), [str(i) for i in range(1, 10)])
+
+    def test_stats_include_the_workers(self):
+        context = ProcessPoolContext(workers=2)
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            if msg['url'] == 'bad':
+                raise ValueError('bad url')
+
+        for url in ['a', 'b', 'c', 'bad']:
+            context.publish(context.message(messageType='pageUrl', url=url))
+        context.run()
+        stats = context.stats()
+        self.assertEqual(stats['messages'], {'pageUrl': 4})
+        self.assertEqual(stats['callbacks']['pageUrl.pageUrl']['calls'], 4)
+        self.assertEqual(stats['callbacks']['pageUrl.pageUrl']['errors'], 1)
+        self.assertEqual(stats['callbacks']['pageUrl.pageUrl']['latency']['count'], 4)
+
+    def test_concurrency_limit(self):
+        active = multiprocessing.Value('i', 0)
+        context = ProcessPoolContext(workers=4, concurrency={'slow': 1})
+
+        @context.handle('slow')
+        def slow(msg):
+            with active.get_lock():
+                active.value += 1
+                self.received.put(active.value)
+            time.sleep(0.02)
+            with active.get_lock():
+                active.value -= 1
+
+        for i in range(6):
+            context.publish(context.message(messageType='slow'))
+        context.run()
+        observed = drain(self.received)
+        self.assertEqual(len(observed), 6)
+        self.assertEqual(max(observed), 1)
+
+    def test_limited_messages_wait_in_a_bounded_window(self):
+        popped = []
+
+        class RecordingContext(ProcessPoolContext):
+            def _pop(self):
+                popped.append(time.time())
+                return ProcessPoolContext._pop(self)
+
+        context = RecordingContext(workers=1, concurrency={'slow': 1})
+        context.handle('slow')(lambda msg: time.sleep(0.02))
+        for i in range(20):
+            context.publish(context.message(messageType='slow'))
+        context.run()
+        # One in flight and two waiting are taken at once, the next ones as the slow messages complete
+        self.assertTrue(popped[10] - popped[0] >= 0.1)
+        self.assertEqual(len(context.queues), 0)
+
+    def test_waiting_messages_are_queued_again_on_stop(self):
+        context = ProcessPoolContext(workers=2, concurrency={'slow': 1})
+
+        @context.handle('slow')
+        def slow(msg):
+            time.sleep(0.05)
+            self.received.put(msg['index'])
+            context.stop()
+
+        for i in range(6):
+            context.publish(context.message(messageType='slow', index=i))
+        context.run()
+        processed = drain(self.received)
+        self.assertEqual(len(processed) + len(context.queues), 6)
+
+    def test_worker_exit_is_retried_then_dead_lettered(self):
+        context = ProcessPoolContext(ContextConfig({'retry': {'maxAttempts': 2, 'delay': 0.01}}), workers=2)
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            if msg['url'] == 'crash':
+                os._exit(3)
+            self.received.put(msg['url'])
+
+        for url in ['a', 'crash', 'b', 'c']:
+            context.publish(context.message(messageType='pageUrl', url=url))
+        context.run()
+        self.assertEqual(sorted(drain(self.received)), ['a', 'b', 'c'])
+        self.assertEqual([msg['url'] for msg in context.deadLetters], ['crash'])
+        self.assertEqual(context.deadLetters[0]['_system']['attempts'], 2)
+
+    def test_concurrency_limit_below_one(self):
+        context = ProcessPoolContext(ContextConfig({'local': {'concurrency': {'slow': 0}}}), workers=1)
+        context.handle('slow')(lambda msg: None)
+        context.publish(context.message(messageType='slow'))
+        self.assertRaises(ValueError, context.run)
+        self.assertEqual(len(context.queues), 1)
+
+    def test_stop(self):
+        context = ProcessPoolContext(workers=2)
+
+        @context.handle('testMessage')
+        def handler(msg):
+            self.received.put(msg['index'])
+            context.stop()
+            context.publish(context.message(messageType='testMessage', index=-1))
+
+        for i in range(20):
+            context.publish(context.message(messageType='testMessage', index=i))
+        context.run()
+        processed = drain(self.received)
+        self.assertTrue(0 < len(processed) < 20)
+        self.assertNotIn(-1, processed)
+        self.assertTrue(context.terminated)
+
+    def test_auto_stop_limit(self):
+        context = ProcessPoolContext(ContextConfig({'runtime': {'autoStop': True, 'autoStopLimit': 5}}), workers=3)
+
+        @context.handle('testMessage')
+        def handler(msg):
+            self.received.put(msg['index'])
+
+        for i in range(20):
+            context.publish(context.message(messageType='testMessage', index=i))
+        context.run()
+        processed = drain(self.received)
+        self.assertTrue(0 < len(processed) <= 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
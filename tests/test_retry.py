@@ -0,0 +1,177 @@
+import base64
+import time
+
+from hop import ContextConfig
+from hop.codec import decode
+from hop.kinesis import LambdaContext
+from hop.local import LocalContext
+from hop.retry import RetryPolicy
+from tests.stubs import StubKinesisClient, StubSQSClient, StubTable
+from tests.test_kinesis import kinesisRecord
+from tests.test_sqs import sqsRecord
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        policy = RetryPolicy(maxAttempts=5, delay=1, maxDelay=3)
+        for attempts, delay in [(1, 1), (2, 2), (3, 3), (4, 3)]:
+            self.assertTrue(delay / 2.0 <= policy.delayFor(attempts) <= delay)
+
+    def test_from_config(self):
+        policy = RetryPolicy.fromConfig(ContextConfig({'retry': {'maxAttempts': 3, 'deadLetterQueue': 'deadLetter'}}))
+        self.assertEqual((policy.maxAttempts, policy.delay, policy.deadLetterQueue), (3, 1, 'deadLetter'))
+        self.assertEqual(RetryPolicy.fromConfig(ContextConfig({})).maxAttempts, 1)
+
+    def test_attempts_and_wait(self):
+        context = LocalContext()
+        msg = context.message(messageType='pageUrl')
+        self.assertEqual((RetryPolicy.attempts(msg), RetryPolicy.wait(msg)), (1, 0))
+        RetryPolicy(delay=10).retry(msg, 1)
+        self.assertEqual(RetryPolicy.attempts(msg), 2)
+        self.assertTrue(4 < RetryPolicy.wait(msg) <= 10)
+
+
+class LocalRetryTest(unittest.TestCase):
+
+    def createContext(self, maxAttempts):
+        return LocalContext(ContextConfig({'retry': {'maxAttempts': maxAttempts, 'delay': 0.01},
+                                           'metrics': {'enabled': True}}))
+
+    def test_retries_only_the_failed_handler(self):
+        context = self.createContext(3)
+        calls = []
+
+        @context.handle('pageUrl')
+        def flaky(msg):
+            calls.append('flaky')
+            if len(calls) < 4:
+                raise ValueError('failed')
+
+        @context.handle('pageUrl')
+        def stable(msg):
+            calls.append('stable')
+
+        context.publish(context.message(messageType='pageUrl'))
+        start = time.time()
+        context.run()
+        self.assertEqual(calls, ['flaky', 'stable', 'flaky', 'flaky'])
+        self.assertTrue(time.time() - start >= 0.01)
+        self.assertEqual(context.stats()['retries'], {'pageUrl': 2})
+        self.assertEqual(len(context.deadLetters), 0)
+
+    def test_dead_letter_after_the_last_attempt(self):
+        context = self.createContext(2)
+
+        @context.handle('pageUrl')
+        def broken(msg):
+            raise ValueError('failed')
+
+        context.publish(context.message(messageType='pageUrl', url='a'))
+        context.run()
+        self.assertEqual(len(context.deadLetters), 1)
+        failed = context.deadLetters[0]
+        self.assertEqual((failed['url'], failed['_system']['attempts']), ('a', 2))
+        self.assertEqual(failed['_system']['error']['callback'], 'broken')
+        self.assertTrue('failed' in failed['_system']['error']['error'])
+        self.assertEqual(context.stats()['deadLetters'], {'pageUrl': 1})
+
+    def test_failed_filter_retries_the_message(self):
+        context = self.createContext(2)
+        received = []
+
+        @context.filter('pageUrl')
+        def check(msg):
+            if RetryPolicy.attempts(msg) == 1:
+                raise ValueError('failed')
+            return msg
+
+        context.handle('pageUrl')(lambda msg: received.append(msg['url']))
+        context.publish(context.message(messageType='pageUrl', url='a'))
+        context.run()
+        self.assertEqual(received, ['a'])
+
+
+class LambdaRetryTest(unittest.TestCase):
+
+    def createContext(self, retry):
+        self.kinesisClient = StubKinesisClient()
+        self.sqsClient = StubSQSClient()
+        config = ContextConfig({'retry': retry,
+                                'queues': {'default': {'type': 'kinesis', 'stream': 'HopperQueue'},
+                                           'deadLetter': {'type': 'sqs', 'name': 'HopperDeadLetter'}}})
+        context = LambdaContext(config, kinesisClient=self.kinesisClient, table=StubTable(), sqsClient=self.sqsClient)
+
+        @context.handle('pageUrl')
+        def pageUrl(msg):
+            if msg['url'] == 'poison':
+                raise ValueError('failed')
+            self.received.append(msg['url'])
+        self.received = []
+        return context
+
+    def test_last_attempt_is_dropped_without_dead_letter_queue(self):
+        context = self.createContext({})
+        event = {'Records': [sqsRecord(context.message(messageType='pageUrl', url=url), url)
+                             for url in ['a', 'poison', 'b']]}
+        self.assertEqual(context.lambda_handler(event, None), None)
+        self.assertEqual(self.received, ['a', 'b'])
+
+    def test_ordered_records_after_a_failure_are_delivered_again(self):
+        context = self.createContext({})
+        process = context._process
+        def failingProcess(msg):
+            # Fails outside of the handlers, where it is not retried
+            if msg['url'] == 'poison':
+                raise ValueError('failed')
+            return process(msg)
+        context._process = failingProcess
+        event = {'Records': [kinesisRecord(context.message(messageType='pageUrl', url=url), index, 'shard')
+                             for index, url in enumerate(['a', 'poison', 'b'])]}
+        self.assertEqual(context.lambda_handler(event, None),
+                         {'batchItemFailures': [{'itemIdentifier': '1'}, {'itemIdentifier': '2'}]})
+        self.assertEqual(self.received, ['a'])
+
+    def test_publishes_the_retry(self):
+        context = self.createContext({'maxAttempts': 2, 'delay': 5})
+        event = {'Records': [kinesisRecord(context.message(messageType='pageUrl', url='poison'), 1)]}
+        self.assertEqual(context.lambda_handler(event, None), None)
+        retried = decode(self.kinesisClient.delivered[0][1]['Data'])
+        self.assertEqual(retried['_system']['attempts'], 2)
+        self.assertEqual(retried['_system']['flow']['currentState']['callback'], 'pageUrl')
+
+    def test_sqs_retry_is_delayed(self):
+        context = self.createContext({'maxAttempts': 2, 'delay': 5, 'queue': 'deadLetter'})
+        event = {'Records': [kinesisRecord(context.message(messageType='pageUrl', url='poison'), 1)]}
+        context.lambda_handler(event, None)
+        self.assertTrue(3 <= self.sqsClient.delivered[0][1]['DelaySeconds'] <= 5)
+
+    def test_dead_letter_queue(self):
+        context = self.createContext({'maxAttempts': 1, 'deadLetterQueue': 'deadLetter'})
+        event = {'Records': [kinesisRecord(context.message(messageType='pageUrl', url='poison'), 1)]}
+        self.assertEqual(context.lambda_handler(event, None), None)
+        failed = decode(base64.b64decode(self.sqsClient.delivered[0][1]['MessageBody']))
+        self.assertEqual(failed['url'], 'poison')
+        self.assertEqual(failed['_system']['error']['callback'], 'pageUrl')
+
+    def test_undecodable_record_is_dropped_without_dead_letter_queue(self):
+        context = self.createContext({})
+        event = {'Records': [{'kinesis': {'data': base64.b64encode(b'{not json').decode('ascii'),
+                                          'sequenceNumber': '0', 'partitionKey': 'shard'}},
+                             kinesisRecord(context.message(messageType='pageUrl', url='a'), 1, 'shard')]}
+        self.assertEqual(context.lambda_handler(event, None), None)
+        self.assertEqual(self.received, ['a'])
+
+    def test_undecodable_record_goes_to_the_dead_letter_queue(self):
+        context = self.createContext({'deadLetterQueue': 'deadLetter'})
+        event = {'Records': [{'kinesis': {'data': base64.b64encode(b'{not json').decode('ascii'),
+                                          'sequenceNumber': '1', 'partitionKey': '1'}}]}
+        self.assertEqual(context.lambda_handler(event, None), None)
+        self.assertEqual(base64.b64decode(self.sqsClient.delivered[0][1]['MessageBody']), b'{not json')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import base64
+import json
+
+from hop import ContextConfig
+from hop.codec import decode
+from hop.kinesis import LambdaContext
+from hop.sqs import SQSPublishBuffer
+from tests.stubs import StubKinesisClient, StubSQSClient, StubTable
+from tests.test_kinesis import StubLambdaContext, kinesisRecord
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+QUEUE_URL = 'https://sqs.ap-southeast-2.amazonaws.com/1234567890/HopperBursty'
+
+def sqsRecord(msg, messageId, groupId=None, encoded=True):
+    body = json.dumps(msg)
+    record = {'messageId': str(messageId), 'receiptHandle': 'handle%s' % messageId, 'eventSource': 'aws:sqs',
+              'body': base64.b64encode(body.encode('utf-8')).decode('ascii') if encoded else body,
+              'attributes': {}}
+    if groupId is not None:
+        record['attributes']['MessageGroupId'] = groupId
+    return record
+
+class SQSPublishBufferTest(unittest.TestCase):
+
+    def test_batches_of_ten(self):
+        client = StubSQSClient()
+        buffer = SQSPublishBuffer(client)
+        for i in range(25):
+            buffer.add(QUEUE_URL, str(i).encode('ascii'), str(i))
+        buffer.flush()
+        self.assertEqual([len(entries) for _, entries in client.calls], [10, 10, 5])
+        self.assertEqual([base64.b64decode(entry['MessageBody']) for _, entry in client.delivered[:2]], [b'0', b'1'])
+        self.assertFalse('MessageGroupId' in client.delivered[0][1])
+
+    def test_fifo_queue_groups_by_partition_key(self):
+        client = StubSQSClient()
+        buffer = SQSPublishBuffer(client)
+        buffer.add(QUEUE_URL + '.fifo', b'a', 'page1', deduplicationID='m1')
+        buffer.add(QUEUE_URL, b'b', 'page1', deduplicationID='m2')
+        buffer.flush()
+        entries = dict(client.delivered)
+        self.assertEqual(entries[QUEUE_URL + '.fifo']['MessageGroupId'], 'page1')
+        self.assertEqual(entries[QUEUE_URL + '.fifo']['MessageDeduplicationId'], 'm1')
+        self.assertFalse('MessageDeduplicationId' in entries[QUEUE_URL])
+
+    def test_retries_only_failed_entries(self):
+        client = StubSQSClient(failures={b'b': 2})
+        buffer = SQSPublishBuffer(client, retryDelay=0)
+        for data in [b'a', b'b', b'c']:
+            buffer.add(QUEUE_URL, data, 'key')
+        self.assertEqual(buffer.flush(), [])
+        self.assertEqual([len(entries) for _, entries in client.calls], [3, 1, 1])
+        self.assertEqual(len(client.delivered), 3)
+
+    def test_sender_faults_are_not_retried(self):
+        client = StubSQSClient(senderFaults=set([b'b']), failures={b'c': 5})
+        buffer = SQSPublishBuffer(client, maxRetries=1, retryDelay=0)
+        for data in [b'a', b'b', b'c']:
+            buffer.add(QUEUE_URL, data, 'key')
+        failed = buffer.flush()
+        self.assertEqual(sorted(base64.b64decode(entry['MessageBody']) for entry in failed), [b'b', b'c'])
+        self.assertEqual([len(entries) for _, entries in client.calls], [3, 1])
+
+
+class SQSLambdaContextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kinesisClient = StubKinesisClient()
+        self.sqsClient = StubSQSClient()
+        config = ContextConfig({'lambda': {'deadlineMargin': 100},
+                                'queues': {'default': {'type': 'kinesis', 'stream': 'HopperQueue'},
+                                           'bursty': {'type': 'sqs', 'name': 'HopperBursty'}}})
+        self.context = LambdaContext(config, kinesisClient=self.kinesisClient, table=StubTable(), sqsClient=self.sqsClient)
+
+    def test_publish_goes_to_the_backend_of_the_queue(self):
+        for i in range(3):
+            self.context.publish(self.context.message(messageType='pageUrl', url=str(i)), 'bursty')
+        self.context.publish(self.context.message(messageType='pageUrl', url='k'))
+        self.assertEqual(self.context.flush(), [])
+        self.assertEqual(self.sqsClient.urlLookups, 1)
+        self.assertEqual([decode(base64.b64decode(entry['MessageBody']))['url'] for url, entry in self.sqsClient.delivered],
+                         ['0', '1', '2'])
+        self.assertEqual(self.sqsClient.delivered[0][0], QUEUE_URL)
+        self.assertEqual([decode(record['Data'])['url'] for stream, record in self.kinesisClient.delivered], ['k'])
+
+    def test_fifo_messages_are_deduplicated_by_message_id(self):
+        config = ContextConfig({'queues': {'default': {'type': 'sqs', 'name': 'HopperOrdered.fifo'}}})
+        context = LambdaContext(config, kinesisClient=self.kinesisClient, table=StubTable(), sqsClient=self.sqsClient)
+        msg = context.message(messageType='pageUrl', url='a')
+        context.publish(msg)
+        context.flush()
+        self.assertEqual(self.sqsClient.delivered[0][1]['MessageDeduplicationId'], msg['_system']['messageID'])
+
+    def test_handles_sqs_event(self):
+        received = []
+        self.context.handle('pageUrl')(lambda msg: received.append(msg['url']))
+        event = {'Records': [sqsRecord(self.context.message(messageType='pageUrl', url='a'), 1),
+                             sqsRecord(self.context.message(messageType='pageUrl', url='b'), 2, encoded=False)]}
+        self.assertEqual(self.context.lambda_handler(event, None), None)
+        self.assertEqual(received, ['a', 'b'])
+
+    def test_reports_sqs_records_left_at_deadline(self):
+        lambdaContext = StubLambdaContext()
+
+        @self.context.handle('pageUrl')
+        def pageUrl(msg):
+            lambdaContext.remaining = 50
+
+        event = {'Records': [sqsRecord(self.context.message(messageType='pageUrl', url=str(i)), 'id%d' % i) for i in range(3)]}
+        response = self.context.lambda_handler(event, lambdaContext)
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': 'id1'}, {'itemIdentifier': 'id2'}]})
+
+    def test_mixed_event_sources(self):
+        received = []
+        self.context.handle('pageUrl')(lambda msg: received.append(msg['url']))
+        event = {'Records': [kinesisRecord(self.context.message(messageType='pageUrl', url='k'), 1),
+                             sqsRecord(self.context.message(messageType='pageUrl', url='s'), 2)]}
+        self.context.lambda_handler(event, None)
+        self.assertEqual(received, ['k', 's'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+from hop import ContextConfig
+from hop.kinesis import PublishBuffer, LambdaContext
+from hop.local import LocalContext
+from hop.metrics import Metrics, prometheusText
+from hop.throttle import TokenBucket, AdaptiveBackoff, RateLimits
+from tests.stubs import StubKinesisClient, StubTable
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_waits(self):
+        bucket = TokenBucket(10, burst=2)
+        self.assertEqual([bucket.reserve(), bucket.reserve()], [0.0, 0.0])
+        delays = [bucket.reserve(), bucket.reserve()]
+        self.assertTrue(0.05 < delays[0] <= 0.1)
+        self.assertTrue(0.15 < delays[1] <= 0.2)
+
+    def test_try_acquire_does_not_owe(self):
+        bucket = TokenBucket(1, burst=1)
+        self.assertTrue(bucket.tryAcquire())
+        self.assertFalse(bucket.tryAcquire())
+        self.assertTrue(bucket.tokens > -0.01)
+
+
+class AdaptiveBackoffTest(unittest.TestCase):
+
+    def test_multiplicative_increase_additive_decrease(self):
+        backoff = AdaptiveBackoff(initial=0.1, maximum=0.5)
+        delays = []
+        for i in range(4):
+            backoff.throttled()
+            delays.append(backoff.delay)
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.5])
+        backoff.succeeded()
+        self.assertAlmostEqual(backoff.delay, 0.4)
+        for i in range(5):
+            backoff.succeeded()
+        self.assertEqual(backoff.delay, 0.0)
+
+    def test_jittered_wait(self):
+        slept = []
+        backoff = AdaptiveBackoff(initial=0.2)
+        backoff.sleep = slept.append
+        self.assertEqual(backoff.wait(), 0.0)
+        backoff.throttled()
+        for i in range(20):
+            backoff.wait()
+        self.assertTrue(all(0.1 <= delay <= 0.2 for delay in slept))
+        self.assertTrue(len(set(slept)) > 1)
+
+
+class RateLimitsTest(unittest.TestCase):
+
+    def test_from_config(self):
+        config = ContextConfig({'throttle': {'burst': 2, 'messageTypes': {'pageUrl': 10}, 'queues': {'default': 100}}})
+        limits = RateLimits.fromConfig(config)
+        self.assertEqual(sorted(limits.buckets), [('messageType', 'pageUrl'), ('queue', 'default')])
+        self.assertEqual(limits.buckets[('messageType', 'pageUrl')].burst, 20)
+        self.assertEqual(RateLimits.fromConfig(ContextConfig({'throttle': {'burst': 1}})), None)
+
+    def test_dispatch_waits_for_the_limit_of_the_message_type(self):
+        context = LocalContext(ContextConfig({'metrics': {'enabled': True}}))
+        received = []
+
+        @context.handle('pageUrl', rateLimit=5, burst=1)
+        def pageUrl(msg):
+            received.append(msg['url'])
+
+        context.handle('pageBody')(lambda msg: None)
+        slept = []
+        context.rateLimits.sleep = slept.append
+        for i in range(3):
+            context.publish(context.message(messageType='pageUrl', url=i))
+        context.publish(context.message(messageType='pageBody'))
+        context.run()
+        self.assertEqual(received, [0, 1, 2])
+        self.assertEqual(len(slept), 2)
+        self.assertTrue(0.15 < slept[0] <= 0.2)
+        throttles = context.stats()['throttles']
+        self.assertEqual(list(throttles), ['messageType.pageUrl'])
+        self.assertEqual(throttles['messageType.pageUrl']['count'], 2)
+        self.assertTrue('hopper_throttles_total{kind="messageType",name="pageUrl"} 2' in prometheusText(context.stats()))
+
+    def test_publish_waits_for_the_limit_of_the_queue(self):
+        context = LocalContext(ContextConfig({'throttle': {'queues': {'default': 100}}}))
+        slept = []
+        context.rateLimits.sleep = slept.append
+        for i in range(102):
+            context.publish(context.message(messageType='pageUrl'))
+        self.assertEqual(len(slept), 2)
+        context.publish(context.message(messageType='pageUrl'), 'other')
+        self.assertEqual(len(slept), 2)
+
+
+class ThrottledPublishTest(unittest.TestCase):
+
+    def createBuffer(self, client, **kwargs):
+        buffer = PublishBuffer(client, maxRetries=0, **kwargs)
+        self.slept = []
+        buffer.backoff.sleep = self.slept.append
+        buffer.metrics = Metrics()
+        return buffer
+
+    def test_throttled_records_are_retried_without_using_retries(self):
+        client = StubKinesisClient(failures={'a': 3}, errorCode='ProvisionedThroughputExceededException')
+        buffer = self.createBuffer(client)
+        buffer.add('stream', b'1', 'a')
+        buffer.add('stream', b'2', 'b')
+        self.assertEqual(buffer.flush(), [])
+        self.assertEqual([len(records) for _, records in client.calls], [2, 1, 1, 1])
+        self.assertEqual(len(self.slept), 3)
+        self.assertTrue(self.slept[2] > self.slept[0])
+        self.assertEqual(buffer.metrics.snapshot()['throttles']['backend.stream']['count'], 3)
+        # The next batch is paced by the delay left
+        buffer.add('stream', b'3', 'c')
+        buffer.flush()
+        self.assertEqual(len(self.slept), 4)
+
+    def test_gives_up_after_the_throttle_wait(self):
+        client = StubKinesisClient(failures={'a': 100}, errorCode='ProvisionedThroughputExceededException')
+        buffer = self.createBuffer(client, maxThrottleWait=1)
+        buffer.add('stream', b'1', 'a')
+        self.assertEqual(len(buffer.flush()), 1)
+        self.assertTrue(sum(self.slept[:-1]) < 1)
+
+    def test_other_errors_use_retries(self):
+        client = StubKinesisClient(failures={'a': 1})
+        buffer = self.createBuffer(client)
+        buffer.add('stream', b'1', 'a')
+        self.assertEqual(len(buffer.flush()), 1)
+        self.assertEqual(self.slept, [])
+
+    def test_lambda_context_counts_backend_throttles(self):
+        client = StubKinesisClient(failures={'a': 1}, errorCode='ProvisionedThroughputExceededException')
+        context = LambdaContext(ContextConfig({'queues': {'default': {'stream': 'HopperQueue'}}}),
+                                kinesisClient=client, table=StubTable())
+        context.publishBuffer.backoff.sleep = lambda delay: None
+        context.publishBuffer.add('HopperQueue', b'1', 'a')
+        self.assertEqual(context.flush(), [])
+        self.assertEqual(context.stats()['throttles']['backend.HopperQueue']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
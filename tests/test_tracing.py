@@ -0,0 +1,152 @@
+import json
+
+from hop import ContextConfig, Message
+from hop.kinesis import LambdaContext
+from hop.local import LocalContext
+from hop.tracing import LogCollector
+from tests.stubs import StubKinesisClient, StubTable
+from tests.test_kinesis import kinesisEvent, StubLambdaContext
+from hop.codec import decode
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class LocalTracingTest(unittest.TestCase):
+
+    def createPipeline(self, context):
+        received = dict()
+
+        @context.handle('pageView')
+        def pageView(msg):
+            received['pageView'] = msg
+            context.publish(context.message(messageType='enriched'))
+
+        @context.handle('enriched')
+        def enriched(msg):
+            received['enriched'] = msg
+            context.publish(context.message(messageType='stored'))
+
+        @context.handle('stored')
+        def stored(msg):
+            received['stored'] = msg
+
+        return received
+
+    def test_lineage(self):
+        context = LocalContext()
+        tracer = context.trace()
+        received = self.createPipeline(context)
+        context.publish(context.message(messageType='pageView'))
+        context.run()
+
+        root, child, grandchild = [received[name]['_system'] for name in ['pageView', 'enriched', 'stored']]
+        self.assertEqual(root['traceID'], root['messageID'])
+        self.assertFalse('parentMessageID' in root)
+        self.assertEqual(child['traceID'], root['messageID'])
+        self.assertEqual(child['parentMessageID'], root['messageID'])
+        self.assertEqual(grandchild['parentMessageID'], child['messageID'])
+        self.assertTrue(grandchild['published'] >= root['published'])
+
+        spans = tracer.collector.trace(root['traceID'])
+        self.assertEqual([span['messageType'] for span in spans], ['pageView', 'enriched', 'stored'])
+        self.assertTrue(all(span['queueWait'] >= 0 and span['duration'] >= 0 for span in spans))
+        self.assertEqual([span['messageType'] for span in tracer.collector.criticalPath(root['traceID'])],
+                         ['pageView', 'enriched', 'stored'])
+
+    def test_sampling(self):
+        context = LocalContext(ContextConfig({'tracing': {'enabled': True, 'sampleRate': 0, 'collector': 'local'}}))
+        received = self.createPipeline(context)
+        context.publish(context.message(messageType='pageView'))
+        context.run()
+        self.assertEqual(len(context.tracer.collector.spans), 0)
+        self.assertFalse(received['stored']['_system']['sampled'])
+        self.assertEqual(received['stored']['_system']['traceID'], received['pageView']['_system']['messageID'])
+
+    def test_fanoutCopiesJoinTrace(self):
+        context = LocalContext()
+        context.trace()
+        received = []
+
+        @context.handle('test')
+        def first(msg):
+            received.append(msg)
+
+        @context.handle('test')
+        def second(msg):
+            received.append(msg)
+
+        context.publish(context.message(messageType='test'))
+        context.run()
+        original, copy = received
+        self.assertEqual(copy['_system']['traceID'], original['_system']['traceID'])
+        self.assertEqual(copy['_system']['parentMessageID'], original['_system']['messageID'])
+
+    def siblingTrace(self, fanout):
+        context = LocalContext(ContextConfig({'dispatch': {'fanout': fanout}}))
+        context.trace()
+        received = dict()
+
+        @context.handle('test')
+        def first(msg):
+            received['original'] = msg
+
+        @context.handle('test')
+        def second(msg):
+            received['copy'] = msg
+            context.publish(context.message(messageType='child'))
+
+        @context.handle('child')
+        def child(msg):
+            received['child'] = msg
+
+        context.publish(context.message(messageType='test'))
+        context.run()
+        original, copy, child = received['original']['_system'], received['copy']['_system'], received['child']['_system']
+        self.assertEqual(copy['traceID'], original['traceID'])
+        self.assertEqual(copy['parentMessageID'], original['messageID'])
+        self.assertEqual(child['traceID'], original['traceID'])
+        self.assertEqual(child['parentMessageID'], original['messageID'])
+        spans = context.tracer.collector.trace(original['traceID'])
+        self.assertEqual(sorted(span['messageID'] for span in spans),
+                         sorted([original['messageID'], copy['messageID'], child['messageID']]))
+
+    def test_inlineSiblingsJoinTrace(self):
+        self.siblingTrace('inline')
+
+    def test_poolSiblingsJoinTrace(self):
+        self.siblingTrace('pool')
+
+    def test_disabledByDefault(self):
+        context = LocalContext()
+        msg = context.message(messageType='test')
+        context.publish(msg)
+        self.assertEqual(context.tracer, None)
+        self.assertFalse('traceID' in msg['_system'])
+
+
+class LambdaTracingTest(unittest.TestCase):
+
+    def test_spansLoggedAndParentStamped(self):
+        client = StubKinesisClient()
+        config = ContextConfig({'tracing': {'enabled': True, 'sampleRate': 1}, 'queues': {'default': {'stream': 'HopperQueue'}}})
+        context = LambdaContext(config, kinesisClient=client, table=StubTable())
+        self.assertTrue(isinstance(context.tracer.collector, LogCollector))
+        lines = []
+        context.tracer.collector.write = lines.append
+        context.handle('pageView')(lambda msg: context.publish(context.message(messageType='enriched')))
+
+        root = Message('pageView', None)
+        context.lambda_handler(kinesisEvent(root), StubLambdaContext())
+        published = decode(client.delivered[0][1]['Data'])
+        self.assertEqual(published['_system']['parentMessageID'], root['_system']['messageID'])
+        self.assertEqual(published['_system']['traceID'], root['_system']['messageID'])
+        span = json.loads(lines[0])['span']
+        self.assertEqual((span['messageType'], span['messageID']), ('pageView', root['_system']['messageID']))
+
+        # The next hop continues the trace
+        del lines[:]
+        context.lambda_handler(kinesisEvent(published), StubLambdaContext())
+        span = json.loads(lines[0])['span']
+        self.assertEqual((span['traceID'], span['parentMessageID']), (root['_system']['messageID'], root['_system']['messageID']))
+        self.assertTrue(span['queueWait'] >= 0)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+
+from examples.crawler.urlstore import UrlStore
+
+__author__ = 'Denis Mikhalkin'
+
+import unittest
+
+class UrlStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'urls')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_addAndContains(self):
+        store = UrlStore()
+        self.assertTrue(store.add('http://abc.com'))
+        self.assertFalse(store.add('http://abc.com'))
+        self.assertTrue('http://abc.com' in store)
+        self.assertFalse('http://abc.com/other' in store)
+        self.assertTrue(store.add(u'http://\u00e9.com'))
+        self.assertEqual(len(store), 2)
+
+    def test_growsAndPersists(self):
+        store = UrlStore(self.path, capacity=1024)
+        urls = ['http://abc.com/%d' % i for i in range(5000)]
+        for url in urls:
+            store.add(url)
+        self.assertTrue(store.slots >= 10000)
+        store.close()
+        self.assertFalse(os.path.exists(self.path + '.grow'))
+
+        reopened = UrlStore(self.path)
+        self.assertEqual(len(reopened), 5000)
+        self.assertTrue(all(url in reopened for url in urls))
+        self.assertFalse('http://abc.com/5000' in reopened)
+        reopened.close()
+
+    def test_batches(self):
+        store = UrlStore()
+        store.add('http://a')
+        self.assertEqual(store.addMany(['http://b', 'http://a', 'http://c', 'http://b']), ['http://b', 'http://c'])
+        self.assertEqual(store.containsMany(['http://c', 'http://d', 'http://a']), [True, False, True])
+
+    def test_rejectsOtherFiles(self):
+        with open(self.path, 'wb') as stream:
+            stream.write(b'x' * 64)
+        self.assertRaises(ValueError, UrlStore, self.path)